@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Collection, Dict, List, Optional
+
+from health import CircuitBreaker, STATE_DEGRADED, STATE_DOWN, STATE_UNKNOWN
+
+logger = logging.getLogger(__name__)
+
+
+class NoBackendAvailableError(Exception):
+    """Нет ни одного сервера Stable Diffusion, на который можно отправить задачу."""
+
+
+@dataclass
+class Backend:
+    """Сервер Stable Diffusion в пуле."""
+    url: str
+    max_concurrent: int
+    outstanding: int = 0
+    # Скользящее среднее длительности запросов к серверу, с
+    latency: Optional[float] = None
+    draining: bool = False
+    completed: int = 0
+    failed: int = 0
+    last_used: float = 0.0
+    # Кешированный результат фоновой проверки
+    state: str = STATE_UNKNOWN
+    probe_latency: Optional[float] = None
+    checked_at: Optional[float] = None
+    breaker: CircuitBreaker = field(default_factory=lambda: CircuitBreaker(3, 30.0))
+    # Прогрев: пока сервер загружает модель, задачи на него не направляются
+    warming: bool = False
+    warmup_seconds: Optional[float] = None
+    warmup_error: Optional[str] = None
+
+    @property
+    def load(self) -> float:
+        return self.outstanding / self.max_concurrent
+
+    @property
+    def available(self) -> bool:
+        """Сервер прогрет, не выключен проверкой и автомат защиты пропускает запросы."""
+        return (not self.draining and not self.warming and self.state != STATE_DOWN
+                and self.breaker.allows_request())
+
+
+class BackendPool:
+    """Пул серверов Stable Diffusion с балансировкой нагрузки.
+
+    Задача направляется на сервер с наименьшей загрузкой (число выполняемых
+    запросов относительно лимита), а при равной загрузке - на сервер с
+    наименьшей недавней задержкой. Сервер в режиме drain новые задачи не
+    получает, но дорабатывает уже начатые.
+    """
+
+    def __init__(self, urls: Collection[str], max_concurrent: int, failure_threshold: int = 3,
+                 reset_timeout: float = 30.0):
+        self.max_concurrent = max_concurrent
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._backends: Dict[str, Backend] = {}
+        self._changed = asyncio.Event()
+        for url in urls:
+            self.add(url)
+
+    @staticmethod
+    def normalize(url: str) -> str:
+        return url.strip().rstrip('/')
+
+    def add(self, url: str) -> Backend:
+        """Добавляет сервер в пул (или возвращает уже добавленный)."""
+        url = self.normalize(url)
+        backend = self._backends.get(url)
+        if backend is None:
+            backend = self._backends[url] = Backend(
+                url=url, max_concurrent=self.max_concurrent,
+                breaker=CircuitBreaker(self.failure_threshold, self.reset_timeout))
+            logger.info(f"Сервер {url} добавлен в пул")
+            self._changed.set()
+        return backend
+
+    def remove(self, url: str) -> bool:
+        """Удаляет сервер из пула. Уже начатые на нём задачи доработают."""
+        backend = self._backends.pop(self.normalize(url), None)
+        if backend is not None:
+            logger.info(f"Сервер {backend.url} удалён из пула")
+        return backend is not None
+
+    def drain(self, url: str, draining: bool = True) -> bool:
+        """Включает или выключает режим drain для сервера."""
+        backend = self._backends.get(self.normalize(url))
+        if backend is None:
+            return False
+        backend.draining = draining
+        logger.info(f"Сервер {backend.url}: режим drain {'включён' if draining else 'выключен'}")
+        self._changed.set()
+        return True
+
+    def replace(self, urls: Collection[str]) -> None:
+        """Заменяет состав пула заданным списком серверов."""
+        keep = {self.normalize(url) for url in urls}
+        for url in list(self._backends):
+            if url not in keep:
+                self.remove(url)
+        for url in urls:
+            self.add(url)
+
+    @property
+    def backends(self) -> List[Backend]:
+        return list(self._backends.values())
+
+    def get(self, url: str) -> Optional[Backend]:
+        return self._backends.get(self.normalize(url))
+
+    def routable(self, exclude: Collection[str] = ()) -> List[Backend]:
+        """Серверы, на которые сейчас можно направлять задачи."""
+        return [b for b in self._backends.values() if b.available and b.url not in exclude]
+
+    def has_available(self) -> bool:
+        """Есть ли хотя бы один доступный сервер (по кешированному состоянию).
+
+        Прогревающиеся серверы тоже учитываются: задача подождёт в очереди.
+        """
+        return any(b.available or (b.warming and not b.draining and b.state != STATE_DOWN)
+                   for b in self._backends.values())
+
+    def notify(self) -> None:
+        """Будит задачи, ожидающие свободный сервер."""
+        self._changed.set()
+
+    @property
+    def capacity(self) -> int:
+        """Суммарное число одновременных запросов по всем доступным серверам."""
+        return sum(b.max_concurrent for b in self.routable())
+
+    def pick(self, exclude: Collection[str] = ()) -> Optional[Backend]:
+        """Выбирает свободный сервер с наименьшей загрузкой и задержкой."""
+        free = [b for b in self.routable(exclude) if b.outstanding < b.max_concurrent]
+        if not free:
+            return None
+        return min(free, key=lambda b: (b.state == STATE_DEGRADED, b.load, b.latency or 0.0, b.last_used))
+
+    async def acquire(self, exclude: Collection[str] = ()) -> Backend:
+        """Ждёт свободный сервер и резервирует на нём слот.
+
+        Если заданы исключения (например, серверы, на которых задача уже
+        упала) и других доступных серверов нет, выбрасывает NoBackendAvailableError.
+        """
+        while True:
+            self._changed.clear()
+            backend = self.pick(exclude)
+            if backend is not None:
+                backend.breaker.on_request()
+                backend.outstanding += 1
+                backend.last_used = time.monotonic()
+                return backend
+            if exclude and not self.routable(exclude):
+                raise NoBackendAvailableError("Нет других доступных серверов Stable Diffusion")
+            await self._changed.wait()
+
+    def release(self, backend: Backend, duration: Optional[float] = None, ok: Optional[bool] = True) -> None:
+        """Освобождает слот сервера и учитывает результат запроса.
+
+        ok=None означает, что слот возвращается без результата (запрос не
+        отправлялся или был отменён) и не влияет на автомат защиты.
+        """
+        backend.outstanding -= 1
+        if ok is None:
+            backend.breaker.cancel_request()
+        elif ok:
+            backend.completed += 1
+            backend.breaker.record_success()
+            if duration is not None:
+                backend.latency = duration if backend.latency is None else 0.7 * backend.latency + 0.3 * duration
+        else:
+            backend.failed += 1
+            backend.breaker.record_failure()
+            if backend.breaker.state == CircuitBreaker.OPEN:
+                logger.warning(f"Сервер {backend.url}: автомат защиты разомкнут после {backend.breaker.failures} ошибок")
+        self._changed.set()
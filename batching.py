@@ -0,0 +1,65 @@
+import logging
+from typing import Hashable, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Поля, которые могут различаться у задач внутри одного пакета
+_PER_JOB_FIELDS = ("prompt",)
+
+
+def batch_key(payload: dict, prompt_list: bool) -> Hashable:
+    """Возвращает ключ совместимости задач для объединения в один запрос txt2img.
+
+    Задачи совместимы, если у них совпадают все параметры генерации (размер,
+    шаги, сэмплер, negative prompt, seed и т.д.). Если API не принимает список
+    промптов, в ключ входит и сам промпт.
+    """
+    ignored = _PER_JOB_FIELDS if prompt_list else ()
+    return tuple(sorted((k, repr(v)) for k, v in payload.items() if k not in ignored and k != "batch_size"))
+
+
+def _fixed_seed(payload: dict) -> bool:
+    return payload.get("seed", -1) not in (-1, None)
+
+
+def _shared_result(payloads: Sequence[dict]) -> bool:
+    # Одинаковый промпт с фиксированным seed даёт одно и то же изображение
+    return len({p["prompt"] for p in payloads}) == 1 and _fixed_seed(payloads[0])
+
+
+def build_batch_payload(payloads: Sequence[dict], prompt_list: bool) -> dict:
+    """Собирает один запрос txt2img для пакета совместимых задач.
+
+    Одинаковые промпты отправляются одним промптом с batch_size=N (сервер
+    сам подбирает разные seed), а при фиксированном seed - одной генерацией,
+    результат которой получат все задачи. Разные промпты передаются списком
+    с batch_size=N, если API это поддерживает.
+    """
+    payload = dict(payloads[0])
+    prompts = [p["prompt"] for p in payloads]
+    if len(set(prompts)) == 1:
+        payload["batch_size"] = 1 if _shared_result(payloads) else len(payloads)
+    elif prompt_list:
+        payload["prompt"] = prompts
+        payload["batch_size"] = len(payloads)
+    else:
+        raise ValueError("Разные промпты нельзя объединить без поддержки списка промптов")
+    return payload
+
+
+def split_batch_results(payloads: Sequence[dict], images: List[bytes]) -> List[Optional[bytes]]:
+    """Распределяет изображения из ответа пакета по задачам в исходном порядке.
+
+    Задачи, на которые изображений не хватило, получают None и завершаются
+    ошибкой: копировать им чужое изображение со случайным seed нельзя.
+    """
+    expected = len(payloads)
+    if _shared_result(payloads):
+        # Одна генерация с фиксированным seed на все одинаковые задачи
+        return [images[-1] if images else None] * expected
+    if len(images) == expected + 1:
+        # Некоторые серверы возвращают первым изображением сетку из всего пакета
+        images = images[1:]
+    if len(images) < expected:
+        logger.warning(f"В ответе пакета {len(images)} изображений вместо {expected}")
+    return [images[i] if i < len(images) else None for i in range(expected)]
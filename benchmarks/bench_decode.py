@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Сравнение пикового потребления памяти при разборе ответа txt2img.
+
+Старый путь: всё тело ответа в памяти, json.loads, b64decode и обёртка в
+BytesIO. Новый путь: тело подаётся кусками в ImagesStreamDecoder.
+
+Запуск:
+    python benchmarks/bench_decode.py [--image-mb 3] [--info-kb 64] [--images 1]
+"""
+
+import argparse
+import base64
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming import ImagesStreamDecoder  # noqa: E402
+
+CHUNK_SIZE = 64 * 1024
+
+
+def make_body(image_bytes: int, info_bytes: int, images: int) -> bytes:
+    """Собирает ответ txt2img с изображениями и большим полем info."""
+    image = base64.b64encode(os.urandom(image_bytes)).decode()
+    return json.dumps({
+        "images": [image] * images,
+        "parameters": {"prompt": "x" * 1000, "steps": 30},
+        "info": "i" * info_bytes,
+    }).encode()
+
+
+def chunks(body: bytes):
+    view = memoryview(body)
+    for start in range(0, len(body), CHUNK_SIZE):
+        # Копия куска имитирует чтение из сокета
+        yield bytes(view[start:start + CHUNK_SIZE])
+
+
+def decode_old(body_chunks) -> bytes:
+    body = b''.join(body_chunks)
+    result = json.loads(body)
+    image_data = base64.b64decode(result["images"][0])
+    return io.BytesIO(image_data).getvalue()
+
+
+def decode_streaming(body_chunks) -> bytes:
+    decoder = ImagesStreamDecoder()
+    for chunk in body_chunks:
+        decoder.feed(chunk)
+    return decoder.close()[0]
+
+
+def measure(name: str, func, body: bytes) -> None:
+    tracemalloc.start()
+    started = time.perf_counter()
+    image = func(chunks(body))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} пик памяти: {peak / 1024 / 1024:7.2f} МБ, "
+          f"время: {elapsed * 1000:7.1f} мс, изображение: {len(image) / 1024 / 1024:.2f} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image-mb", type=float, default=3.0, help="Размер изображения, МБ")
+    parser.add_argument("--info-kb", type=int, default=64, help="Размер поля info, КБ")
+    parser.add_argument("--images", type=int, default=1, help="Число изображений в ответе")
+    args = parser.parse_args()
+
+    body = make_body(int(args.image_mb * 1024 * 1024), args.info_kb * 1024, args.images)
+    print(f"Размер ответа: {len(body) / 1024 / 1024:.2f} МБ")
+    measure("json", decode_old, body)
+    measure("streaming", decode_streaming, body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Сравнение размера и времени перекодирования PNG в JPEG/WebP.
+
+Исходное изображение - плавный градиент с шумом, близкий по сжимаемости к
+результатам Stable Diffusion, либо собственный PNG через --input.
+
+Запуск:
+    python benchmarks/bench_transcode.py [--size 1024] [--quality 90] [--max-side 0] [--input image.png]
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from transcoding import FORMATS, transcode_image  # noqa: E402
+
+
+def make_png(size: int) -> bytes:
+    """Собирает PNG с градиентом и шумом."""
+    gradient = Image.linear_gradient("L").resize((size, size))
+    noise = Image.effect_noise((size, size), 24)
+    image = Image.merge("RGB", (gradient, noise, gradient.rotate(90)))
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024, help="Сторона тестового изображения, px")
+    parser.add_argument("--quality", type=int, default=90, help="Качество сжатия")
+    parser.add_argument("--max-side", type=int, default=0, help="Максимальная сторона после уменьшения, px")
+    parser.add_argument("--input", help="PNG-файл вместо тестового изображения")
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, 'rb') as f:
+            data = f.read()
+    else:
+        data = make_png(args.size)
+    print(f"png        размер: {len(data) / 1024:8.1f} КБ")
+    for name in FORMATS:
+        started = time.perf_counter()
+        result = transcode_image(data, name, args.quality, args.max_side)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<10} размер: {len(result) / 1024:8.1f} КБ ({len(result) / len(data):.0%}), "
+              f"время: {elapsed * 1000:7.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
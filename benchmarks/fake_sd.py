@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Локальная заглушка API Stable Diffusion для нагрузочного тестирования.
+
+Поддерживает /sdapi/v1/txt2img, /sdapi/v1/img2img, /sdapi/v1/extra-single-image,
+/sdapi/v1/progress, /sdapi/v1/interrupt, /sdapi/v1/options и /sdapi/v1/sd-models.
+Время генерации берётся из логнормального распределения, одновременно
+выполняется не больше --concurrency запросов (как на одном GPU), часть
+запросов может завершаться ошибкой. Первая генерация дольше на --cold-start
+секунд, смена чекпойнта занимает --checkpoint-load секунд. С --scale-by-work время пропорционально
+размеру и числу шагов запроса (медиана задаётся для 512x512 и 20 шагов).
+Счётчики доступны на /stats.
+
+Запуск:
+    python benchmarks/fake_sd.py [--port 7861] [--latency-median 2] [--latency-sigma 0.3]
+                                 [--image-side 512] [--error-rate 0] [--concurrency 1] [--scale-by-work]
+                                 [--cold-start 0] [--checkpoint-load 0]
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import math
+import os
+import random
+import time
+
+from aiohttp import web
+
+try:
+    from PIL import Image
+except ImportError:  # Без Pillow отдаются случайные байты вместо PNG
+    Image = None
+
+# Шаг, с которым имитация генерации проверяет прерывание и обновляет прогресс, с
+STEP_INTERVAL = 0.05
+
+# Чекпойнты, которые "установлены" на заглушке; загружен первый
+CHECKPOINTS = ["sd_xl_base_1.0", "v1-5-pruned-emaonly"]
+
+# Объём работы (мегапиксель-шаги), для которого задана медиана времени генерации
+REFERENCE_WORK = 512 * 512 / 1_000_000 * 20
+
+
+def make_image(side: int) -> bytes:
+    """PNG с шумом: по размеру близок к реальным результатам генерации."""
+    if Image is None:
+        return os.urandom(side * side)
+    image = Image.effect_noise((side, side), 32).convert("RGB")
+    output = io.BytesIO()
+    image.save(output, "PNG")
+    return output.getvalue()
+
+
+class FakeSDServer:
+    def __init__(self, latency_median: float, latency_sigma: float, image_side: int, error_rate: float,
+                 concurrency: int, seed: int = None, scale_by_work: bool = False, cold_start: float = 0.0,
+                 checkpoint_load: float = 0.0):
+        self.latency_median = latency_median
+        self.scale_by_work = scale_by_work
+        self.cold_start = cold_start
+        self.checkpoint_load = checkpoint_load
+        self.checkpoint = self._title(CHECKPOINTS[0])
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.image_b64 = base64.b64encode(make_image(image_side)).decode()
+        self._gpu = asyncio.Semaphore(concurrency)
+        self._interrupted = False
+        self._current = None
+        self.stats = {"requests": 0, "images": 0, "errors": 0, "interrupted": 0, "busy_seconds": 0.0}
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_get("/", self.handle_root)
+        app.router.add_post("/sdapi/v1/txt2img", self.handle_txt2img)
+        app.router.add_post("/sdapi/v1/img2img", self.handle_txt2img)
+        app.router.add_post("/sdapi/v1/extra-single-image", self.handle_upscale)
+        app.router.add_get("/sdapi/v1/progress", self.handle_progress)
+        app.router.add_post("/sdapi/v1/interrupt", self.handle_interrupt)
+        app.router.add_get("/sdapi/v1/options", self.handle_get_options)
+        app.router.add_post("/sdapi/v1/options", self.handle_set_options)
+        app.router.add_get("/sdapi/v1/sd-models", self.handle_models)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    @staticmethod
+    def _title(name: str) -> str:
+        return f"{name}.safetensors [0123456789]"
+
+    async def handle_root(self, request: web.Request) -> web.Response:
+        return web.Response(text="fake stable diffusion")
+
+    async def handle_txt2img(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.stats["requests"] += 1
+        async with self._gpu:
+            duration = self.random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+            if self.scale_by_work:
+                work = (payload.get("width", 512) * payload.get("height", 512) / 1_000_000
+                        * payload.get("num_inference_steps", 20))
+                if payload.get("init_images"):
+                    work *= payload.get("denoising_strength", 0.75)
+                duration *= work / REFERENCE_WORK
+            if self.cold_start:
+                # Первая генерация после запуска или смены модели: компиляция ядер CUDA
+                duration += self.cold_start
+                self.cold_start = 0.0
+            started = time.monotonic()
+            self._interrupted = False
+            self._current = (started, duration)
+            try:
+                while time.monotonic() - started < duration and not self._interrupted:
+                    await asyncio.sleep(STEP_INTERVAL)
+            finally:
+                self._current = None
+                self.stats["busy_seconds"] += time.monotonic() - started
+            if self._interrupted:
+                self.stats["interrupted"] += 1
+            elif self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return web.Response(status=500, text="CUDA out of memory (fake)")
+        count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        self.stats["images"] += count
+        return web.json_response({
+            "images": [self.image_b64] * count,
+            "parameters": payload,
+            "info": "{}",
+        })
+
+    async def handle_upscale(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        self.stats["upscales"] = self.stats.get("upscales", 0) + 1
+        async with self._gpu:
+            started = time.monotonic()
+            # Апскейлер работает гораздо быстрее диффузии
+            await asyncio.sleep(self.latency_median * 0.1 * payload.get("upscaling_resize", 2))
+            self.stats["busy_seconds"] += time.monotonic() - started
+        return web.json_response({"image": self.image_b64, "html_info": ""})
+
+    async def handle_progress(self, request: web.Request) -> web.Response:
+        if self._current is None:
+            return web.json_response({"progress": 0.0, "eta_relative": 0.0, "current_image": None})
+        started, duration = self._current
+        elapsed = time.monotonic() - started
+        return web.json_response({
+            "progress": min(1.0, elapsed / duration),
+            "eta_relative": max(0.0, duration - elapsed),
+            "current_image": None,
+        })
+
+    async def handle_interrupt(self, request: web.Request) -> web.Response:
+        self._interrupted = True
+        return web.json_response({})
+
+    async def handle_get_options(self, request: web.Request) -> web.Response:
+        return web.json_response({"sd_model_checkpoint": self.checkpoint})
+
+    async def handle_set_options(self, request: web.Request) -> web.Response:
+        options = await request.json()
+        checkpoint = options.get("sd_model_checkpoint")
+        if checkpoint and checkpoint != self.checkpoint:
+            if checkpoint not in [self._title(name) for name in CHECKPOINTS]:
+                return web.Response(status=500, text=f"Checkpoint {checkpoint} not found")
+            async with self._gpu:
+                await asyncio.sleep(self.checkpoint_load)
+                self.checkpoint = checkpoint
+            self.stats["checkpoint_loads"] = self.stats.get("checkpoint_loads", 0) + 1
+        return web.json_response(None)
+
+    async def handle_models(self, request: web.Request) -> web.Response:
+        return web.json_response([{"title": self._title(name), "model_name": name} for name in CHECKPOINTS])
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--latency-median", type=float, default=2.0, help="Медиана времени генерации, с")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Разброс (sigma логнормального распределения)")
+    parser.add_argument("--image-side", type=int, default=512, help="Сторона отдаваемого изображения, px")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля запросов с ошибкой 500")
+    parser.add_argument("--concurrency", type=int, default=1, help="Одновременных генераций")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--cold-start", type=float, default=0.0, help="Добавка к первой генерации, с")
+    parser.add_argument("--checkpoint-load", type=float, default=0.0, help="Время смены чекпойнта, с")
+    parser.add_argument("--scale-by-work", action="store_true",
+                        help="Время генерации пропорционально размеру и числу шагов")
+    args = parser.parse_args()
+
+    server = FakeSDServer(args.latency_median, args.latency_sigma, args.image_side, args.error_rate,
+                          args.concurrency, args.seed, args.scale_by_work, args.cold_start, args.checkpoint_load)
+    web.run_app(server.app(), host=args.host, port=args.port, access_log=None, print=None)
+
+
+if __name__ == "__main__":
+    main()
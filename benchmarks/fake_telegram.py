@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Локальная заглушка Telegram Bot API для нагрузочного тестирования.
+
+Отвечает на методы, которыми пользуется бот (sendMessage, sendPhoto,
+editMessageText и т.д.), правдоподобными объектами Message и записывает
+каждый вызов. Бот направляется сюда через build_application(base_url=...).
+"""
+
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadTestBot", "username": "load_test_bot"}
+
+# Методы, которые возвращают True вместо сообщения
+BOOLEAN_METHODS = {"deleteMessage", "answerCallbackQuery", "setWebhook", "deleteWebhook", "setMyCommands"}
+
+
+class FakeTelegramServer:
+    """Заглушка Bot API: /bot<token>/<method>.
+
+    on_call(method, params, result) вызывается для каждого запроса - по нему
+    генератор нагрузки понимает, что пользователь получил ответ.
+    latency добавляется к каждому ответу, upload_bytes_per_second
+    имитирует загрузку файлов.
+    """
+
+    def __init__(self, latency: float = 0.0, upload_bytes_per_second: float = 0.0,
+                 on_call: Optional[Callable[[str, Dict[str, str], object], None]] = None):
+        self.latency = latency
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.on_call = on_call
+        self.calls: List[tuple] = []
+        self.methods: Counter = Counter()
+        self.uploaded_bytes = 0
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.port: Optional[int] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self, port: int = 0) -> None:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params: Dict[str, str] = {}
+        upload = 0
+        if request.content_type == "application/json":
+            params = {key: str(value) for key, value in (await request.json()).items()}
+        else:
+            for key, value in (await request.post()).items():
+                if isinstance(value, web.FileField):
+                    upload += len(value.file.read())
+                else:
+                    params[key] = value
+        self.methods[method] += 1
+        self.uploaded_bytes += upload
+        self.calls.append((time.monotonic(), method, params.get("chat_id")))
+        delay = self.latency
+        if upload and self.upload_bytes_per_second:
+            delay += upload / self.upload_bytes_per_second
+        if delay:
+            await asyncio.sleep(delay)
+        result = self._result(method, params)
+        if self.on_call is not None:
+            self.on_call(method, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    def _result(self, method: str, params: Dict[str, str]):
+        if method == "getMe":
+            return BOT_USER
+        if method in BOOLEAN_METHODS:
+            return True
+        if method == "getUpdates":
+            return []
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if method in ("sendPhoto", "editMessageMedia"):
+            file_id = f"photo-{message['message_id']}"
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+        if method == "sendDocument":
+            file_id = f"document-{message['message_id']}"
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id}
+        return message
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Проверка перезапуска бота без простоя на локальных заглушках.
+
+Запускает настоящий bot.py на заглушках Telegram (в этом процессе) и
+Stable Diffusion (benchmarks/fake_sd.py), затем выполняет ту же передачу
+приёма обновлений, что и manage_bot.py restart (HandOver): новый экземпляр
+готовится в режиме standby, пока прежний работает, и начинает получать
+обновления после его остановки. Эндпоинт /metrics включён, поэтому
+проверяется и то, что оба экземпляра одновременно открывают один порт.
+Вывод процессов бота - в bot.log.
+
+Запуск:
+    python benchmarks/handover_check.py [--timeout 60]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_telegram import FakeTelegramServer  # noqa: E402
+from loadtest import free_port  # noqa: E402
+
+
+async def wait_for(condition, timeout: float, interval: float = 0.2) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+
+async def metrics_available(port: int) -> bool:
+    async with httpx.AsyncClient() as client:
+        try:
+            response = await client.get(f"http://127.0.0.1:{port}/metrics")
+        except httpx.HTTPError:
+            return False
+    return response.status_code == 200
+
+
+async def run(args) -> bool:
+    telegram = FakeTelegramServer(latency=0.05)
+    await telegram.start()
+    sd_port = free_port()
+    sd_process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCHMARKS_DIR, "fake_sd.py"), "--port", str(sd_port),
+        "--latency-median", "0.1")
+    metrics_port = free_port()
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:HANDOVER",
+        "TELEGRAM_API_URL": telegram.base_url,
+        "STABLE_DIFFUSION_API_URLS": f"http://127.0.0.1:{sd_port}",
+        "TRANSLATION_BACKEND": "none",
+        "METRICS_HOST": "127.0.0.1",
+        "METRICS_PORT": str(metrics_port),
+        "RUN_DIR": tempfile.mkdtemp(prefix="handover-"),
+        "BOT_ROLE": "standalone",
+    })
+    # manage_bot читает RUN_DIR из config при импорте
+    from manage_bot import HandOver, process_state, spawn
+    from lifecycle import STATE_RUNNING
+
+    processes = []
+    ok = False
+    try:
+        old_process = spawn("bot.py", env=os.environ)
+        processes.append(old_process)
+        if not await wait_for(lambda: process_state(old_process) == STATE_RUNNING, args.timeout):
+            print("Прежний экземпляр не запустился")
+            return False
+        if not await metrics_available(metrics_port):
+            print("Прежний экземпляр не отдаёт /metrics")
+            return False
+        started = time.monotonic()
+        new_process = spawn("bot.py", "--standby", env=os.environ)
+        processes.append(new_process)
+        handover = HandOver([old_process], new_process)
+        result = None
+        deadline = time.monotonic() + args.timeout
+        while result is None and time.monotonic() < deadline:
+            result = handover.step()
+            await asyncio.sleep(0.2)
+        if result is not True or process_state(new_process) != STATE_RUNNING:
+            print("Передача приёма обновлений не удалась")
+            return False
+        print(f"Новый экземпляр принимает обновления через {time.monotonic() - started:.1f} с")
+        if not await wait_for(lambda: process_state(old_process) is None, args.timeout):
+            print("Прежний экземпляр не завершился")
+            return False
+        if not await metrics_available(metrics_port):
+            print("Новый экземпляр не отдаёт /metrics")
+            return False
+        print("Прежний экземпляр завершился, /metrics отвечает")
+        ok = True
+        return True
+    finally:
+        for process in processes:
+            if process.is_running():
+                process.terminate()
+                try:
+                    process.wait(10)
+                except Exception:
+                    process.kill()
+        sd_process.terminate()
+        await sd_process.wait()
+        await telegram.stop()
+        print("Проверка пройдена" if ok else "Проверка не пройдена, подробности в bot.log")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Проверка перезапуска бота без простоя")
+    parser.add_argument("--timeout", type=float, default=60, help="Предельное время каждого этапа, с")
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
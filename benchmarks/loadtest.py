@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест бота на локальных заглушках Stable Diffusion и Telegram.
+
+Заглушки серверов Stable Diffusion запускаются отдельными процессами
+(benchmarks/fake_sd.py), заглушка Bot API - в этом процессе. Обновления от
+синтетических пользователей подаются в настоящие обработчики бота, а ответ
+считается полученным, когда заглушка Telegram принимает sendPhoto (или
+сообщение об ошибке) для чата пользователя. В отчёте - пропускная
+способность, перцентили задержки от сообщения до ответа и пиковый RSS
+процесса бота.
+
+С --draft бот отвечает черновиками, а доля --improve-rate пользователей
+нажимает под черновиком кнопку улучшения: так сравнивается время до первого
+изображения и время GPU на нужный пользователю результат в обоих режимах.
+
+Запуск:
+    python benchmarks/loadtest.py [--users 1000] [--rate 50] [--sd-servers 2] [--latency-median 2]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import socket
+import sys
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+import httpx
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from fake_telegram import FakeTelegramServer  # noqa: E402
+
+# Подписи к результатам улучшения черновика
+IMPROVED_PREFIXES = ("Увеличено", "Доработано")
+
+PROMPTS = ["a cat in a spacesuit", "кот в скафандре", "mountain lake at sunrise", "старый замок в тумане"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[index]
+
+
+def configure_environment(args, sd_urls: List[str]) -> None:
+    """Настраивает бота через переменные окружения до импорта bot.py."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:LOADTEST",
+        "STABLE_DIFFUSION_API_URLS": ",".join(sd_urls),
+        "TRANSLATION_BACKEND": args.translation_backend,
+        "SD_MAX_CONCURRENT_JOBS": str(args.sd_concurrency),
+        "SCHEDULER_MAX_QUEUE": str(args.max_queue),
+        "SCHEDULER_MAX_JOBS_PER_USER": str(max(5, args.requests_per_user)),
+        "JOB_DEADLINE": str(args.timeout),
+        "SD_TOTAL_TIMEOUT": str(args.timeout),
+        "SD_READ_TIMEOUT": str(args.timeout),
+        "HEALTH_CHECK_INTERVAL": "5",
+        "PROGRESS_POLL_INTERVAL": str(args.progress_interval),
+        "METRICS_PORT": "0",
+        "SCHEDULER_ORDERING": args.ordering,
+        "SD_CHECKPOINT": args.checkpoint,
+        "DRAFT_MODE_ENABLED": "true" if args.draft else "false",
+    })
+
+
+async def start_fake_sd(args, port: int) -> asyncio.subprocess.Process:
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCHMARKS_DIR, "fake_sd.py"), "--port", str(port),
+        "--latency-median", str(args.latency_median), "--latency-sigma", str(args.latency_sigma),
+        "--image-side", str(args.image_side), "--error-rate", str(args.error_rate),
+        "--concurrency", str(args.sd_concurrency), "--cold-start", str(args.cold_start),
+        "--checkpoint-load", str(args.checkpoint_load), *(["--scale-by-work"] if args.scale_by_work else []))
+    url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(url)
+                return process
+            except httpx.HTTPError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"Заглушка Stable Diffusion на порту {port} не запустилась")
+
+
+def make_user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+
+def make_callback_update(update_id: int, user_id: int, message: dict, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "message": message,
+            "data": data,
+        },
+    }
+
+
+def make_update(update_id: int, user_id: int, text: str) -> dict:
+    user = make_user(user_id)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def run(args) -> None:
+    sd_ports = [free_port() for _ in range(args.sd_servers)]
+    sd_urls = [f"http://127.0.0.1:{port}" for port in sd_ports]
+    sd_processes = [await start_fake_sd(args, port) for port in sd_ports]
+    configure_environment(args, sd_urls)
+    import bot
+
+    # Ответы бота, после которых пользователь больше ничего не ждёт: приходят
+    # новым сообщением или правкой сообщения о статусе запроса
+    failure_texts = {bot.CANCELLED_TEXT, bot.EXPIRED_TEXT, bot.SHUTDOWN_TEXT, bot.RESTARTING_TEXT,
+                     bot.QUEUE_FULL_TEXT, bot.GENERATION_FAILED_TEXT, bot.UNAVAILABLE_TEXT, bot.ERROR_TEXT}
+    improve_failure_texts = failure_texts | {bot.IMPROVE_CANCELLED_TEXT, bot.IMPROVE_FAILED_TEXT}
+    # Сообщения о статусе улучшений: их правки относятся к улучшению, а не к запросу
+    improve_messages = set()
+
+    pending: Dict[int, Deque[float]] = {}
+    latencies: List[float] = []
+    failures = 0
+    finished = asyncio.Event()
+    expected = args.users * args.requests_per_user
+    # Улучшения черновиков: время нажатия кнопки по идентификатору черновика
+    improving: Dict[str, float] = {}
+    improve_latencies: List[float] = []
+    improve_failures = 0
+    improve_requested = 0
+    update_ids = iter(range(10 ** 9, 2 * 10 ** 9))
+    chooser = random.Random(1)
+
+    def check_finished() -> None:
+        if len(latencies) + failures >= expected and len(improve_latencies) + improve_failures >= improve_requested:
+            finished.set()
+
+    def maybe_improve(chat_id: int, params: Dict[str, str], message: dict) -> None:
+        # Пользователь нажимает кнопку улучшения под частью черновиков
+        nonlocal improve_requested
+        markup = json.loads(params.get("reply_markup") or "{}")
+        actions = [button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row
+                   if button.get("callback_data", "").startswith(("upscale:", "refine:"))]
+        if not actions or chooser.random() >= args.improve_rate:
+            return
+        data = actions[0] if args.improve_action == "upscale" else actions[-1]
+        improve_requested += 1
+        improving[str(chat_id)] = time.monotonic()
+        update = Update.de_json(make_callback_update(next(update_ids), chat_id, message, data), application.bot)
+        application.update_queue.put_nowait(update)
+
+    def on_call(method: str, params: Dict[str, str], result) -> None:
+        nonlocal failures, improve_failures
+        chat_id = int(params.get("chat_id") or 0)
+        text = params.get("text", "")
+        if method == "sendMessage" and text == bot.IMPROVING_TEXT:
+            improve_messages.add(result["message_id"])
+            return
+        if method == "sendPhoto" and params.get("caption", "").startswith(IMPROVED_PREFIXES):
+            improve_latencies.append(time.monotonic() - improving.pop(str(chat_id), time.monotonic()))
+            check_finished()
+            return
+        if (method == "editMessageText" and text in improve_failure_texts
+                and int(params.get("message_id") or 0) in improve_messages):
+            improve_messages.discard(int(params["message_id"]))
+            improving.pop(str(chat_id), None)
+            improve_failures += 1
+            check_finished()
+            return
+        if method == "sendPhoto":
+            ok = True
+        elif method in ("sendMessage", "editMessageText") and text in failure_texts:
+            ok = False
+        else:
+            return
+        queue = pending.get(chat_id)
+        if not queue:
+            return
+        started = queue.popleft()
+        if ok:
+            latencies.append(time.monotonic() - started)
+            if args.draft:
+                maybe_improve(chat_id, params, result)
+        else:
+            failures += 1
+        check_finished()
+
+    telegram = FakeTelegramServer(latency=args.telegram_latency,
+                                  upload_bytes_per_second=args.upload_mbps * 1024 * 1024 / 8,
+                                  on_call=on_call)
+    await telegram.start()
+
+    from metrics import PREDICTION_RATIO
+    from telegram import Update
+    logging.getLogger().setLevel(args.log_level)
+
+    application = bot.build_application(base_url=telegram.base_url)
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    # Даём фоновой проверке отметить серверы доступными и ждём окончания прогрева
+    await bot.health_checker.check_all()
+    while any(backend.warming for backend in bot.backend_pool.backends):
+        await asyncio.sleep(0.1)
+    for backend in bot.backend_pool.backends:
+        warmup = (f"{backend.warmup_seconds:.1f} с" if backend.warmup_seconds is not None
+                  else backend.warmup_error or "выключен")
+        print(f"Прогрев {backend.url}: {warmup}")
+
+    print(f"Пользователей: {args.users}, запросов: {expected}, серверов SD: {args.sd_servers} "
+          f"x {args.sd_concurrency}, медиана генерации {args.latency_median} с")
+    started = time.monotonic()
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+    update_id = 0
+    try:
+        for round_index in range(args.requests_per_user):
+            for user_index in range(args.users):
+                user_id = 1000 + user_index
+                update_id += 1
+                text = PROMPTS[update_id % len(PROMPTS)]
+                if args.unique_prompts:
+                    text = f"{text} #{update_id}"
+                update = Update.de_json(make_update(update_id, user_id, text), application.bot)
+                pending.setdefault(user_id, deque()).append(time.monotonic())
+                await application.update_queue.put(update)
+                if interval:
+                    await asyncio.sleep(interval)
+        try:
+            await asyncio.wait_for(finished.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print("Не все запросы завершились за отведённое время")
+        elapsed = time.monotonic() - started
+    finally:
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        await telegram.stop()
+        sd_stats = []
+        async with httpx.AsyncClient() as client:
+            for url in sd_urls:
+                try:
+                    sd_stats.append((await client.get(f"{url}/stats")).json())
+                except httpx.HTTPError:
+                    pass
+        for process in sd_processes:
+            process.terminate()
+            await process.wait()
+
+    completed = len(latencies)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Успешно: {completed}, ошибок: {failures}, без ответа: {expected - completed - failures}")
+    print(f"Время: {elapsed:.1f} с, пропускная способность: {completed / elapsed:.2f} изображений/с")
+    print(f"Задержка p50: {percentile(latencies, 0.5):.2f} с, p95: {percentile(latencies, 0.95):.2f} с, "
+          f"p99: {percentile(latencies, 0.99):.2f} с, максимум: {max(latencies, default=0):.2f} с")
+    print(f"Пиковый RSS процесса бота: {peak_rss_mb:.1f} МБ")
+    print(f"Модель стоимости, с на мегапиксель-шаг: "
+          f"{ {url: round(rate, 4) for (url, _), rate in bot.cost_model.rates().items()} }")
+    for labels in PREDICTION_RATIO.label_sets():
+        summary = PREDICTION_RATIO.summary(**labels)
+        print(f"Факт/прогноз времени генерации {labels['backend']}: p50 {summary['p50']:.2f}, p95 {summary['p95']:.2f}")
+    print(f"Задач с пониженным качеством по уровням: {bot.quality_policy.degraded_jobs[1:]}, "
+          f"итоговый уровень {bot.quality_policy.level}")
+    print(f"Вызовы Bot API: {dict(telegram.methods)}, загружено {telegram.uploaded_bytes / 1024 / 1024:.1f} МБ")
+    for url, stats in zip(sd_urls, sd_stats):
+        print(f"Stable Diffusion {url}: {stats}")
+    # Нужный пользователю результат: в режиме черновиков - улучшенный черновик, иначе - каждое изображение
+    satisfied = len(improve_latencies) if args.draft else completed
+    gpu_seconds = sum(stats["busy_seconds"] for stats in sd_stats)
+    if args.draft:
+        print(f"Улучшений: {len(improve_latencies)} из {improve_requested}, ошибок: {improve_failures}, "
+              f"p50: {percentile(improve_latencies, 0.5):.2f} с, p95: {percentile(improve_latencies, 0.95):.2f} с")
+    if satisfied:
+        print(f"Время GPU на нужный результат: {gpu_seconds / satisfied:.2f} с ({satisfied} результатов)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200, help="Число синтетических пользователей")
+    parser.add_argument("--requests-per-user", type=int, default=1, help="Запросов от каждого пользователя")
+    parser.add_argument("--rate", type=float, default=50, help="Запросов в секунду (0 - все сразу)")
+    parser.add_argument("--unique-prompts", action="store_true", help="Не повторять запросы (без попаданий в кеши)")
+    parser.add_argument("--sd-servers", type=int, default=2, help="Число заглушек Stable Diffusion")
+    parser.add_argument("--sd-concurrency", type=int, default=1, help="Одновременных генераций на сервер")
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Медиана времени генерации, с")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Разброс времени генерации")
+    parser.add_argument("--image-side", type=int, default=512, help="Сторона изображения, px")
+    parser.add_argument("--scale-by-work", action="store_true",
+                        help="Время генерации заглушки пропорционально размеру и шагам запроса")
+    parser.add_argument("--cold-start", type=float, default=0.0, help="Добавка к первой генерации заглушки, с")
+    parser.add_argument("--checkpoint", default="", help="Чекпойнт, который бот загрузит при прогреве")
+    parser.add_argument("--checkpoint-load", type=float, default=0.0, help="Время смены чекпойнта заглушкой, с")
+    parser.add_argument("--draft", action="store_true", help="Режим черновиков с улучшением по кнопке")
+    parser.add_argument("--improve-rate", type=float, default=0.2, help="Доля черновиков, которые улучшают")
+    parser.add_argument("--improve-action", default="refine", choices=["refine", "upscale"],
+                        help="Какую кнопку нажимают под черновиком")
+    parser.add_argument("--ordering", default="fair", help="Порядок очереди: fair, sjf или wfq")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ошибок Stable Diffusion")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка ответа Bot API, с")
+    parser.add_argument("--upload-mbps", type=float, default=0.0, help="Скорость загрузки файлов, Мбит/с (0 - без ограничения)")
+    parser.add_argument("--progress-interval", type=float, default=1.5, help="Период опроса прогресса, с")
+    parser.add_argument("--translation-backend", default="none", help="Сервис перевода бота")
+    parser.add_argument("--max-queue", type=int, default=100000, help="Размер очереди планировщика")
+    parser.add_argument("--timeout", type=float, default=600, help="Предельное время теста, с")
+    parser.add_argument("--log-level", default="WARNING", help="Уровень журнала бота во время теста")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,184 @@
+import asyncio
 import logging
 import os
-import requests
-import io
-import sys
+import argparse
 import json
-import signal
+import secrets
 import time
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from typing import List, Optional
+from telegram import Update, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import (Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters,
+                          ContextTypes)
 import telegram.error
-from deep_translator import GoogleTranslator
-from config import (TELEGRAM_TOKEN, STABLE_DIFFUSION_API_URL, DEFAULT_SD_SETTINGS, 
+from clients import http_pool, SDClient, SDAPIError, SDTimeoutError, GoogleTranslateClient
+from translation import Translator, DiskTranslationCache, create_backend
+from result_cache import ResultCache, DiskImageCache, payload_key, is_cacheable
+from progress import ProgressMonitor, EditThrottle
+from transcoding import ImageTranscoder, OriginalsStore
+from webhook import WebhookServer, serve_webhook
+from lifecycle import InstanceState, Lifecycle, serve_polling
+from metrics import (REGISTRY, STAGE_SECONDS, RENDER_SECONDS, JOBS_TOTAL, REQUESTS_TOTAL, PREDICTION_RATIO,
+                     GPU_SECONDS, SATISFIED_TOTAL, MetricsServer,
+                     install_trace_logging, trace_id)
+from jobqueue import QueuedJob, SharedSettings, create_job_store, STATUS_QUEUED
+from scheduler import GenerationScheduler, GenerationJob, QueueFullError, JobCancelledError, new_job_id
+from batching import batch_key, build_batch_payload, split_batch_results
+from backends import Backend, BackendPool
+from health import HealthChecker
+from warmup import BackendWarmer
+from drafts import (Draft, DraftStore, ACTION_REFINE, ACTION_UPSCALE, with_fixed_seed, refine_payload,
+                    upscale_payload)
+from quality import QualityLevel, QualityPolicy, parse_levels
+from cost import CostModel, payload_work
+from config import (TELEGRAM_TOKEN, TELEGRAM_API_URL, STABLE_DIFFUSION_API_URLS, DEFAULT_SD_SETTINGS, 
                     ADMIN_IDS, CONTENT_FILTER_ENABLED, ADULT_CONTENT_NEGATIVE_PROMPT,
-                    DEFAULT_NEGATIVE_PROMPT)
+                    DEFAULT_NEGATIVE_PROMPT, SCHEDULER_MAX_QUEUE, SCHEDULER_MAX_JOBS_PER_USER,
+                    SD_MAX_CONCURRENT_JOBS, SCHEDULER_INITIAL_JOB_ESTIMATE,
+                    QUEUE_POSITION_UPDATE_INTERVAL, JOB_DEADLINE, SD_BATCHING_ENABLED, SD_MAX_BATCH_SIZE,
+                    SD_BATCH_WINDOW, SD_BATCH_PROMPT_LIST, SD_MAX_RETRIES, HEALTH_CHECK_INTERVAL,
+                    HEALTH_DEGRADED_LATENCY, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+                    TRANSLATION_BACKEND, TRANSLATION_CACHE_SIZE, TRANSLATION_DISK_CACHE,
+                    TRANSLATION_DISK_CACHE_MAX_ENTRIES, TRANSLATION_BATCH_WINDOW, TRANSLATION_MAX_BATCH,
+                    SD_SEED, RESULT_CACHE_SIZE, RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES,
+                    PROGRESS_POLL_INTERVAL, PROGRESS_PREVIEW_ENABLED, PROGRESS_EDIT_MIN_INTERVAL,
+                    PROGRESS_EDIT_MAX_INTERVAL, TELEGRAM_EDITS_PER_SECOND, IMAGE_FORMAT, IMAGE_QUALITY,
+                    IMAGE_MAX_SIDE, TRANSCODE_WORKERS, ORIGINALS_CACHE_MAX_BYTES, BOT_MODE, WEBHOOK_URL,
+                    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS,
+                    BOT_ROLE, JOB_STORE_BACKEND, JOB_STORE_PATH, SETTINGS_REFRESH_INTERVAL, METRICS_HOST,
+                    METRICS_PORT, QUALITY_ADAPTIVE_ENABLED, QUALITY_LEVELS, QUALITY_QUEUE_THRESHOLD,
+                    QUALITY_LATENCY_SLO, QUALITY_RECOVERY_RATIO, QUALITY_ADJUST_INTERVAL,
+                    QUALITY_LATENCY_WINDOW, SCHEDULER_ORDERING, SCHEDULER_SJF_AGING, COST_MODEL_ALPHA,
+                    SD_WARMUP_ENABLED, SD_CHECKPOINT, SD_WARMUP_TIMEOUT, DRAFT_MODE_ENABLED, DRAFT_LEVEL,
+                    DRAFT_CACHE_SIZE, REFINE_DENOISING_STRENGTH, SD_UPSCALER, UPSCALE_FACTOR, DRAIN_TIMEOUT,
+                    RUN_DIR)
 
-# Глобальная переменная для текущего URL Stable Diffusion
-current_sd_server_url = STABLE_DIFFUSION_API_URL
+# Пул серверов Stable Diffusion
+backend_pool = BackendPool(STABLE_DIFFUSION_API_URLS, max_concurrent=SD_MAX_CONCURRENT_JOBS,
+                           failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT)
 
-# Настройка логирования
+# Настройка логирования: в каждой строке - идентификатор задачи, к которой она относится
+install_trace_logging()
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(trace_id)s] %(message)s',
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-# Настройка обработчика сигналов для корректного завершения
-def signal_handler(sig, frame):
-    logger.info(f"Получен сигнал {sig}, завершение работы...")
-    sys.exit(0)
+# Асинхронные клиенты поверх общего пула соединений
+sd_client = SDClient(http_pool)
+translator = Translator(
+    create_backend(TRANSLATION_BACKEND, GoogleTranslateClient(http_pool, source='ru', target='en')),
+    cache_size=TRANSLATION_CACHE_SIZE,
+    disk_cache=(DiskTranslationCache(TRANSLATION_DISK_CACHE, TRANSLATION_DISK_CACHE_MAX_ENTRIES)
+                if TRANSLATION_DISK_CACHE else None),
+    batch_window=TRANSLATION_BATCH_WINDOW,
+    max_batch=TRANSLATION_MAX_BATCH,
+)
+
+# Кеш результатов генерации (file_id Telegram и, при настройке, изображения на диске)
+result_cache = ResultCache(
+    RESULT_CACHE_SIZE,
+    disk_cache=DiskImageCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES) if RESULT_CACHE_DIR else None,
+)
+
+# Общий опрос прогресса генерации и ограничение частоты правок сообщений
+progress_monitor = ProgressMonitor(sd_client, interval=PROGRESS_POLL_INTERVAL,
+                                   with_preview=PROGRESS_PREVIEW_ENABLED)
+edit_throttle = EditThrottle(PROGRESS_EDIT_MIN_INTERVAL, PROGRESS_EDIT_MAX_INTERVAL,
+                             TELEGRAM_EDITS_PER_SECOND)
+
+# Сжатие изображений перед отправкой и оригиналы для отправки файлом
+transcoder = ImageTranscoder(IMAGE_FORMAT, IMAGE_QUALITY, IMAGE_MAX_SIDE, TRANSCODE_WORKERS)
+originals = OriginalsStore(ORIGINALS_CACHE_MAX_BYTES)
+
+# Двухэтапная генерация: сначала дешёвый черновик, полное качество - по кнопке.
+# Во фронтенде не используется: улучшение выполняется в процессе, где хранится черновик
+draft_mode = DRAFT_MODE_ENABLED and BOT_ROLE != "frontend"
+draft_level = parse_levels(DRAFT_LEVEL)[0]
+drafts = DraftStore(DRAFT_CACHE_SIZE)
+
+# Прогрев серверов перед приёмом задач (во фронтенде генерацией занимаются воркеры)
+backend_warmer = BackendWarmer(backend_pool, sd_client, checkpoint=SD_CHECKPOINT, timeout=SD_WARMUP_TIMEOUT,
+                               enabled=SD_WARMUP_ENABLED and BOT_ROLE != "frontend")
+
+# Фоновая проверка доступности серверов; вернувшийся после сбоя сервер прогревается заново
+health_checker = HealthChecker(backend_pool, sd_client, interval=HEALTH_CHECK_INTERVAL,
+                               degraded_latency=HEALTH_DEGRADED_LATENCY, on_recovered=backend_warmer.schedule)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+# Качество генерации: полное по DEFAULT_SD_SETTINGS, под нагрузкой - упрощённые уровни
+quality_policy = QualityPolicy(
+    [QualityLevel(DEFAULT_SD_SETTINGS["width"], DEFAULT_SD_SETTINGS["height"],
+                  DEFAULT_SD_SETTINGS["num_inference_steps"])] + parse_levels(QUALITY_LEVELS),
+    queue_threshold=QUALITY_QUEUE_THRESHOLD,
+    # Во фронтенде задачи завершают воркеры, поэтому уровень зависит только от очереди
+    latency_slo=QUALITY_LATENCY_SLO if BOT_ROLE != "frontend" else 0,
+    recovery_ratio=QUALITY_RECOVERY_RATIO,
+    adjust_interval=QUALITY_ADJUST_INTERVAL,
+    latency_window=QUALITY_LATENCY_WINDOW,
+    enabled=QUALITY_ADAPTIVE_ENABLED,
+)
+
+# Ответы пользователю об итогах задачи - общие для бота и воркеров
+CANCELLED_TEXT = "❌ Генерация отменена."
+EXPIRED_TEXT = "⌛ Время ожидания истекло, запрос отменён."
+SHUTDOWN_TEXT = "🔄 Бот перезапускается, запрос не выполнен. Пожалуйста, отправьте его ещё раз через минуту."
+RESTARTING_TEXT = "🔄 Бот перезапускается. Пожалуйста, отправьте запрос ещё раз через минуту."
+QUEUE_FULL_TEXT = "Извините, сейчас слишком много запросов. Пожалуйста, попробуйте чуть позже."
+GENERATION_FAILED_TEXT = "Извините, не удалось сгенерировать изображение. Пожалуйста, попробуйте другой запрос."
+UNAVAILABLE_TEXT = "Извините, API Stable Diffusion в данный момент недоступен. Пожалуйста, попробуйте позже."
+ERROR_TEXT = "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+IMPROVING_TEXT = "⏳ Улучшаю изображение..."
+IMPROVE_CANCELLED_TEXT = "❌ Улучшение отменено."
+IMPROVE_FAILED_TEXT = "Извините, не удалось улучшить изображение. Пожалуйста, попробуйте ещё раз."
+
+# Типы обновлений, которые обрабатывает бот: остальные Telegram не присылает
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Глобальная переменная для хранения состояния фильтрации
 content_filter_state = CONTENT_FILTER_ENABLED
 
+def apply_shared_setting(key: str, value) -> None:
+    """Применяет общую настройку, изменённую другим процессом бота."""
+    global content_filter_state
+    if key == "content_filter":
+        content_filter_state = bool(value)
+        logger.info(f"Фильтрация контента для взрослых: {'Включена' if content_filter_state else 'Выключена'}")
+    elif key == "sd_servers":
+        backend_pool.replace(value)
+        backend_warmer.schedule_pending()
+        logger.info(f"Серверы Stable Diffusion: {', '.join(value) or 'не заданы'}")
+
+# В режиме фронтенда генерацию выполняют процессы worker.py: задачи и
+# настройки передаются через общее хранилище
+job_store = create_job_store(JOB_STORE_BACKEND, JOB_STORE_PATH) if BOT_ROLE == "frontend" else None
+shared_settings = (SharedSettings(job_store, SETTINGS_REFRESH_INTERVAL, apply_shared_setting)
+                   if job_store is not None else None)
+
+async def publish_setting(key: str, value) -> None:
+    """Сохраняет настройку в общем хранилище, если бот работает с воркерами."""
+    if shared_settings is not None:
+        await shared_settings.set(key, value)
+
 def is_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором."""
     return user_id in ADMIN_IDS
 
+async def warm_up_backend(update: Update, url: str) -> None:
+    """Прогревает сервер после смены или добавления и сообщает администратору результат."""
+    backend = backend_pool.get(url)
+    task = backend_warmer.schedule(backend) if backend is not None else None
+    if task is None:
+        return
+    await update.message.reply_text(f"⏳ Сервер {backend.url} прогревается, задачи на него пока не направляются...")
+    await asyncio.shield(task)
+    if backend.warmup_error:
+        await update.message.reply_text(f"Не удалось прогреть сервер {backend.url}: {backend.warmup_error}")
+    else:
+        await update.message.reply_text(f"Сервер {backend.url} прогрет за {backend.warmup_seconds:.1f} с "
+                                        f"и принимает задачи.")
+
 async def set_sd_server(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Позволяет администратору изменить адрес сервера Stable Diffusion."""
+    """Позволяет администратору заменить все серверы Stable Diffusion одним адресом."""
     user_id = update.effective_user.id
     if not is_admin(user_id):
         await update.message.reply_text("У вас нет прав для выполнения этой команды.")
@@ -49,14 +187,148 @@ async def set_sd_server(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text("Использование: /set_sd_server <url>")
         return
     new_url = context.args[0]
-    global current_sd_server_url
-    current_sd_server_url = new_url
+    backend_pool.replace([new_url])
+    await publish_setting("sd_servers", [backend.url for backend in backend_pool.backends])
     await update.message.reply_text(f"Адрес Stable Diffusion API изменён на: {new_url}")
+    await warm_up_backend(update, new_url)
 
 async def get_sd_server(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показывает текущий адрес сервера Stable Diffusion."""
-    global current_sd_server_url
-    await update.message.reply_text(f"Текущий адрес Stable Diffusion API: {current_sd_server_url}")
+    """Показывает текущие адреса серверов Stable Diffusion."""
+    urls = ', '.join(backend.url for backend in backend_pool.backends) or 'не задан'
+    await update.message.reply_text(f"Текущий адрес Stable Diffusion API: {urls}")
+
+def format_backend(backend: Backend) -> str:
+    """Формирует строку с состоянием сервера для команды /backends."""
+    latency = f"{backend.latency:.1f} с" if backend.latency is not None else "нет данных"
+    probe = f"{backend.probe_latency * 1000:.0f} мс" if backend.probe_latency is not None else "нет данных"
+    state = f"{backend.state}, drain" if backend.draining else backend.state
+    if backend.warming:
+        warmup = "идёт"
+    elif backend.warmup_error:
+        warmup = f"ошибка ({backend.warmup_error})"
+    elif backend.warmup_seconds is not None:
+        warmup = f"{backend.warmup_seconds:.1f} с"
+    else:
+        warmup = "не выполнялся"
+    return (f"{backend.url}\n"
+            f"  состояние: {state}, автомат: {backend.breaker.state}, "
+            f"задач: {backend.outstanding}/{backend.max_concurrent}\n"
+            f"  задержка генерации: {latency}, проверки: {probe}, прогрев: {warmup}, "
+            f"выполнено: {backend.completed}, ошибок: {backend.failed}")
+
+async def list_backends(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору состояние всех серверов пула."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+    if not backend_pool.backends:
+        await update.message.reply_text("В пуле нет серверов Stable Diffusion.")
+        return
+    if job_store is not None:
+        counts = await asyncio.to_thread(job_store.counts)
+        await update.message.reply_text(
+            '\n'.join(backend.url for backend in backend_pool.backends) +
+            f"\n\nОбщая очередь: {counts.get('queued', 0)}, выполняется: {counts.get('running', 0)} "
+            f"на {counts['workers']} воркерах\n"
+            f"Выполнено: {counts.get('done', 0)}, ошибок: {counts.get('failed', 0)}, "
+            f"отменено: {counts.get('cancelled', 0)}"
+        )
+        return
+    await update.message.reply_text(
+        '\n'.join(format_backend(b) for b in backend_pool.backends) +
+        f"\n\nОчередь: {scheduler.queued}, выполняется: {scheduler.in_flight}\n"
+        f"Отменено в очереди: {scheduler.cancelled_queued}, во время генерации: {scheduler.cancelled_running}, "
+        f"по сроку: {scheduler.expired}\n"
+        f"Потеряно времени GPU: {scheduler.wasted_gpu_seconds:.0f} с"
+    )
+
+async def manage_backend(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Добавляет, удаляет или переводит в режим drain сервер пула."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+    command = update.message.text.split()[0].lstrip('/').split('@')[0]
+    if not context.args or len(context.args) != 1:
+        await update.message.reply_text(f"Использование: /{command} <url>")
+        return
+    url = context.args[0]
+    if command == "add_backend":
+        backend_pool.add(url)
+        await publish_setting("sd_servers", [backend.url for backend in backend_pool.backends])
+        await update.message.reply_text(f"Сервер {url} добавлен в пул.")
+        await warm_up_backend(update, url)
+        return
+    if command == "remove_backend":
+        found = backend_pool.remove(url)
+        await publish_setting("sd_servers", [backend.url for backend in backend_pool.backends])
+        done = "удалён из пула"
+    elif command == "drain_backend":
+        found = backend_pool.drain(url, True)
+        done = "больше не получает новых задач"
+    else:
+        found = backend_pool.drain(url, False)
+        done = "снова получает задачи"
+    await update.message.reply_text(f"Сервер {url} {done}." if found else f"Сервер {url} не найден в пуле.")
+
+async def cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору статистику кешей, перекодирования и загрузки изображений."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+    stats = result_cache.stats()
+    translations = translator.hits + translator.misses
+    translation_rate = translator.hits / translations if translations else 0.0
+    images = transcoder.stats()
+    text = (f"Кеш результатов: {stats['hit_rate']:.0%} попаданий из {stats['lookups']} запросов\n"
+            f"  по file_id: {stats['file_id_hits']}, с диска: {stats['disk_hits']}, промахов: {stats['misses']}\n"
+            f"  записей file_id: {stats['file_ids']}, на диске: {stats['disk_entries']} "
+            f"({stats['disk_bytes'] / 1024 / 1024:.1f} МБ)\n"
+            f"Кеш переводов: {translation_rate:.0%} попаданий из {translations} запросов\n"
+            f"Перекодирование ({transcoder.image_format}): {images['images']} изображений, "
+            f"ошибок: {images['failures']}\n"
+            f"  средний размер: {images['avg_bytes_in'] / 1024:.0f} КБ -> {images['avg_bytes_out'] / 1024:.0f} КБ "
+            f"({images['ratio']:.0%}), сжатие {images['avg_transcode_seconds'] * 1000:.0f} мс")
+    for kind, title in (("photo", "фото"), ("document", "файлы")):
+        if images.get(f"{kind}_uploads"):
+            text += (f"\n  загрузка ({title}): {images[f'{kind}_uploads']} шт., "
+                     f"{images[f'{kind}_avg_bytes'] / 1024:.0f} КБ за {images[f'{kind}_avg_seconds']:.2f} с")
+    text += f"\nОригиналов в памяти: {len(originals)} ({originals.total_bytes / 1024 / 1024:.1f} МБ)"
+    await update.message.reply_text(text)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает администратору длительность этапов и итоги задач."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("У вас нет прав для выполнения этой команды.")
+        return
+    lines = ["Этапы (число, среднее / p50 / p95, с):"]
+    for labels in STAGE_SECONDS.label_sets():
+        summary = STAGE_SECONDS.summary(**labels)
+        lines.append(f"  {labels['stage']}: {summary['count']}, "
+                     f"{summary['avg']:.2f} / {summary['p50']:.2f} / {summary['p95']:.2f}")
+    if len(lines) == 1:
+        lines.append("  нет данных")
+    jobs = ', '.join(f"{key[0]}: {int(value)}" for key, value in JOBS_TOTAL.values.items()) or "нет"
+    requests_by_result = ', '.join(f"{key[0]}: {int(value)}" for key, value in REQUESTS_TOTAL.values.items()) or "нет"
+    lines.append(f"Задачи: {jobs}")
+    lines.append(f"Запросы: {requests_by_result}")
+    for labels in PREDICTION_RATIO.label_sets():
+        summary = PREDICTION_RATIO.summary(**labels)
+        lines.append(f"Точность ETA {labels['backend']}: факт/прогноз p50 {summary['p50']:.2f}, "
+                     f"p95 {summary['p95']:.2f} ({summary['count']} задач)")
+    first_image = STAGE_SECONDS.summary(stage="end_to_end")
+    if first_image:
+        lines.append(f"До первого изображения: p50 {first_image['p50']:.1f} с, p95 {first_image['p95']:.1f} с"
+                     f"{' (черновики)' if draft_mode else ''}")
+    gpu_seconds = sum(GPU_SECONDS.values.values())
+    satisfied = SATISFIED_TOTAL.get()
+    if satisfied:
+        lines.append(f"Время GPU на нужный пользователю результат: {gpu_seconds / satisfied:.1f} с "
+                     f"({int(satisfied)} результатов)")
+    p95 = quality_policy.latency_p95()
+    lines.append(f"Качество: уровень {quality_policy.level} ({quality_policy.current.describe()}), "
+                 f"p95 последних задач: {f'{p95:.1f} с' if p95 is not None else 'нет данных'} "
+                 f"при цели {quality_policy.latency_slo:.0f} с")
+    await update.message.reply_text('\n'.join(lines))
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет приветственное сообщение при команде /start."""
@@ -67,7 +339,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                'Просто отправь мне описание того, что ты хочешь увидеть на картинке, '
                'и я сгенерирую его для тебя!\n\n'
                'Доступные команды:\n'
-               '/help - Получить справку по использованию бота')
+               '/help - Получить справку по использованию бота\n'
+               '/cancel - Отменить свои запросы')
     
     # Дополнительная информация для администраторов
     if is_admin(user_id):
@@ -76,7 +349,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                      '/enable_filter - Включить фильтрацию контента для взрослых\n'
                      '/disable_filter - Выключить фильтрацию контента для взрослых\n'
                      '/set_sd_server <url> - Изменить адрес Stable Diffusion API\n'
-                     '/get_sd_server - Показать текущий адрес Stable Diffusion API')
+                     '/get_sd_server - Показать текущий адрес Stable Diffusion API\n'
+                     '/backends - Показать состояние серверов Stable Diffusion\n'
+                     '/add_backend <url> - Добавить сервер в пул\n'
+                     '/remove_backend <url> - Удалить сервер из пула\n'
+                     '/drain_backend <url> - Перестать отправлять задачи на сервер\n'
+                     '/undrain_backend <url> - Вернуть сервер в работу\n'
+                     '/cache_stats - Статистика кеша, перекодирования и загрузки изображений\n'
+                     '/stats - Длительность этапов обработки и итоги задач')
         message += admin_info
     
     await update.message.reply_text(message)
@@ -106,6 +386,7 @@ async def enable_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     content_filter_state = True
+    await publish_setting("content_filter", True)
     await update.message.reply_text("Фильтрация контента для взрослых включена.")
     logger.info("Фильтрация контента для взрослых включена")
 
@@ -120,168 +401,533 @@ async def disable_filter(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     content_filter_state = False
+    await publish_setting("content_filter", False)
     await update.message.reply_text("Фильтрация контента для взрослых выключена.")
     logger.info("Фильтрация контента для взрослых выключена")
 
-def is_russian(text: str) -> bool:
-    """Проверяет, содержит ли текст русские символы."""
-    return any(ord('а') <= ord(c) <= ord('я') or ord('А') <= ord(c) <= ord('Я') for c in text)
+def build_payload(prompt: str, level: Optional[QualityLevel] = None) -> dict:
+    """Формирует параметры запроса к API Stable Diffusion.
 
-def translate_to_english(text: str) -> str:
-    """Переводит текст с русского на английский."""
-    try:
-        translation = GoogleTranslator(source='ru', target='en').translate(text)
-        return translation
-    except Exception as e:
-        logger.error(f"Ошибка при переводе: {e}")
-        return text
+    Размер и число шагов берутся из level (например, для черновика), а по
+    умолчанию - из текущего уровня качества quality_policy.
+    """
+    # Подготовка параметров запроса для локального API Stable Diffusion
+    payload = {
+        "prompt": prompt,
+        "width": DEFAULT_SD_SETTINGS["width"],
+        "height": DEFAULT_SD_SETTINGS["height"],
+        "num_outputs": 1,
+        "num_inference_steps": DEFAULT_SD_SETTINGS["num_inference_steps"],
+        "guidance_scale": DEFAULT_SD_SETTINGS["guidance_scale"],
+        "scheduler": "DPMSolverMultistep",  # Стандартный планировщик
+        "seed": SD_SEED,
+    }
+    payload = level.apply(payload) if level is not None else quality_policy.apply(payload)
+    
+    # Применяем фильтрацию контента для взрослых, если она включена
+    if content_filter_state:
+        payload["negative_prompt"] = ADULT_CONTENT_NEGATIVE_PROMPT
+        logger.info("Фильтрация контента для взрослых активна")
+    else:
+        payload["negative_prompt"] = DEFAULT_NEGATIVE_PROMPT
+        logger.info("Фильтрация контента для взрослых отключена, используется базовый negative prompt")
+    return payload
 
-def check_api_availability() -> bool:
-    """Проверяет доступность API Stable Diffusion."""
-    try:
-        # Проверяем доступность API с помощью простого запроса
-        # Используем базовый URL без дополнительных путей
-        base_url = current_sd_server_url.split('://')[0] + '://' + current_sd_server_url.split('://')[1].split('/')[0]
-        # Игнорируем проверку SSL-сертификатов
-        response = requests.get(base_url, timeout=10, verify=False)
-        return response.status_code < 400  # Любой ответ, кроме ошибки, считаем успешным
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при проверке доступности API: {e}")
-        return False
-
-def generate_image(prompt: str) -> bytes:
-    """Генерирует изображение с помощью локального Stable Diffusion API."""
+async def generate_images(jobs: List[GenerationJob], backend: Backend) -> List[bytes]:
+    """Генерирует изображения для пакета задач одним запросом к Stable Diffusion API.
+
+    Задачи img2img и upscale (доработка и увеличение черновиков) всегда
+    приходят по одной. Ошибки API пробрасываются как SDAPIError, чтобы
+    планировщик мог повторить задачу на другом сервере.
+    """
+    payloads = [job.payload for job in jobs]
+    operation = jobs[0].operation
+    payload = (build_batch_payload(payloads, prompt_list=SD_BATCH_PROMPT_LIST) if operation == "txt2img"
+               else payloads[0])
+    logger.info(f"Отправка запроса к Stable Diffusion API {backend.url} ({len(jobs)} задач): {jobs[0].prompt[:50]}...")
+    
+    for job in jobs:
+        if job.on_progress:
+            progress_monitor.subscribe(backend.url, job.job_id, job.on_progress)
+    started = time.monotonic()
     try:
-        # Подготовка параметров запроса для локального API Stable Diffusion
-        payload = {
-            "prompt": prompt,
-            "width": 512,
-            "height": 512,
-            "num_outputs": 1,
-            "num_inference_steps": 20,
-            "guidance_scale": 7.5,
-            "scheduler": "DPMSolverMultistep",  # Стандартный планировщик
-        }
-        
-        # Применяем фильтрацию контента для взрослых, если она включена
-        if content_filter_state:
-            payload["negative_prompt"] = ADULT_CONTENT_NEGATIVE_PROMPT
-            logger.info("Фильтрация контента для взрослых активна")
+        if operation == "upscale":
+            images = [await sd_client.upscale(backend.url, payload)]
+        elif operation == "img2img":
+            images = await sd_client.img2img(backend.url, payload)
         else:
-            payload["negative_prompt"] = DEFAULT_NEGATIVE_PROMPT
-            logger.info("Фильтрация контента для взрослых отключена, используется базовый negative prompt")
-        
-        logger.info(f"Отправка запроса к Stable Diffusion API: {prompt[:50]}...")
-        
-        # Используем API endpoint из конфигурации
-        api_endpoint = f"{current_sd_server_url}/sdapi/v1/txt2img"
-        
-        # Отправка запроса к API с таймаутом, игнорируя SSL-сертификаты
-        response = requests.post(api_endpoint, json=payload, timeout=180, verify=False)
-        
-        # Проверка статуса ответа
-        if response.status_code != 200:
-            logger.error(f"Ошибка API Stable Diffusion: {response.status_code} - {response.text}")
-            return None
-        
-        # Получение и декодирование изображения
-        result = response.json()
-        logger.info("Ответ от API получен")
-        
-        # Проверка наличия изображений в ответе
-        if "images" in result and result["images"]:
-            # Получение закодированного в base64 изображения
-            image_base64 = result["images"][0]
-            logger.info("Изображение получено в формате base64")
-            
-            # Декодирование base64 в бинарные данные
-            import base64
-            try:
-                image_data = base64.b64decode(image_base64)
-                logger.info(f"Изображение успешно декодировано, размер: {len(image_data)} байт")
-                return image_data
-            except Exception as e:
-                logger.error(f"Ошибка при декодировании изображения: {e}")
-                return None
+            images = await sd_client.txt2img(backend.url, payload)
+        elapsed = time.monotonic() - started
+        if operation == "txt2img":
+            STAGE_SECONDS.observe(elapsed, stage="render")
+            RENDER_SECONDS.observe(elapsed, backend=backend.url)
         else:
-            error_message = result.get('error', 'Неизвестная ошибка')
-            logger.error(f"Ошибка в ответе API: {error_message}")
-            
-        return None
-            
-    except requests.exceptions.Timeout:
-        logger.error("Таймаут при обращении к API Stable Diffusion")
-        return None
-    except requests.exceptions.ConnectionError:
-        logger.error("Ошибка соединения с API Stable Diffusion")
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при генерации изображения: {e}")
-        return None
+            STAGE_SECONDS.observe(elapsed, stage=operation)
+        cost_model.observe(payload, backend.url, elapsed)
+    except SDTimeoutError:
+        # Сервер продолжил бы рисовать брошенное изображение - прерываем его
+        await sd_client.interrupt(backend.url)
+        raise
+    finally:
+        # Время GPU учитывается и для неудачных и прерванных запросов
+        GPU_SECONDS.inc(time.monotonic() - started, operation=operation)
+        for job in jobs:
+            progress_monitor.unsubscribe(backend.url, job.job_id)
+    logger.info(f"Изображения успешно декодированы, размеры: {[len(image) for image in images]} байт")
+    return split_batch_results(payloads, images)
+
+# Модель стоимости: скорость серверов в секундах на мегапиксель-шаг, уточняется по каждому запросу.
+# До первых данных считаем, что запрос полного качества занимает SCHEDULER_INITIAL_JOB_ESTIMATE
+cost_model = CostModel(
+    SCHEDULER_INITIAL_JOB_ESTIMATE / payload_work(QualityLevel(
+        DEFAULT_SD_SETTINGS["width"], DEFAULT_SD_SETTINGS["height"],
+        DEFAULT_SD_SETTINGS["num_inference_steps"]).apply({})),
+    alpha=COST_MODEL_ALPHA,
+)
+
+# Планировщик генерации: ограниченная очередь с обходом пользователей по кругу
+# (или по стоимости задач, см. SCHEDULER_ORDERING)
+scheduler = GenerationScheduler(
+    generate_images,
+    backend_pool,
+    max_queue=SCHEDULER_MAX_QUEUE,
+    max_per_user=SCHEDULER_MAX_JOBS_PER_USER,
+    initial_estimate=SCHEDULER_INITIAL_JOB_ESTIMATE,
+    position_update_interval=QUEUE_POSITION_UPDATE_INTERVAL,
+    batch_key=(lambda payload: batch_key(payload, SD_BATCH_PROMPT_LIST)) if SD_BATCHING_ENABLED else None,
+    max_batch_size=SD_MAX_BATCH_SIZE,
+    batch_window=SD_BATCH_WINDOW,
+    max_retries=SD_MAX_RETRIES,
+    interrupt=lambda backend: sd_client.interrupt(backend.url),
+    cost_model=cost_model,
+    ordering=SCHEDULER_ORDERING,
+    sjf_aging=SCHEDULER_SJF_AGING,
+)
+
+# Плавная остановка по SIGTERM: новые обновления не принимаются, задачи в работе
+# доделываются до срока DRAIN_TIMEOUT, оставшиеся отменяются с сообщением пользователю
+lifecycle = Lifecycle(DRAIN_TIMEOUT, InstanceState(RUN_DIR), on_drain=scheduler.shutdown_at,
+                      on_deadline=scheduler.close, prepare=backend_warmer.wait)
+
+def collect_metrics():
+    """Снимает текущие значения очереди, серверов и кешей для /metrics."""
+    cache = result_cache.stats()
+    yield ("sd_bot_queue_depth", "gauge", "Задач в очереди планировщика", [({}, scheduler.queued)])
+    yield ("sd_bot_in_flight", "gauge", "Выполняющихся запросов по серверам",
+           [({"backend": b.url}, b.outstanding) for b in backend_pool.backends])
+    yield ("sd_bot_backend_up", "gauge", "Сервер доступен для задач",
+           [({"backend": b.url}, int(b.available)) for b in backend_pool.backends])
+    yield ("sd_bot_seconds_per_megapixel_step", "gauge", "Оценка скорости сервера моделью стоимости",
+           [({"backend": url, "sampler": sampler}, rate) for (url, sampler), rate in cost_model.rates().items()])
+    yield ("sd_bot_quality_level", "gauge", "Текущий уровень качества генерации (0 - полное)",
+           [({}, quality_policy.level)])
+    yield ("sd_bot_degraded_jobs_total", "counter", "Задачи, поставленные с пониженным качеством",
+           [({"level": str(level)}, count) for level, count in enumerate(quality_policy.degraded_jobs) if level])
+    yield ("sd_bot_backend_warming", "gauge", "Сервер прогревается и не получает задачи",
+           [({"backend": b.url}, int(b.warming)) for b in backend_pool.backends])
+    yield ("sd_bot_backend_warmup_seconds", "gauge", "Длительность последнего прогрева сервера",
+           [({"backend": b.url}, b.warmup_seconds) for b in backend_pool.backends if b.warmup_seconds is not None])
+    yield ("sd_bot_wasted_gpu_seconds_total", "counter", "Время GPU, потраченное на отменённые задачи",
+           [({}, scheduler.wasted_gpu_seconds)])
+    yield ("sd_bot_cache_lookups_total", "counter", "Обращения к кешам по результату", [
+        ({"cache": "result", "result": "file_id_hit"}, cache["file_id_hits"]),
+        ({"cache": "result", "result": "disk_hit"}, cache["disk_hits"]),
+        ({"cache": "result", "result": "miss"}, cache["misses"]),
+        ({"cache": "translation", "result": "hit"}, translator.hits),
+        ({"cache": "translation", "result": "miss"}, translator.misses),
+    ])
+    if shared_settings is not None:
+        # Снимок обновляется в фоне вместе с общими настройками
+        counts = shared_settings.counts
+        yield ("sd_bot_shared_jobs", "gauge", "Задачи в общей очереди по статусу",
+               [({"status": status}, counts.get(status, 0)) for status in ("queued", "running")])
+
+REGISTRY.add_collector(collect_metrics)
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+
+def format_queue_status(position: int, eta: float) -> str:
+    """Формирует текст сообщения о положении запроса в очереди."""
+    return f"⏳ Запрос в очереди: позиция {position}, примерное ожидание {int(eta)} с"
+
+def format_started(predicted: float) -> str:
+    """Формирует текст сообщения о начале генерации с прогнозом её длительности."""
+    return f"⏳ Генерирую картинку... (~{max(int(predicted), 1)} с)"
+
+def format_cancelled(reason: str, default: str = CANCELLED_TEXT) -> str:
+    """Формирует текст сообщения об отменённой задаче по причине отмены."""
+    if reason == "expired":
+        return EXPIRED_TEXT
+    if reason == "shutdown":
+        return SHUTDOWN_TEXT
+    return default
+
+def format_rejected() -> str:
+    """Формирует текст сообщения о запросе, который не принят в очередь."""
+    if scheduler.closed:
+        return RESTARTING_TEXT
+    return QUEUE_FULL_TEXT
+
+def format_progress(progress: float, eta: float = None) -> str:
+    """Формирует текст сообщения о ходе генерации."""
+    text = f"⏳ Генерирую картинку... {progress:.0%}"
+    if eta:
+        text += f", осталось ~{int(eta)} с"
+    return text
+
+def improve_buttons(job_id: str) -> List[InlineKeyboardButton]:
+    """Кнопки увеличения и доработки под черновиком."""
+    return [InlineKeyboardButton("🔍 Увеличить", callback_data=f"{ACTION_UPSCALE}:{job_id}"),
+            InlineKeyboardButton("✨ Доработать", callback_data=f"{ACTION_REFINE}:{job_id}")]
+
+def original_button(job_id: str) -> List[InlineKeyboardButton]:
+    """Кнопка отправки оригинала файлом."""
+    return [InlineKeyboardButton("📄 Отправить файлом", callback_data=f"original:{job_id}")]
+
+def cancel_keyboard(job_id: str) -> InlineKeyboardMarkup:
+    """Кнопка отмены под сообщением о ходе генерации."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data=f"cancel:{job_id}")]])
+
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отменяет все ожидающие и выполняющиеся запросы пользователя."""
+    if job_store is not None:
+        jobs = await asyncio.to_thread(job_store.cancel_user, update.effective_user.id)
+        # Сообщения выполняющихся задач обновит воркер, ожидающих - фронтенд
+        for job in jobs:
+            if job.status == STATUS_QUEUED:
+                try:
+                    await context.bot.edit_message_text(CANCELLED_TEXT, chat_id=job.chat_id,
+                                                        message_id=job.message_id)
+                except telegram.error.TelegramError:
+                    pass
+        cancelled = len(jobs)
+    else:
+        cancelled = scheduler.cancel_user(update.effective_user.id)
+    if cancelled:
+        await update.message.reply_text(f"Отменено запросов: {cancelled}.")
+    else:
+        await update.message.reply_text("У вас нет активных запросов.")
+
+async def cancel_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает нажатие кнопки отмены под сообщением о генерации."""
+    query = update.callback_query
+    job_id = query.data.split(':', 1)[1]
+    if job_store is not None:
+        status = await asyncio.to_thread(job_store.cancel, job_id, query.from_user.id)
+        if status is None:
+            await query.answer("Этот запрос уже нельзя отменить")
+            return
+        await query.answer("Генерация отменена")
+        if status == STATUS_QUEUED:
+            await query.edit_message_text(CANCELLED_TEXT)
+        return
+    job = scheduler.get(job_id)
+    if job is not None and job.user_id == query.from_user.id and scheduler.cancel(job_id):
+        await query.answer("Генерация отменена")
+    else:
+        await query.answer("Этот запрос уже нельзя отменить")
+
+async def send_original(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Отправляет оригинал изображения в полном разрешении файлом."""
+    query = update.callback_query
+    key = query.data.split(':', 1)[1]
+    data = originals.get(key)
+    if data is None:
+        await query.answer("Оригинал больше недоступен")
+        return
+    await query.answer()
+    started = time.monotonic()
+    await context.bot.send_document(chat_id=query.message.chat_id, document=data, filename=f"{key}.png")
+    transcoder.record_upload("document", len(data), time.monotonic() - started)
+
+async def improve_draft(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Увеличивает или дорабатывает черновик по кнопке под ним."""
+    query = update.callback_query
+    action, key = query.data.split(':', 1)
+    draft = drafts.get(key)
+    image = originals.get(key)
+    if draft is None or image is None:
+        await query.answer("Черновик больше недоступен, отправьте запрос заново")
+        return
+    if draft.user_id != query.from_user.id:
+        await query.answer("Улучшить можно только свой черновик")
+        return
+    await query.answer()
+    if not draft.used:
+        # Первое улучшение означает, что черновик пользователю понравился
+        draft.used = True
+        SATISFIED_TOTAL.inc()
+    chat_id = query.message.chat_id
+    received_at = time.monotonic()
+    job_id = new_job_id()
+    trace_id.set(job_id)
+    if action == ACTION_UPSCALE:
+        payload = upscale_payload(image, SD_UPSCALER, UPSCALE_FACTOR)
+        operation = "upscale"
+        caption = f"Увеличено в {UPSCALE_FACTOR:g} раза: {draft.prompt}"
+    else:
+        quality_policy.update(scheduler.queued, backend_pool.capacity)
+        level = quality_policy.current
+        payload = refine_payload(draft.payload, image, level, REFINE_DENOISING_STRENGTH)
+        operation = "img2img"
+        caption = f"Доработано ({level.describe()}): {draft.prompt}"
+    logger.info(f"Улучшение черновика {key} ({action}) для пользователя {query.from_user.id}")
+    keyboard = cancel_keyboard(job_id)
+    processing_message = await context.bot.send_message(chat_id, IMPROVING_TEXT,
+                                                        reply_to_message_id=query.message.message_id,
+                                                        reply_markup=keyboard)
+    message_id = processing_message.message_id
+
+    async def on_start() -> None:
+        await context.bot.edit_message_text(format_started(job.predicted), chat_id=chat_id,
+                                            message_id=message_id, reply_markup=keyboard)
+
+    async def on_progress(progress: float, eta: float, preview: bytes) -> None:
+        await edit_throttle.call(chat_id, lambda: context.bot.edit_message_text(
+            format_progress(progress, eta), chat_id=chat_id, message_id=message_id, reply_markup=keyboard))
+
+    job = GenerationJob(user_id=query.from_user.id, chat_id=chat_id, prompt=draft.prompt, payload=payload,
+                        job_id=job_id, deadline=time.monotonic() + JOB_DEADLINE, operation=operation,
+                        on_start=on_start, on_progress=on_progress)
+    text = IMPROVE_FAILED_TEXT
+    result = None
+    try:
+        result = await scheduler.submit(job)
+    except QueueFullError:
+        text = format_rejected()
+    except JobCancelledError as e:
+        text = format_cancelled(e.reason, IMPROVE_CANCELLED_TEXT)
+    except SDAPIError as e:
+        logger.error(f"Не удалось улучшить черновик {key}: {e}")
+    finally:
+        edit_throttle.forget(chat_id)
+    if not result:
+        await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        return
+    photo = await transcoder.transcode(result)
+    reply_markup = None
+    if photo is not result:
+        originals.put(job_id, result)
+        reply_markup = InlineKeyboardMarkup([original_button(job_id)])
+    started = time.monotonic()
+    await context.bot.send_photo(chat_id=chat_id, photo=photo, caption=caption, reply_markup=reply_markup,
+                                 reply_to_message_id=query.message.message_id)
+    transcoder.record_upload("photo", len(photo), time.monotonic() - started)
+    STAGE_SECONDS.observe(time.monotonic() - received_at, stage=f"{action}_end_to_end")
+    await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает входящие сообщения и генерирует изображения."""
     processing_message = None
+    preview_message = None
     try:
         user_id = update.effective_user.id
         username = update.effective_user.username or "Unknown"
         prompt = update.message.text
+        received_at = time.monotonic()
+        job_id = new_job_id()
+        trace_id.set(job_id)
         
         logger.info(f"Получен запрос от пользователя {username} (ID: {user_id}): {prompt}")
         
-        # Отправляем сообщение о начале обработки
-        processing_message = await update.message.reply_text("⏳ Генерирую картинку...")
+        # Отправляем сообщение о начале обработки с кнопкой отмены
+        keyboard = cancel_keyboard(job_id)
+        processing_message = await update.message.reply_text("⏳ Генерирую картинку...", reply_markup=keyboard)
         
-        # Проверяем, на русском ли запрос
-        if is_russian(prompt):
-            # Переводим запрос на английский
-            english_prompt = translate_to_english(prompt)
+        # Переводим русский запрос на английский (с кешированием)
+        with STAGE_SECONDS.time(stage="translate"):
+            english_prompt = await translator.translate(prompt)
+        if english_prompt != prompt:
             prompt = english_prompt
             logger.info(f"Запрос переведен на английский: {prompt}")
         else:
             logger.info("Запрос на английском, перевод не требуется")
         
-        # Проверяем доступность API
-        if not check_api_availability():
-            await update.message.reply_text(
-                "Извините, API Stable Diffusion в данный момент недоступен. Пожалуйста, попробуйте позже."
-            )
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=processing_message.message_id
-            )
+        chat_id = update.effective_chat.id
+        message_id = processing_message.message_id
+        # Под нагрузкой новые задачи получают упрощённые параметры генерации
+        if job_store is not None:
+            counts = await asyncio.to_thread(job_store.counts)
+            quality_policy.update(counts.get(STATUS_QUEUED, 0), backend_pool.capacity)
+        else:
+            quality_policy.update(scheduler.queued, backend_pool.capacity)
+        if draft_mode:
+            payload = build_payload(prompt, draft_level)
+            caption = f"Черновик по запросу: {prompt}"
+        else:
+            payload = build_payload(prompt)
+            caption = f"Сгенерировано по запросу: {prompt}"
+            if quality_policy.degraded:
+                caption += f"\n⚙️ Упрощённое качество из-за нагрузки: {quality_policy.current.describe()}"
+
+        # Одинаковый запрос с фиксированным seed берём из кеша результатов
+        cache_key = payload_key(payload) if is_cacheable(payload) else None
+        if draft_mode:
+            # Seed черновика фиксируется уже после расчёта ключа: случайный seed не должен попадать в кеш
+            payload = with_fixed_seed(payload)
+        image_data = None
+        generated = False
+        # По file_id отправляется только фото, а черновику нужны кнопки улучшения и оригинал изображения
+        if cache_key and not draft_mode:
+            file_id = result_cache.get_file_id(cache_key)
+            if file_id is None and job_store is not None:
+                # Результаты, отправленные воркерами, известны только общему хранилищу
+                shared_file_id = await asyncio.to_thread(job_store.get_file_id, cache_key)
+                if shared_file_id:
+                    result_cache.put_file_id(cache_key, shared_file_id)
+                    file_id = result_cache.get_file_id(cache_key)
+            if file_id:
+                logger.info(f"Результат для пользователя {username} найден в кеше, повторная отправка по file_id")
+                REQUESTS_TOTAL.inc(result="cache_file_id")
+                await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return
+        if cache_key:
+            image_data = await result_cache.get_bytes(cache_key)
+            if image_data is not None:
+                REQUESTS_TOTAL.inc(result="cache_disk")
+
+        if image_data is None and job_store is not None:
+            # Генерацию выполнит один из воркеров и сам отправит результат в чат
+            queued = QueuedJob(job_id=job_id, user_id=user_id, chat_id=chat_id, message_id=message_id,
+                               prompt=prompt, caption=caption, payload=payload, deadline=time.time() + JOB_DEADLINE)
+            try:
+                position = await asyncio.to_thread(job_store.enqueue, queued, SCHEDULER_MAX_QUEUE,
+                                                   SCHEDULER_MAX_JOBS_PER_USER)
+            except QueueFullError as e:
+                REQUESTS_TOTAL.inc(result="rejected")
+                logger.warning(f"Запрос пользователя {username} отклонён: {e}")
+                await context.bot.edit_message_text(format_rejected(), chat_id=chat_id, message_id=message_id)
+                return
+            REQUESTS_TOTAL.inc(result="queued")
+            logger.info(f"Запрос пользователя {username} поставлен в общую очередь, позиция {position}")
+            await context.bot.edit_message_text(f"⏳ Запрос в очереди: позиция {position}", chat_id=chat_id,
+                                                message_id=message_id, reply_markup=keyboard)
             return
-        
-        # Генерируем изображение
-        image_data = generate_image(prompt)
+
+        if image_data is None:
+            # Проверяем доступность API по результатам фоновой проверки
+            if not backend_pool.has_available():
+                REQUESTS_TOTAL.inc(result="unavailable")
+                await update.message.reply_text(UNAVAILABLE_TEXT)
+                await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return
+
+            async def on_position(position: int, eta: float) -> None:
+                await context.bot.edit_message_text(format_queue_status(position, eta), chat_id=chat_id,
+                                                    message_id=message_id, reply_markup=keyboard)
+
+            async def on_start() -> None:
+                await context.bot.edit_message_text(format_started(job.predicted),
+                                                    chat_id=chat_id, message_id=message_id, reply_markup=keyboard)
+
+            async def on_progress(progress: float, eta: float, preview: bytes) -> None:
+                text = format_progress(progress, eta)
+                if preview is None:
+                    if preview_message is None:
+                        await edit_throttle.call(chat_id, lambda: context.bot.edit_message_text(
+                            text, chat_id=chat_id, message_id=message_id, reply_markup=keyboard))
+                    return
+                await edit_throttle.call(chat_id, lambda: send_preview(text, preview))
+
+            async def send_preview(text: str, preview: bytes) -> None:
+                # Превью показывается отдельным сообщением с фото, которое затем редактируется
+                nonlocal preview_message
+                if preview_message is None:
+                    preview_message = await context.bot.send_photo(chat_id=chat_id, photo=preview, caption=text,
+                                                                   reply_markup=keyboard)
+                else:
+                    await context.bot.edit_message_media(InputMediaPhoto(preview, caption=text),
+                                                         chat_id=chat_id, message_id=preview_message.message_id,
+                                                         reply_markup=keyboard)
+
+            # Ставим задачу в очередь генерации
+            job = GenerationJob(user_id=user_id, chat_id=chat_id, prompt=prompt, payload=payload,
+                                job_id=job_id, deadline=time.monotonic() + JOB_DEADLINE,
+                                on_position=on_position, on_start=on_start, on_progress=on_progress)
+            try:
+                result = scheduler.submit(job)
+            except QueueFullError as e:
+                REQUESTS_TOTAL.inc(result="rejected")
+                logger.warning(f"Запрос пользователя {username} отклонён: {e}")
+                await context.bot.edit_message_text(
+                    format_rejected(),
+                    chat_id=chat_id, message_id=message_id
+                )
+                return
+
+            # Ждём результата генерации
+            cancel_reason = None
+            try:
+                image_data = await result
+            except JobCancelledError as e:
+                cancel_reason = e.reason
+            except SDAPIError as e:
+                logger.error(f"Не удалось сгенерировать изображение для пользователя {username}: {e}")
+            finally:
+                edit_throttle.forget(chat_id)
+                if preview_message is not None:
+                    try:
+                        await context.bot.delete_message(chat_id=chat_id, message_id=preview_message.message_id)
+                    except telegram.error.TelegramError:
+                        pass
+            if cancel_reason:
+                logger.info(f"Запрос пользователя {username} отменён ({cancel_reason})")
+                REQUESTS_TOTAL.inc(result="cancelled")
+                text = format_cancelled(cancel_reason)
+                await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+                return
+            if image_data and cache_key:
+                await result_cache.put_bytes(cache_key, image_data)
+            generated = True
         
         if image_data:
+            # Сжимаем изображение в отдельном процессе, оригинал доступен по кнопке
+            photo = await transcoder.transcode(image_data)
+            buttons = []
+            if draft_mode:
+                # Черновик и его параметры нужны для увеличения и доработки по кнопкам
+                originals.put(job_id, image_data)
+                drafts.put(job_id, Draft(user_id=user_id, prompt=prompt, payload=payload))
+                buttons.append(improve_buttons(job_id))
+            if photo is not image_data:
+                originals.put(job_id, image_data)
+                buttons.append(original_button(job_id))
+            reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
             # Отправляем изображение пользователю
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=io.BytesIO(image_data),
-                caption=f"Сгенерировано по запросу: {prompt}"
+            # bytes передаются в Telegram напрямую, без дополнительной обёртки в BytesIO
+            started = time.monotonic()
+            message = await context.bot.send_photo(
+                chat_id=chat_id,
+                photo=photo,
+                caption=caption,
+                reply_markup=reply_markup
             )
+            transcoder.record_upload("photo", len(photo), time.monotonic() - started)
+            if generated:
+                # Сгенерированным запрос считается только после отправки результата
+                REQUESTS_TOTAL.inc(result="generated")
+            STAGE_SECONDS.observe(time.monotonic() - received_at, stage="end_to_end")
+            quality_policy.observe(time.monotonic() - received_at)
+            if not draft_mode:
+                SATISFIED_TOTAL.inc()
+            if cache_key and message.photo and not draft_mode:
+                result_cache.put_file_id(cache_key, message.photo[-1].file_id)
             logger.info(f"Изображение успешно отправлено пользователю {username}")
         else:
             # Если не удалось сгенерировать изображение
+            REQUESTS_TOTAL.inc(result="failed")
             await update.message.reply_text(
-                "Извините, не удалось сгенерировать изображение. Пожалуйста, попробуйте другой запрос."
+                GENERATION_FAILED_TEXT
             )
             logger.error(f"Не удалось отправить изображение пользователю {username}")
         
         # Удаляем сообщение о обработке
-        await context.bot.delete_message(
-            chat_id=update.effective_chat.id,
-            message_id=processing_message.message_id
-        )
+        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
         
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {e}")
         # Если произошла ошибка, отправляем сообщение об ошибке
-        await update.message.reply_text(
-            "Произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
-        )
+        await update.message.reply_text(ERROR_TEXT)
         # Удаляем сообщение о обработке, если оно существует
         if processing_message:
             try:
@@ -298,51 +944,109 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     
     # Обработка ошибки Conflict
     if isinstance(context.error, telegram.error.Conflict):
-        logger.error("Обнаружен конфликт: запущено несколько экземпляров бота")
-        # Можно добавить код для завершения работы бота
-        import sys
-        sys.exit(1)
+        logger.error("Обнаружен конфликт: запущено несколько экземпляров бота в режиме polling")
+        # Останавливаемся плавно, доделав задачи в работе.
+        # Несколько экземпляров можно запускать только в режиме webhook,
+        # для перезапуска без простоя есть manage_bot.py restart
+        lifecycle.request_stop()
+
+async def post_init(application: Application) -> None:
+    """Запускает планировщик и фоновую проверку серверов Stable Diffusion."""
+    if metrics_server is not None:
+        await metrics_server.start()
+    if shared_settings is not None:
+        # Серверами и очередью занимаются воркеры
+        await shared_settings.start()
+        return
+    scheduler.start()
+    health_checker.start()
+    backend_warmer.schedule_pending()
+
+async def post_shutdown(application: Application) -> None:
+    """Останавливает планировщик и закрывает пул HTTP-соединений."""
+    await backend_warmer.stop()
+    await health_checker.stop()
+    await progress_monitor.stop()
+    await scheduler.stop()
+    await http_pool.close()
+    translator.close()
+    transcoder.close()
+    if shared_settings is not None:
+        await shared_settings.stop()
+        job_store.close()
+    if metrics_server is not None:
+        await metrics_server.stop()
+
+def build_application(base_url: Optional[str] = None) -> Application:
+    """Создаёт приложение Telegram со всеми обработчиками.
+
+    base_url позволяет направить запросы к Bot API на другой адрес,
+    например на локальную заглушку при нагрузочном тестировании.
+    """
+    # Обновления обрабатываются параллельно,
+    # чтобы ожидание генерации одного пользователя не блокировало остальных
+    builder = Application.builder()\
+        .token(TELEGRAM_TOKEN)\
+        .concurrent_updates(True)\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url)
+    application = builder.build()
+    
+    # Добавляем обработчик ошибок
+    application.add_error_handler(error_handler)
+    
+    # Обработчики команд
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("cancel", cancel_command))
+    application.add_handler(CallbackQueryHandler(cancel_button, pattern=r"^cancel:"))
+    application.add_handler(CallbackQueryHandler(send_original, pattern=r"^original:"))
+    application.add_handler(CallbackQueryHandler(improve_draft, pattern=rf"^({ACTION_UPSCALE}|{ACTION_REFINE}):"))
+    
+    # Обработчики команд для управления фильтрацией
+    application.add_handler(CommandHandler("filter_status", filter_status))
+    application.add_handler(CommandHandler("enable_filter", enable_filter))
+    application.add_handler(CommandHandler("disable_filter", disable_filter))
+
+    # Команды для управления сервером SD
+    application.add_handler(CommandHandler("set_sd_server", set_sd_server))
+    application.add_handler(CommandHandler("get_sd_server", get_sd_server))
+    application.add_handler(CommandHandler("backends", list_backends))
+    application.add_handler(CommandHandler(
+        ["add_backend", "remove_backend", "drain_backend", "undrain_backend"], manage_backend))
+    application.add_handler(CommandHandler("cache_stats", cache_stats))
+    application.add_handler(CommandHandler("stats", stats_command))
+    
+    # Обработчик текстовых сообщений
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return application
 
 def main() -> None:
     """Запускает бота."""
+    parser = argparse.ArgumentParser(description="Telegram-бот для генерации изображений")
+    parser.add_argument("--standby", action="store_true",
+                        help="Подготовиться к работе, но получать обновления только после SIGUSR1")
+    args = parser.parse_args()
     try:
         # Вывод информации о запуске
         logger.info(f"Запуск бота с токеном: {TELEGRAM_TOKEN[:5]}...{TELEGRAM_TOKEN[-5:]}")
-        logger.info(f"API Stable Diffusion: {current_sd_server_url}")
+        logger.info(f"Серверы Stable Diffusion: {', '.join(b.url for b in backend_pool.backends)}")
         logger.info(f"Фильтрация контента для взрослых: {'Включена' if content_filter_state else 'Выключена'}")
         
-        # Проверка доступности API Stable Diffusion
-        api_available = check_api_availability()
-        if not api_available:
-            logger.warning(f"API Stable Diffusion недоступен: {current_sd_server_url}. Бот будет запущен, но генерация изображений будет недоступна.")
-        
-        # Создание приложения с настройками для предотвращения конфликтов
-        application = Application.builder()\
-            .token(TELEGRAM_TOKEN)\
-            .build()
-        
-        # Добавляем обработчик ошибок
-        application.add_error_handler(error_handler)
-        
-        # Обработчики команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        
-        # Обработчики команд для управления фильтрацией
-        application.add_handler(CommandHandler("filter_status", filter_status))
-        application.add_handler(CommandHandler("enable_filter", enable_filter))
-        application.add_handler(CommandHandler("disable_filter", disable_filter))
-
-        # Команды для управления сервером SD
-        application.add_handler(CommandHandler("set_sd_server", set_sd_server))
-        application.add_handler(CommandHandler("get_sd_server", get_sd_server))
-        
-        # Обработчик текстовых сообщений
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+        application = build_application(TELEGRAM_API_URL or None)
         
         # Запуск бота
-        logger.info("Бот запущен и ожидает сообщений...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        if BOT_MODE == "webhook":
+            secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+            server = WebhookServer(application, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, secret_token)
+            logger.info("Бот запущен в режиме webhook и ожидает сообщений...")
+            asyncio.run(serve_webhook(application, server, WEBHOOK_URL, ALLOWED_UPDATES, WEBHOOK_MAX_CONNECTIONS,
+                                      lifecycle, args.standby))
+        else:
+            logger.info("Бот запущен и ожидает сообщений...")
+            asyncio.run(serve_polling(application, lifecycle, ALLOWED_UPDATES, args.standby))
     except telegram.error.Conflict:
         logger.error("Обнаружен конфликт: запущено несколько экземпляров бота")
     except Exception as e:
@@ -0,0 +1,263 @@
+import asyncio
+import base64
+import binascii
+import logging
+import time
+from typing import List, Optional
+
+import httpx
+from bs4 import BeautifulSoup
+from deep_translator.constants import BASE_URLS
+
+from config import (HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY,
+                    SD_CONNECT_TIMEOUT, SD_READ_TIMEOUT, SD_TOTAL_TIMEOUT, SD_HEALTH_TIMEOUT,
+                    TRANSLATE_TIMEOUT)
+from metrics import STAGE_SECONDS
+from streaming import ImagesStreamDecoder, StreamDecodeError
+
+# Размер куска при потоковом чтении ответа txt2img
+STREAM_CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class SDAPIError(Exception):
+    """Ошибка при обращении к Stable Diffusion API."""
+
+
+class SDTimeoutError(SDAPIError):
+    """Сервер Stable Diffusion не ответил за отведённое время."""
+
+
+class HttpPool:
+    """Общий асинхронный HTTP-клиент с пулом keep-alive соединений.
+
+    Клиент создаётся лениво внутри работающего event loop и переиспользуется
+    всеми запросами к SD API и сервису перевода, поэтому TLS-соединение
+    устанавливается один раз на хост, а не на каждый запрос.
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                # Игнорируем проверку SSL-сертификатов, как и раньше
+                verify=False,
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=httpx.Timeout(SD_READ_TIMEOUT, connect=SD_CONNECT_TIMEOUT),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        """Закрывает все соединения пула."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+http_pool = HttpPool()
+
+
+def base_url(url: str) -> str:
+    """Возвращает адрес сервера без дополнительных путей."""
+    return url.split('://')[0] + '://' + url.split('://')[1].split('/')[0]
+
+
+class SDClient:
+    """Асинхронный клиент Stable Diffusion API."""
+
+    def __init__(self, pool: HttpPool = http_pool):
+        self.pool = pool
+
+    async def check_availability(self, url: str) -> bool:
+        """Проверяет доступность сервера простым запросом к корню."""
+        try:
+            response = await self.pool.client.get(
+                base_url(url),
+                timeout=httpx.Timeout(SD_HEALTH_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+            )
+            return response.status_code < 400  # Любой ответ, кроме ошибки, считаем успешным
+        except httpx.HTTPError as e:
+            logger.error(f"Ошибка при проверке доступности API: {e!r}")
+            return False
+
+    async def progress(self, url: str, with_image: bool = False) -> dict:
+        """Возвращает состояние текущей генерации на сервере."""
+        try:
+            response = await self.pool.client.get(
+                f"{url}/sdapi/v1/progress",
+                params={"skip_current_image": "false" if with_image else "true"},
+                timeout=httpx.Timeout(SD_HEALTH_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+            )
+        except httpx.HTTPError as e:
+            raise SDAPIError(f"Ошибка при запросе прогресса: {e!r}")
+        if response.status_code != 200:
+            raise SDAPIError(f"Ошибка при запросе прогресса: {response.status_code}")
+        return response.json()
+
+    async def txt2img(self, url: str, payload: dict) -> List[bytes]:
+        """Отправляет запрос txt2img и возвращает декодированные изображения.
+
+        Общий таймаут ограничивает всю операцию целиком, а таймауты соединения
+        и чтения - отдельные фазы запроса.
+        """
+        return await self._with_timeout(self._generate(url, "txt2img", payload))
+
+    async def img2img(self, url: str, payload: dict) -> List[bytes]:
+        """Отправляет запрос img2img (исходное изображение - в init_images)."""
+        return await self._with_timeout(self._generate(url, "img2img", payload))
+
+    async def upscale(self, url: str, payload: dict) -> bytes:
+        """Увеличивает изображение апскейлером /sdapi/v1/extra-single-image без новой генерации."""
+        return await self._with_timeout(self._upscale(url, payload))
+
+    @staticmethod
+    async def _with_timeout(coro):
+        # Общий таймаут ограничивает всю операцию целиком
+        try:
+            return await asyncio.wait_for(coro, timeout=SD_TOTAL_TIMEOUT)
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            raise SDTimeoutError("Таймаут при обращении к API Stable Diffusion")
+        except httpx.TransportError as e:
+            raise SDAPIError(f"Ошибка соединения с API Stable Diffusion: {e!r}")
+
+    async def options(self, url: str) -> dict:
+        """Возвращает настройки сервера, в том числе загруженный чекпойнт."""
+        return await self._get_json(url, "/sdapi/v1/options", "настроек")
+
+    async def models(self, url: str) -> List[dict]:
+        """Возвращает список чекпойнтов, доступных на сервере."""
+        return await self._get_json(url, "/sdapi/v1/sd-models", "списка моделей")
+
+    async def set_options(self, url: str, options: dict, timeout: float) -> None:
+        """Меняет настройки сервера. Смена чекпойнта ждёт окончания его загрузки."""
+        try:
+            response = await self.pool.client.post(
+                f"{url}/sdapi/v1/options",
+                json=options,
+                timeout=httpx.Timeout(timeout, connect=SD_CONNECT_TIMEOUT)
+            )
+        except httpx.TimeoutException:
+            raise SDTimeoutError("Таймаут при изменении настроек Stable Diffusion")
+        except httpx.HTTPError as e:
+            raise SDAPIError(f"Ошибка при изменении настроек: {e!r}")
+        if response.status_code != 200:
+            raise SDAPIError(f"Ошибка при изменении настроек: {response.status_code} - {response.text[:500]}")
+
+    async def _get_json(self, url: str, path: str, what: str):
+        try:
+            response = await self.pool.client.get(
+                f"{url}{path}",
+                timeout=httpx.Timeout(SD_HEALTH_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+            )
+        except httpx.HTTPError as e:
+            raise SDAPIError(f"Ошибка при запросе {what}: {e!r}")
+        if response.status_code != 200:
+            raise SDAPIError(f"Ошибка при запросе {what}: {response.status_code}")
+        return response.json()
+
+    async def interrupt(self, url: str) -> bool:
+        """Прерывает текущую генерацию на сервере, чтобы освободить GPU."""
+        try:
+            response = await self.pool.client.post(
+                f"{url}/sdapi/v1/interrupt",
+                timeout=httpx.Timeout(SD_HEALTH_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"Не удалось прервать генерацию на {url}: {e!r}")
+            return False
+        logger.info(f"Генерация на {url} прервана, ответ {response.status_code}")
+        return response.status_code < 400
+
+    async def _generate(self, url: str, method: str, payload: dict) -> List[bytes]:
+        # Ответ читается потоком: из JSON извлекаются только строки images,
+        # которые сразу декодируются из base64, остальные поля пропускаются
+        api_endpoint = f"{url}/sdapi/v1/{method}"
+        started = time.monotonic()
+        async with self.pool.client.stream(
+            "POST",
+            api_endpoint,
+            json=payload,
+            timeout=httpx.Timeout(SD_READ_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+        ) as response:
+            if response.status_code != 200:
+                raise SDAPIError(f"Ошибка API Stable Diffusion: {response.status_code} - "
+                                 f"{await self._read_error(response)}")
+            decoder = ImagesStreamDecoder()
+            decode_seconds = 0.0
+            try:
+                async for chunk in response.aiter_bytes(STREAM_CHUNK_SIZE):
+                    decode_started = time.perf_counter()
+                    decoder.feed(chunk)
+                    decode_seconds += time.perf_counter() - decode_started
+                images = decoder.close()
+            except StreamDecodeError as e:
+                raise SDAPIError(str(e))
+            STAGE_SECONDS.observe(decode_seconds, stage="decode")
+        logger.info(f"Ответ от API получен за {time.monotonic() - started:.1f} с")
+
+        if not images:
+            raise SDAPIError("Ошибка в ответе API: нет изображений")
+        return images
+
+    async def _upscale(self, url: str, payload: dict) -> bytes:
+        response = await self.pool.client.post(
+            f"{url}/sdapi/v1/extra-single-image",
+            json=payload,
+            timeout=httpx.Timeout(SD_READ_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+        )
+        if response.status_code != 200:
+            raise SDAPIError(f"Ошибка API Stable Diffusion: {response.status_code} - {response.text[:500]}")
+        try:
+            image = response.json().get("image")
+            if not image:
+                raise SDAPIError("Ошибка в ответе API: нет изображения")
+            return base64.b64decode(image.split(",", 1)[-1])
+        except (ValueError, binascii.Error) as e:
+            raise SDAPIError(f"Не удалось декодировать изображение: {e}")
+
+    @staticmethod
+    async def _read_error(response: httpx.Response, limit: int = 500) -> str:
+        """Читает начало тела ответа с ошибкой, не загружая его целиком."""
+        body = b''
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) >= limit:
+                break
+        return body[:limit].decode('utf-8', errors='replace')
+
+
+class GoogleTranslateClient:
+    """Асинхронный клиент Google Translate поверх общего пула соединений.
+
+    Повторяет запрос, который выполняет deep_translator.GoogleTranslator,
+    но не блокирует event loop и не открывает новое соединение на каждый перевод.
+    """
+
+    def __init__(self, pool: HttpPool = http_pool, source: str = 'ru', target: str = 'en'):
+        self.pool = pool
+        self.source = source
+        self.target = target
+
+    async def translate(self, text: str) -> str:
+        text = text.strip()
+        if not text:
+            return text
+        response = await self.pool.client.get(
+            BASE_URLS["GOOGLE_TRANSLATE"],
+            params={"sl": self.source, "tl": self.target, "q": text},
+            timeout=httpx.Timeout(TRANSLATE_TIMEOUT, connect=SD_CONNECT_TIMEOUT)
+        )
+        response.raise_for_status()
+        soup = BeautifulSoup(response.text, "html.parser")
+        element = soup.find("div", {"class": "t0"}) or soup.find("div", {"class": "result-container"})
+        if not element:
+            raise ValueError(f"Перевод не найден для: {text[:50]}")
+        return element.get_text(strip=True)
@@ -6,10 +6,16 @@ load_dotenv()
 
 # Токен Telegram бота
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN", "7711096546:AAEBHGt-H5kOL0N0u9zisqfIFO5FPvH0qS0")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # Адрес Bot API, например локального сервера (по умолчанию api.telegram.org)
 
 # URL API Stable Diffusion
 STABLE_DIFFUSION_API_URL = os.getenv("STABLE_DIFFUSION_API_URL", "https://predator.hopto.org:7777")
 
+# Список серверов Stable Diffusion через запятую (по умолчанию - один STABLE_DIFFUSION_API_URL)
+STABLE_DIFFUSION_API_URLS = [url.strip() for url in
+                             os.getenv("STABLE_DIFFUSION_API_URLS", STABLE_DIFFUSION_API_URL).split(",")
+                             if url.strip()]
+
 # ID администраторов
 ADMIN_IDS = [141566, 1972749]
 
@@ -27,8 +33,129 @@ DEFAULT_SD_SETTINGS = {
     "seed": -1  # Случайное зерно
 }
 
+# Seed для генерации (-1 - случайный). При фиксированном seed работает кеш результатов
+SD_SEED = int(os.getenv("SD_SEED", str(DEFAULT_SD_SETTINGS["seed"])))
+
 # Базовый Negative Prompt для улучшения качества генерации
 DEFAULT_NEGATIVE_PROMPT = "(deformed, distorted, disfigured:1.3), poorly drawn, bad anatomy, wrong anatomy, extra limb, missing limb, floating limbs, (mutated hands and fingers:1.4), disconnected limbs, mutation, mutated, ugly, disgusting, blurry, amputation"
 
 # Negative prompt для фильтрации контента для взрослых
 ADULT_CONTENT_NEGATIVE_PROMPT = f"{DEFAULT_NEGATIVE_PROMPT}, nsfw, nude, naked, porn, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username"
+
+# Настройки HTTP-клиента (общий пул keep-alive соединений)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+# Таймауты запросов к Stable Diffusion API (в секундах)
+SD_CONNECT_TIMEOUT = float(os.getenv("SD_CONNECT_TIMEOUT", "10"))
+SD_READ_TIMEOUT = float(os.getenv("SD_READ_TIMEOUT", "170"))
+SD_TOTAL_TIMEOUT = float(os.getenv("SD_TOTAL_TIMEOUT", "180"))
+SD_HEALTH_TIMEOUT = float(os.getenv("SD_HEALTH_TIMEOUT", "10"))
+
+# Таймаут запроса к сервису перевода (в секундах)
+TRANSLATE_TIMEOUT = float(os.getenv("TRANSLATE_TIMEOUT", "15"))
+
+# Настройки очереди генерации
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))  # Максимум задач в очереди
+SCHEDULER_MAX_JOBS_PER_USER = int(os.getenv("SCHEDULER_MAX_JOBS_PER_USER", "5"))  # Максимум задач одного пользователя
+SD_MAX_CONCURRENT_JOBS = int(os.getenv("SD_MAX_CONCURRENT_JOBS", "1"))  # Одновременных генераций на сервер
+SD_MAX_RETRIES = int(os.getenv("SD_MAX_RETRIES", "2"))  # Повторов задачи на других серверах при ошибке
+SCHEDULER_INITIAL_JOB_ESTIMATE = float(os.getenv("SCHEDULER_INITIAL_JOB_ESTIMATE", "30"))  # Начальная оценка длительности, с
+QUEUE_POSITION_UPDATE_INTERVAL = float(os.getenv("QUEUE_POSITION_UPDATE_INTERVAL", "3"))  # Минимальный интервал обновления позиции, с
+JOB_DEADLINE = float(os.getenv("JOB_DEADLINE", "300"))  # Срок задачи с учётом ожидания в очереди, с
+SCHEDULER_ORDERING = os.getenv("SCHEDULER_ORDERING", "fair").lower()  # fair - по кругу, sjf - сначала дешёвые, wfq - по времени GPU пользователей
+SCHEDULER_SJF_AGING = float(os.getenv("SCHEDULER_SJF_AGING", "0.1"))  # На сколько секунд стоимости задачи в sjf уменьшает секунда ожидания
+COST_MODEL_ALPHA = float(os.getenv("COST_MODEL_ALPHA", "0.2"))  # Вес нового наблюдения в оценке скорости сервера
+
+# Объединение совместимых запросов в один вызов txt2img
+SD_BATCHING_ENABLED = os.getenv("SD_BATCHING_ENABLED", "false").lower() == "true"
+SD_MAX_BATCH_SIZE = int(os.getenv("SD_MAX_BATCH_SIZE", "4"))  # Максимум задач в одном запросе
+SD_BATCH_WINDOW = float(os.getenv("SD_BATCH_WINDOW_MS", "300")) / 1000  # Окно сбора пакета, с
+SD_BATCH_PROMPT_LIST = os.getenv("SD_BATCH_PROMPT_LIST", "false").lower() == "true"  # API принимает список промптов
+
+# Фоновая проверка серверов Stable Diffusion и автомат защиты
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "15"))  # Период проверки, с
+HEALTH_DEGRADED_LATENCY = float(os.getenv("HEALTH_DEGRADED_LATENCY", "2"))  # Задержка ответа, после которой сервер считается деградировавшим, с
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))  # Ошибок подряд до размыкания автомата
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))  # Время до пробного запроса, с
+
+# Прогрев серверов перед приёмом задач (при запуске, добавлении и после восстановления)
+SD_WARMUP_ENABLED = os.getenv("SD_WARMUP_ENABLED", "true").lower() == "true"
+SD_CHECKPOINT = os.getenv("SD_CHECKPOINT", "")  # Чекпойнт, который должен быть загружен (пусто - не менять)
+SD_WARMUP_TIMEOUT = float(os.getenv("SD_WARMUP_TIMEOUT", "600"))  # Предельное время прогрева с загрузкой модели, с
+
+# Перевод запросов
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")  # google, none или module:Class
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "1000"))  # Записей в кеше в памяти
+TRANSLATION_DISK_CACHE = os.getenv("TRANSLATION_DISK_CACHE", "")  # Путь к SQLite-файлу кеша (пусто - без дискового кеша)
+TRANSLATION_DISK_CACHE_MAX_ENTRIES = int(os.getenv("TRANSLATION_DISK_CACHE_MAX_ENTRIES", "50000"))
+TRANSLATION_BATCH_WINDOW = float(os.getenv("TRANSLATION_BATCH_WINDOW_MS", "50")) / 1000  # Окно сбора пакета, с
+TRANSLATION_MAX_BATCH = int(os.getenv("TRANSLATION_MAX_BATCH", "16"))
+
+# Кеш результатов генерации
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "10000"))  # Записей file_id в памяти
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "")  # Каталог дискового кеша изображений (пусто - без него)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+# Отображение прогресса генерации
+PROGRESS_POLL_INTERVAL = float(os.getenv("PROGRESS_POLL_INTERVAL", "1.5"))  # Период опроса /sdapi/v1/progress, с
+PROGRESS_PREVIEW_ENABLED = os.getenv("PROGRESS_PREVIEW_ENABLED", "false").lower() == "true"  # Показывать промежуточное превью
+PROGRESS_EDIT_MIN_INTERVAL = float(os.getenv("PROGRESS_EDIT_MIN_INTERVAL", "3"))  # Минимальный интервал правок в чате, с
+PROGRESS_EDIT_MAX_INTERVAL = float(os.getenv("PROGRESS_EDIT_MAX_INTERVAL", "30"))  # Максимальный интервал после RetryAfter, с
+TELEGRAM_EDITS_PER_SECOND = float(os.getenv("TELEGRAM_EDITS_PER_SECOND", "20"))  # Общий лимит правок по всем чатам
+
+# Перекодирование изображений перед отправкой в Telegram
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg")  # jpeg, webp или png (без перекодирования)
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "90"))  # Качество сжатия, 1-100
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "0"))  # Максимальная сторона отправляемого фото, px (0 - без уменьшения)
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))  # Процессов для перекодирования
+ORIGINALS_CACHE_MAX_BYTES = int(os.getenv("ORIGINALS_CACHE_MAX_MB", "256")) * 1024 * 1024  # Оригиналы для отправки файлом
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Публичный адрес webhook (пусто - не регистрировать в Telegram)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")  # Пусто - генерируется при запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Одновременных запросов от Telegram
+
+# Плавная остановка и перезапуск без простоя
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "60"))  # Сколько после SIGTERM доделывать задачи в работе, с
+RUN_DIR = os.getenv("RUN_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "run"))  # Файлы состояния процессов для manage_bot.py
+SUPERVISOR_WORKERS = int(os.getenv("SUPERVISOR_WORKERS", "0"))  # Воркеров, которых запускает manage_bot.py supervise
+SUPERVISOR_RESTART_BACKOFF = float(os.getenv("SUPERVISOR_RESTART_BACKOFF", "1"))  # Задержка перед перезапуском упавшего процесса, с (удваивается)
+SUPERVISOR_RESTART_BACKOFF_MAX = float(os.getenv("SUPERVISOR_RESTART_BACKOFF_MAX", "60"))  # Наибольшая задержка перезапуска, с
+
+# Разделение на фронтенд и процессы-воркеры с общей очередью задач
+BOT_ROLE = os.getenv("BOT_ROLE", "standalone").lower()  # standalone - всё в одном процессе, frontend - только приём запросов
+JOB_STORE_BACKEND = os.getenv("JOB_STORE_BACKEND", "sqlite")  # sqlite или module:Class
+JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "bot_jobs.db")  # Файл SQLite с очередью и общими настройками
+SETTINGS_REFRESH_INTERVAL = float(os.getenv("SETTINGS_REFRESH_INTERVAL", "5"))  # Период обновления общих настроек и счётчиков очереди для /metrics, с
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "1"))  # Период опроса очереди воркером, с
+WORKER_HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL", "2"))  # Период отметки и проверки отмен, с
+WORKER_STALE_TIMEOUT = float(os.getenv("WORKER_STALE_TIMEOUT", "60"))  # Через сколько задачи молчащего воркера возвращаются в очередь, с
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # Попыток выполнить задачу разными воркерами
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "3600"))  # Сколько хранить завершённые задачи в общей очереди, с
+
+# Метрики в формате Prometheus
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт эндпоинта /metrics (0 - выключен)
+
+# Снижение качества генерации под нагрузкой (полное качество - DEFAULT_SD_SETTINGS)
+QUALITY_ADAPTIVE_ENABLED = os.getenv("QUALITY_ADAPTIVE_ENABLED", "true").lower() == "true"
+QUALITY_LEVELS = os.getenv("QUALITY_LEVELS", "1024x1024:20,768x768:20,512x512:15")  # Упрощённые уровни: ШxВ:шаги[:сэмплер] через запятую
+QUALITY_QUEUE_THRESHOLD = float(os.getenv("QUALITY_QUEUE_THRESHOLD", "2"))  # Задач в очереди на слот GPU, при которых качество снижается
+QUALITY_LATENCY_SLO = float(os.getenv("QUALITY_LATENCY_SLO", "60"))  # Целевой p95 времени от запроса до ответа, с
+QUALITY_RECOVERY_RATIO = float(os.getenv("QUALITY_RECOVERY_RATIO", "0.5"))  # Доля порогов, ниже которой качество повышается
+QUALITY_ADJUST_INTERVAL = float(os.getenv("QUALITY_ADJUST_INTERVAL", "30"))  # Минимальный интервал между сменами уровня, с
+QUALITY_LATENCY_WINDOW = int(os.getenv("QUALITY_LATENCY_WINDOW", "50"))  # Последних задач для расчёта p95
+
+# Двухэтапная генерация: быстрый черновик, а увеличение и доработка - по кнопкам
+DRAFT_MODE_ENABLED = os.getenv("DRAFT_MODE_ENABLED", "false").lower() == "true"
+DRAFT_LEVEL = os.getenv("DRAFT_LEVEL", "512x512:12")  # Параметры черновика: ШxВ:шаги[:сэмплер]
+DRAFT_CACHE_SIZE = int(os.getenv("DRAFT_CACHE_SIZE", "10000"))  # Черновиков, которые можно улучшить
+REFINE_DENOISING_STRENGTH = float(os.getenv("REFINE_DENOISING_STRENGTH", "0.45"))  # Сила перерисовки при доработке (img2img)
+SD_UPSCALER = os.getenv("SD_UPSCALER", "R-ESRGAN 4x+")  # Апскейлер для /sdapi/v1/extra-single-image
+UPSCALE_FACTOR = float(os.getenv("UPSCALE_FACTOR", "2"))  # Во сколько раз увеличивать черновик
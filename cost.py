@@ -0,0 +1,76 @@
+import logging
+from typing import Dict, Optional, Tuple
+
+from metrics import PREDICTION_RATIO
+
+logger = logging.getLogger(__name__)
+
+
+def payload_work(payload: dict) -> float:
+    """Объём работы запроса txt2img или img2img в мегапиксель-шагах.
+
+    Апскейл без диффузии считается бесплатным и не влияет на оценку скорости.
+    """
+    if "upscaling_resize" in payload:
+        return 0.0
+    megapixels = payload.get("width", 512) * payload.get("height", 512) / 1_000_000
+    steps = payload.get("num_inference_steps", 20)
+    if payload.get("init_images"):
+        # img2img выполняет только долю шагов, пропорциональную denoising_strength
+        steps *= payload.get("denoising_strength", 0.75)
+    images = payload.get("batch_size", 1) * payload.get("n_iter", 1)
+    return megapixels * steps * max(images, 1)
+
+
+class CostModel:
+    """Оценка времени генерации по параметрам запроса.
+
+    Для каждого сервера и сэмплера хранится скользящее среднее скорости в
+    секундах на мегапиксель-шаг, которое уточняется после каждого
+    выполненного запроса. Если для сервера или сэмплера ещё нет данных,
+    используется общая скорость по всем серверам, а до первого запроса -
+    initial_rate. Отношение фактического времени к предсказанному
+    записывается в метрику sd_bot_render_prediction_ratio.
+    """
+
+    def __init__(self, initial_rate: float, alpha: float = 0.2):
+        self.initial_rate = initial_rate
+        self.alpha = alpha
+        self._rates: Dict[Tuple[str, str], float] = {}
+        self._global_rate: Optional[float] = None
+        self.observations = 0
+
+    def rate(self, backend_url: Optional[str] = None, sampler: str = "") -> float:
+        """Секунды на мегапиксель-шаг для сервера (None - в среднем по пулу)."""
+        if backend_url is not None:
+            rate = self._rates.get((backend_url, sampler))
+            if rate is not None:
+                return rate
+            rates = [value for (url, _), value in self._rates.items() if url == backend_url]
+            if rates:
+                return sum(rates) / len(rates)
+        if self._global_rate is not None:
+            return self._global_rate
+        return self.initial_rate
+
+    def predict(self, payload: dict, backend_url: Optional[str] = None) -> float:
+        """Предсказанное время генерации запроса, с."""
+        return payload_work(payload) * self.rate(backend_url, payload.get("scheduler", ""))
+
+    def observe(self, payload: dict, backend_url: str, seconds: float) -> None:
+        """Уточняет скорость сервера по фактическому времени генерации."""
+        work = payload_work(payload)
+        if work <= 0 or seconds <= 0:
+            return
+        predicted = self.predict(payload, backend_url)
+        PREDICTION_RATIO.observe(seconds / predicted, backend=backend_url)
+        rate = seconds / work
+        key = (backend_url, payload.get("scheduler", ""))
+        previous = self._rates.get(key)
+        self._rates[key] = rate if previous is None else (1 - self.alpha) * previous + self.alpha * rate
+        self._global_rate = (rate if self._global_rate is None
+                             else (1 - self.alpha) * self._global_rate + self.alpha * rate)
+        self.observations += 1
+
+    def rates(self) -> Dict[Tuple[str, str], float]:
+        return dict(self._rates)
@@ -0,0 +1,72 @@
+import base64
+import secrets
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from quality import QualityLevel
+
+# Операции над черновиком, доступные по кнопкам
+ACTION_UPSCALE = "upscale"
+ACTION_REFINE = "refine"
+
+
+@dataclass
+class Draft:
+    """Быстрый черновик, который пользователь может увеличить или доработать."""
+    user_id: int
+    prompt: str
+    payload: dict
+    # Пользователь запросил улучшение - черновик оказался нужным
+    used: bool = False
+
+
+class DraftStore:
+    """Параметры последних черновиков по идентификатору задачи (LRU).
+
+    Сами изображения хранятся в OriginalsStore: здесь только параметры
+    генерации, поэтому записей можно держать много.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._drafts: "OrderedDict[str, Draft]" = OrderedDict()
+
+    def put(self, key: str, draft: Draft) -> None:
+        self._drafts[key] = draft
+        self._drafts.move_to_end(key)
+        while len(self._drafts) > self.max_entries:
+            self._drafts.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Draft]:
+        draft = self._drafts.get(key)
+        if draft is not None:
+            self._drafts.move_to_end(key)
+        return draft
+
+    def __len__(self) -> int:
+        return len(self._drafts)
+
+
+def with_fixed_seed(payload: dict) -> dict:
+    """Фиксирует seed черновика, чтобы доработка сохранила композицию."""
+    if payload.get("seed", -1) in (-1, None):
+        payload = dict(payload, seed=secrets.randbelow(2 ** 31))
+    return payload
+
+
+def refine_payload(draft: dict, image: bytes, level: QualityLevel, strength: float) -> dict:
+    """Запрос img2img: черновик перерисовывается в полном качестве с тем же seed."""
+    payload = level.apply(draft)
+    payload["init_images"] = [base64.b64encode(image).decode()]
+    payload["denoising_strength"] = strength
+    return payload
+
+
+def upscale_payload(image: bytes, upscaler: str, factor: float) -> dict:
+    """Запрос /sdapi/v1/extra-single-image: увеличение без новой генерации."""
+    return {
+        "image": base64.b64encode(image).decode(),
+        "upscaler_1": upscaler,
+        "upscaling_resize": factor,
+    }
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Callable, Optional
+
+from metrics import STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from backends import Backend, BackendPool
+    from clients import SDClient
+
+logger = logging.getLogger(__name__)
+
+# Состояния сервера по результатам фоновой проверки
+STATE_UNKNOWN = "unknown"
+STATE_UP = "up"
+STATE_DEGRADED = "degraded"
+STATE_DOWN = "down"
+
+
+class CircuitBreaker:
+    """Автомат защиты сервера от запросов после серии ошибок.
+
+    После failure_threshold ошибок подряд автомат размыкается, и задачи на
+    сервер не направляются. Через reset_timeout секунд он переходит в
+    полуоткрытое состояние и пропускает один пробный запрос: успех замыкает
+    автомат, ошибка снова размыкает его.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allows_request(self) -> bool:
+        """Можно ли сейчас направить запрос на сервер (без побочных эффектов)."""
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._trial_in_flight)
+
+    def on_request(self) -> None:
+        """Отмечает отправку запроса; в полуоткрытом состоянии он становится пробным."""
+        if self.state == self.HALF_OPEN:
+            self._trial_in_flight = True
+
+    def cancel_request(self) -> None:
+        """Отмечает, что запрос не дошёл до сервера и не должен учитываться."""
+        self._trial_in_flight = False
+
+    def record_success(self) -> None:
+        if self.opened_at is not None:
+            logger.info("Автомат защиты замкнут: сервер снова отвечает")
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+
+class HealthChecker:
+    """Периодическая фоновая проверка доступности серверов пула.
+
+    Результат кешируется в самих объектах Backend, поэтому обработчики
+    сообщений проверяют доступность без сетевых запросов. on_recovered
+    вызывается, когда недоступный сервер снова отвечает (например, после
+    перезапуска ему нужен прогрев).
+    """
+
+    def __init__(self, pool: "BackendPool", client: "SDClient", interval: float,
+                 degraded_latency: float, on_recovered: Optional[Callable[["Backend"], None]] = None):
+        self.pool = pool
+        self.on_recovered = on_recovered
+        self.client = client
+        self.interval = interval
+        self.degraded_latency = degraded_latency
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def check(self, backend: "Backend") -> None:
+        """Проверяет один сервер и обновляет его кешированное состояние."""
+        started = time.monotonic()
+        ok = await self.client.check_availability(backend.url)
+        backend.probe_latency = time.monotonic() - started
+        STAGE_SECONDS.observe(backend.probe_latency, stage="health_probe")
+        backend.checked_at = time.monotonic()
+        if not ok:
+            state = STATE_DOWN
+        elif backend.probe_latency > self.degraded_latency or backend.breaker.state != CircuitBreaker.CLOSED:
+            state = STATE_DEGRADED
+        else:
+            state = STATE_UP
+        previous = backend.state
+        backend.state = state
+        if state != previous:
+            logger.info(f"Сервер {backend.url}: состояние {previous} -> {state}")
+            if previous == STATE_DOWN and self.on_recovered is not None:
+                self.on_recovered(backend)
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check(backend) for backend in self.pool.backends),
+                             return_exceptions=True)
+        # Будим ожидающих: серверы могли вернуться в строй, а автоматы - перейти в полуоткрытое состояние
+        self.pool.notify()
+
+    async def _loop(self) -> None:
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки серверов: {e}")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,400 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from scheduler import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+
+
+@dataclass
+class QueuedJob:
+    """Задача генерации в общей очереди между фронтендом и воркерами."""
+    job_id: str
+    user_id: int
+    chat_id: int
+    message_id: int
+    prompt: str
+    caption: str
+    payload: dict
+    status: str = STATUS_QUEUED
+    worker_id: Optional[str] = None
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    # Срок выполнения по time.time(); считается от постановки в очередь, а не от начала работы
+    deadline: Optional[float] = None
+
+
+class JobStore:
+    """Хранилище очереди задач и общих настроек.
+
+    Методы синхронные: из асинхронного кода они вызываются через
+    asyncio.to_thread. Своё хранилище подключается классом вида
+    "module:Class", реализующим этот интерфейс.
+    """
+
+    def enqueue(self, job: QueuedJob, max_queue: int = 0, max_per_user: int = 0) -> int:
+        """Ставит задачу в очередь и возвращает её позицию.
+
+        Если в очереди уже max_queue задач или max_per_user задач этого
+        пользователя (0 - без ограничения), выбрасывает QueueFullError.
+        """
+        raise NotImplementedError
+
+    def claim(self, worker_id: str) -> Optional[QueuedJob]:
+        """Забирает следующую задачу для воркера или возвращает None."""
+        raise NotImplementedError
+
+    def heartbeat(self, worker_id: str) -> None:
+        """Отмечает, что воркер жив и продолжает выполнять свои задачи."""
+        raise NotImplementedError
+
+    def finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    def cancel(self, job_id: str, user_id: Optional[int] = None) -> Optional[str]:
+        """Отменяет задачу и возвращает её прежний статус (None - отменять нечего)."""
+        raise NotImplementedError
+
+    def cancel_user(self, user_id: int) -> List[QueuedJob]:
+        """Отменяет активные задачи пользователя; в status - прежний статус."""
+        raise NotImplementedError
+
+    def statuses(self, job_ids: Iterable[str]) -> Dict[str, str]:
+        raise NotImplementedError
+
+    def requeue(self, worker_id: str, job_id: Optional[str] = None) -> int:
+        """Возвращает в очередь задачи воркера (или одну его задачу)."""
+        raise NotImplementedError
+
+    def expire(self) -> List[QueuedJob]:
+        """Отменяет ожидающие задачи с истёкшим сроком и возвращает их."""
+        raise NotImplementedError
+
+    def requeue_stale(self, timeout: float, max_attempts: int) -> Tuple[int, List[QueuedJob]]:
+        """Возвращает в очередь задачи воркеров, которые перестали отмечаться.
+
+        Задачи, исчерпавшие max_attempts попыток, завершаются с ошибкой.
+        Возвращает число задач, поставленных в очередь заново, и список
+        завершённых с ошибкой, чтобы сообщить о них пользователям.
+        """
+        raise NotImplementedError
+
+    def prune(self, retention: float, max_file_ids: int) -> int:
+        """Удаляет задачи, завершённые раньше retention секунд назад, и старые file_id сверх max_file_ids.
+
+        Возвращает число удалённых задач.
+        """
+        raise NotImplementedError
+
+    def position(self, job_id: str) -> int:
+        raise NotImplementedError
+
+    def put_file_id(self, key: str, file_id: str) -> None:
+        """Запоминает file_id отправленного воркером результата по ключу кеша."""
+        raise NotImplementedError
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def counts(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+    def settings(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def set_setting(self, key: str, value: Any) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteJobStore(JobStore):
+    """Очередь задач и настройки в одном файле SQLite.
+
+    Файл может использоваться несколькими процессами на одной машине:
+    включён режим WAL, а задача забирается одним атомарным UPDATE, поэтому
+    два воркера не получат одну и ту же задачу. Следующей выбирается
+    старейшая задача пользователя, у которого сейчас меньше всего задач в
+    работе; position() считает позицию в том же порядке.
+    """
+
+    _COLUMNS = ("id, user_id, chat_id, message_id, prompt, caption, payload, status, worker_id, attempts, created_at, "
+                "deadline")
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, "
+                         "message_id INTEGER NOT NULL, prompt TEXT NOT NULL, caption TEXT NOT NULL, "
+                         "payload TEXT NOT NULL, status TEXT NOT NULL, worker_id TEXT, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, error TEXT, created_at REAL NOT NULL, "
+                         "started_at REAL, heartbeat_at REAL, finished_at REAL, deadline REAL)")
+        # Файлы очереди, созданные до появления срока задачи
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+        if "deadline" not in columns:
+            self._db.execute("ALTER TABLE jobs ADD COLUMN deadline REAL")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT NOT NULL, "
+                         "created_at REAL NOT NULL)")
+
+    @staticmethod
+    def _row_to_job(row) -> QueuedJob:
+        return QueuedJob(job_id=row[0], user_id=row[1], chat_id=row[2], message_id=row[3], prompt=row[4],
+                         caption=row[5], payload=json.loads(row[6]), status=row[7], worker_id=row[8],
+                         attempts=row[9], created_at=row[10], deadline=row[11])
+
+    def enqueue(self, job: QueuedJob, max_queue: int = 0, max_per_user: int = 0) -> int:
+        with self._lock:
+            # Проверка лимитов и вставка в одной транзакции: фронтендов может быть несколько
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                queued, user_queued = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(user_id = ?), 0) FROM jobs WHERE status = ?",
+                    (job.user_id, STATUS_QUEUED)).fetchone()
+                if max_queue and queued >= max_queue:
+                    raise QueueFullError("Общая очередь переполнена")
+                if max_per_user and user_queued >= max_per_user:
+                    raise QueueFullError("Слишком много запросов от пользователя в очереди")
+                self._db.execute(f"INSERT INTO jobs ({self._COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (job.job_id, job.user_id, job.chat_id, job.message_id, job.prompt, job.caption,
+                                  json.dumps(job.payload, ensure_ascii=False), STATUS_QUEUED, None, job.attempts,
+                                  job.created_at, job.deadline))
+            finally:
+                self._db.execute("COMMIT")
+        return self.position(job.job_id)
+
+    def claim(self, worker_id: str) -> Optional[QueuedJob]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "UPDATE jobs SET status = ?, worker_id = ?, started_at = ?, heartbeat_at = ?, "
+                "attempts = attempts + 1 "
+                "WHERE id = (SELECT j.id FROM jobs j WHERE j.status = ? AND (j.deadline IS NULL OR j.deadline > ?) "
+                "ORDER BY (SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = ?), j.created_at "
+                "LIMIT 1) AND status = ? "
+                f"RETURNING {self._COLUMNS}",
+                (STATUS_RUNNING, worker_id, now, now, STATUS_QUEUED, now, STATUS_RUNNING, STATUS_QUEUED),
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def heartbeat(self, worker_id: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE jobs SET heartbeat_at = ? WHERE worker_id = ? AND status = ?",
+                             (time.time(), worker_id, STATUS_RUNNING))
+
+    def finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        # Отменённую задачу не перезаписываем результатом воркера
+        with self._lock:
+            self._db.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = ?",
+                             (status, error, time.time(), job_id, STATUS_RUNNING))
+
+    def cancel(self, job_id: str, user_id: Optional[int] = None) -> Optional[str]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute("SELECT status, user_id FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                if (row is None or row[0] not in (STATUS_QUEUED, STATUS_RUNNING)
+                        or (user_id is not None and row[1] != user_id)):
+                    return None
+                self._db.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE id = ?",
+                                 (STATUS_CANCELLED, time.time(), job_id))
+                return row[0]
+            finally:
+                self._db.execute("COMMIT")
+
+    def cancel_user(self, user_id: int) -> List[QueuedJob]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(f"SELECT {self._COLUMNS} FROM jobs WHERE user_id = ? AND status IN (?, ?)",
+                                        (user_id, STATUS_QUEUED, STATUS_RUNNING)).fetchall()
+                self._db.execute("UPDATE jobs SET status = ?, finished_at = ? WHERE user_id = ? AND status IN (?, ?)",
+                                 (STATUS_CANCELLED, time.time(), user_id, STATUS_QUEUED, STATUS_RUNNING))
+            finally:
+                self._db.execute("COMMIT")
+        return [self._row_to_job(row) for row in rows]
+
+    def statuses(self, job_ids: Iterable[str]) -> Dict[str, str]:
+        job_ids = list(job_ids)
+        if not job_ids:
+            return {}
+        with self._lock:
+            rows = self._db.execute(f"SELECT id, status FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))})",
+                                    job_ids).fetchall()
+        return dict(rows)
+
+    def requeue(self, worker_id: str, job_id: Optional[str] = None) -> int:
+        query = ("UPDATE jobs SET status = ?, worker_id = NULL, attempts = MAX(attempts - 1, 0) "
+                 "WHERE worker_id = ? AND status = ?")
+        params = [STATUS_QUEUED, worker_id, STATUS_RUNNING]
+        if job_id is not None:
+            query += " AND id = ?"
+            params.append(job_id)
+        with self._lock:
+            cursor = self._db.execute(query, params)
+        return cursor.rowcount
+
+    def expire(self) -> List[QueuedJob]:
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                                    "WHERE status = ? AND deadline <= ? "
+                                    f"RETURNING {self._COLUMNS}",
+                                    (STATUS_CANCELLED, "expired", now, STATUS_QUEUED, now)).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def requeue_stale(self, timeout: float, max_attempts: int) -> Tuple[int, List[QueuedJob]]:
+        deadline = time.time() - timeout
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(f"SELECT {self._COLUMNS} FROM jobs "
+                                        "WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+                                        (STATUS_RUNNING, deadline, max_attempts)).fetchall()
+                self._db.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? "
+                                 "WHERE status = ? AND heartbeat_at < ? AND attempts >= ?",
+                                 (STATUS_FAILED, "воркер не отвечает", time.time(), STATUS_RUNNING, deadline,
+                                  max_attempts))
+                cursor = self._db.execute("UPDATE jobs SET status = ?, worker_id = NULL "
+                                          "WHERE status = ? AND heartbeat_at < ?",
+                                          (STATUS_QUEUED, STATUS_RUNNING, deadline))
+            finally:
+                self._db.execute("COMMIT")
+        return cursor.rowcount, [self._row_to_job(row) for row in rows]
+
+    def position(self, job_id: str) -> int:
+        # Порядок тот же, что у claim(): k-я ожидающая задача пользователя будет взята, когда у него
+        # в работе окажется (уже выполняющиеся + k) задач, при равенстве раньше идёт старшая задача
+        with self._lock:
+            row = self._db.execute(
+                "WITH ranked AS (SELECT j.id, j.created_at, "
+                "(SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = ?) "
+                "+ ROW_NUMBER() OVER (PARTITION BY j.user_id ORDER BY j.created_at) AS turn "
+                "FROM jobs j WHERE j.status = ?) "
+                "SELECT COUNT(*) FROM ranked o, ranked t WHERE t.id = ? "
+                "AND (o.turn < t.turn OR (o.turn = t.turn AND o.created_at <= t.created_at))",
+                (STATUS_RUNNING, STATUS_QUEUED, job_id)).fetchone()
+        return row[0]
+
+    def prune(self, retention: float, max_file_ids: int) -> int:
+        with self._lock:
+            cursor = self._db.execute("DELETE FROM jobs WHERE finished_at < ? AND status IN (?, ?, ?)",
+                                      (time.time() - retention, STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED))
+            file_ids = self._db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+            if file_ids > max_file_ids:
+                self._db.execute("DELETE FROM file_ids WHERE key IN "
+                                 "(SELECT key FROM file_ids ORDER BY created_at LIMIT ?)",
+                                 (file_ids - max_file_ids,))
+        return cursor.rowcount
+
+    def put_file_id(self, key: str, file_id: str) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO file_ids (key, file_id, created_at) VALUES (?, ?, ?)",
+                             (key, file_id, time.time()))
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT file_id FROM file_ids WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+            workers = self._db.execute("SELECT COUNT(DISTINCT worker_id) FROM jobs WHERE status = ?",
+                                       (STATUS_RUNNING,)).fetchone()[0]
+        counts = dict(rows)
+        counts["workers"] = workers
+        return counts
+
+    def settings(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM settings").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set_setting(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                             (key, json.dumps(value, ensure_ascii=False)))
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def create_job_store(name: str, path: str) -> JobStore:
+    """Создаёт хранилище очереди по имени из конфигурации: "sqlite" или "module:Class"."""
+    if name == "sqlite":
+        return SQLiteJobStore(path)
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class SharedSettings:
+    """Общие настройки всех процессов бота с периодическим обновлением.
+
+    Значения читаются из локальной копии; раз в interval секунд копия
+    сверяется с хранилищем, и для изменившихся ключей вызывается on_change.
+    Заодно обновляются счётчики задач по статусам (counts), чтобы /metrics
+    не обращался к хранилищу из цикла событий.
+    """
+
+    def __init__(self, store: JobStore, interval: float, on_change: Callable[[str, Any], None]):
+        self.store = store
+        self.interval = interval
+        self.on_change = on_change
+        self._values: Dict[str, Any] = {}
+        self.counts: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._values.get(key, default)
+
+    async def set(self, key: str, value: Any) -> None:
+        await asyncio.to_thread(self.store.set_setting, key, value)
+        self._values[key] = value
+
+    async def refresh(self) -> None:
+        values = await asyncio.to_thread(self.store.settings)
+        for key, value in values.items():
+            if self._values.get(key) != value:
+                self._values[key] = value
+                self.on_change(key, value)
+        self.counts = await asyncio.to_thread(self.store.counts)
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Не удалось обновить общие настройки: {e}")
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from typing import Awaitable, Callable, Optional, Sequence
+
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+# Состояния процесса бота в файле состояния
+STATE_STARTING = "starting"
+STATE_STANDBY = "standby"
+STATE_RUNNING = "running"
+STATE_DRAINING = "draining"
+
+
+def state_path(run_dir: str, kind: str, pid: int) -> str:
+    return os.path.join(run_dir, f"{kind}-{pid}.state")
+
+
+def read_state(path: str) -> Optional[dict]:
+    """Содержимое файла состояния (None - файла нет или он не дописан)."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class InstanceState:
+    """Файл состояния процесса в run_dir: PID, время запуска, состояние и счётчики.
+
+    Файлы kind-PID.state служат PID-файлами: по ним manage_bot.py находит
+    процессы бота и воркеров, не обходя все процессы системы, узнаёт, что
+    новый экземпляр готов, а старый перестал получать обновления, и
+    показывает число выполненных задач. По времени создания файла можно
+    отличить процесс от чужого, запущенного позже с тем же PID.
+    """
+
+    def __init__(self, run_dir: str, kind: str = "bot"):
+        self.run_dir = run_dir
+        self.kind = kind
+        self.path = state_path(run_dir, kind, os.getpid())
+        self.fields = {"pid": os.getpid(), "started_at": time.time()}
+
+    def set(self, state: Optional[str] = None, **fields) -> None:
+        """Обновляет состояние и счётчики процесса и переписывает файл."""
+        if state is not None:
+            self.fields["state"] = state
+        self.fields.update(fields)
+        os.makedirs(self.run_dir, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.fields, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Lifecycle:
+    """Запуск приложения Telegram и плавная остановка по SIGTERM или SIGINT.
+
+    При остановке процесс сразу перестаёт получать обновления, обрабатывает
+    уже полученные и ждёт завершения обработчиков не дольше drain_timeout
+    секунд. В начале ожидания вызывается on_drain(deadline), по истечении
+    срока - on_deadline(), после чего оставшиеся обработчики должны быстро
+    завершиться. Повторный сигнал сокращает ожидание до нуля.
+
+    В режиме standby приложение запускается, дожидается prepare() (например,
+    прогрева серверов) и начинает получать обновления только по SIGUSR1. Так manage_bot.py
+    выполняет перезапуск без простоя: новый экземпляр готовится, пока
+    работает старый, и принимает обновления сразу после того, как старый
+    перестал их получать.
+    """
+
+    def __init__(self, drain_timeout: float, state: Optional[InstanceState] = None,
+                 on_drain: Optional[Callable[[float], None]] = None,
+                 on_deadline: Optional[Callable[[], None]] = None,
+                 prepare: Optional[Callable[[], Awaitable[None]]] = None):
+        self.drain_timeout = drain_timeout
+        self.state = state
+        self.on_drain = on_drain
+        self.on_deadline = on_deadline
+        self.prepare = prepare
+        self._stop: Optional[asyncio.Event] = None
+        self._force: Optional[asyncio.Event] = None
+        self._release: Optional[asyncio.Event] = None
+
+    @property
+    def draining(self) -> bool:
+        return self._stop is not None and self._stop.is_set()
+
+    def request_stop(self) -> None:
+        """Начинает плавную остановку, а при повторном вызове - прерывает ожидание."""
+        if self._stop is None:
+            return
+        if self._stop.is_set():
+            if not self._force.is_set():
+                logger.warning("Повторный сигнал остановки: ожидание задач прерывается")
+                self._force.set()
+            return
+        logger.info("Получен сигнал остановки, бот перестаёт принимать обновления...")
+        self._stop.set()
+
+    def _set_state(self, state: str) -> None:
+        if self.state is None:
+            return
+        try:
+            self.state.set(state)
+        except OSError as e:
+            logger.warning(f"Не удалось записать файл состояния {self.state.path}: {e}")
+
+    async def run(self, application: Application, start_receiving: Callable[[], Awaitable[None]],
+                  stop_receiving: Callable[[], Awaitable[None]], standby: bool = False) -> None:
+        """Выполняет приложение до сигнала остановки и плавно завершает его."""
+        self._stop = asyncio.Event()
+        self._force = asyncio.Event()
+        self._release = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except NotImplementedError:
+                pass
+        try:
+            loop.add_signal_handler(signal.SIGUSR1, self._release.set)
+        except (AttributeError, NotImplementedError):
+            # SIGUSR1 нет в Windows: режим standby там недоступен
+            standby = False
+
+        self._set_state(STATE_STARTING)
+        await application.initialize()
+        try:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            if standby:
+                if self.prepare:
+                    await self.prepare()
+                self._set_state(STATE_STANDBY)
+                logger.info("Бот готов и начнёт получать обновления по сигналу SIGUSR1")
+                await self._wait_any(self._release, self._stop)
+            if not self._stop.is_set():
+                await start_receiving()
+                self._set_state(STATE_RUNNING)
+                await self._stop.wait()
+                await stop_receiving()
+            self._set_state(STATE_DRAINING)
+            await self._drain(application)
+        finally:
+            if application.running:
+                await application.stop()
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+            if self.state is not None:
+                self.state.remove()
+
+    async def _drain(self, application: Application) -> None:
+        # Application.stop() отбрасывает необработанные обновления, поэтому
+        # сначала дожидаемся, пока все полученные обновления уйдут в обработку
+        while not application.update_queue.empty():
+            await asyncio.sleep(0.05)
+        deadline = time.monotonic() + self.drain_timeout
+        logger.info(f"Завершение обработки запросов (не дольше {self.drain_timeout:.0f} с)...")
+        if self.on_drain:
+            self.on_drain(deadline)
+        stopping = asyncio.create_task(application.stop())
+        forced = asyncio.create_task(self._force.wait())
+        try:
+            await asyncio.wait({stopping, forced}, timeout=self.drain_timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            forced.cancel()
+        if not stopping.done():
+            logger.warning("Плавная остановка не уложилась в срок, оставшиеся задачи отменяются")
+            if self.on_deadline:
+                self.on_deadline()
+        await stopping
+        logger.info("Обработка запросов завершена")
+
+    @staticmethod
+    async def _wait_any(*events: asyncio.Event) -> None:
+        waiters = [asyncio.create_task(event.wait()) for event in events]
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+
+async def serve_polling(application: Application, lifecycle: Lifecycle, allowed_updates: Sequence[str],
+                        standby: bool = False) -> None:
+    """Запускает приложение в режиме polling с плавной остановкой."""
+
+    def error_callback(error) -> None:
+        # Ошибки getUpdates передаются обработчику ошибок приложения, как в run_polling
+        application.create_task(application.process_error(error=error, update=None))
+
+    async def start_receiving() -> None:
+        await application.updater.start_polling(allowed_updates=list(allowed_updates),
+                                                error_callback=error_callback)
+
+    await lifecycle.run(application, start_receiving, application.updater.stop, standby)
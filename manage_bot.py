@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import glob
 import os
 import sys
 import signal
-import subprocess
 import logging
 import time
 import psutil
 
+from config import (DRAIN_TIMEOUT, RUN_DIR, SD_WARMUP_TIMEOUT, SUPERVISOR_WORKERS, SUPERVISOR_RESTART_BACKOFF,
+                    SUPERVISOR_RESTART_BACKOFF_MAX, METRICS_PORT)
+from lifecycle import (InstanceState, STATE_DRAINING, STATE_RUNNING, STATE_STANDBY, STATE_STARTING, read_state,
+                       state_path)
+
 # Настройка логирования
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,23 +21,57 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Желаемое число воркеров для супервизора, записывается командой scale
+DESIRED_WORKERS_PATH = os.path.join(RUN_DIR, 'workers.desired')
+
+def find_processes(kind):
+    """Находит процессы вида kind (bot, worker, supervisor) по их файлам состояния.
+    
+    Каждый процесс сам ведёт файл RUN_DIR/kind-PID.state, поэтому поиск
+    занимает O(числа процессов бота), а не O(всех процессов системы).
+    Файлы завершившихся процессов удаляются. Возвращает пары (процесс, содержимое файла).
+    """
+    found = []
+    for path in glob.glob(os.path.join(RUN_DIR, f'{kind}-*.state')):
+        info = read_state(path)
+        if info is None:
+            continue
+        try:
+            proc = psutil.Process(info['pid'])
+            # Процесс, запущенный позже файла, получил PID завершившегося процесса бота
+            alive = proc.create_time() <= info['started_at'] + 1 and proc.status() != psutil.STATUS_ZOMBIE
+        except (KeyError, psutil.NoSuchProcess, psutil.AccessDenied):
+            alive = False
+        if not alive:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        found.append((proc, info))
+    return found
+
 def find_bot_processes():
     """Находит все запущенные процессы бота."""
-    bot_processes = []
-    for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-        try:
-            # Проверяем, что это процесс Python, запускающий bot.py
-            if proc.info['name'] == 'python' or proc.info['name'] == 'python3':
-                cmdline = proc.info['cmdline']
-                if cmdline and any('bot.py' in cmd for cmd in cmdline):
-                    bot_processes.append(proc)
-        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-            pass
-    return bot_processes
+    return [proc for proc, _ in find_processes('bot')]
+
+def find_supervisor():
+    """Возвращает процесс работающего супервизора или None."""
+    supervisors = find_processes('supervisor')
+    return supervisors[0][0] if supervisors else None
 
 def stop_bot():
-    """Останавливает все запущенные экземпляры бота."""
-    bot_processes = find_bot_processes()
+    """Останавливает все запущенные экземпляры бота и воркеров."""
+    supervisor = find_supervisor()
+    if supervisor is not None:
+        # Супервизор сам плавно остановит свои процессы
+        logger.info(f"Останавливаю супервизор с PID {supervisor.pid}...")
+        supervisor.terminate()
+        wait_for_exit([supervisor], DRAIN_TIMEOUT + 30)
+    
+    bot_processes = find_bot_processes() + [proc for proc, _ in find_processes('worker')]
     
     if not bot_processes:
         logger.info("Не найдено запущенных экземпляров бота.")
@@ -47,19 +86,62 @@ def stop_bot():
         except Exception as e:
             logger.error(f"Ошибка при остановке процесса {proc.pid}: {e}")
     
-    # Даем процессам время на корректное завершение
-    time.sleep(2)
+    wait_for_exit(bot_processes)
+    logger.info("Все экземпляры бота остановлены.")
+
+def wait_for_exit(processes, timeout=None):
+    """Ждёт завершения процессов после SIGTERM и принудительно завершает оставшиеся."""
+    # По SIGTERM бот доделывает задачи в работе не дольше DRAIN_TIMEOUT секунд
+    if timeout is None:
+        timeout = DRAIN_TIMEOUT + 10
+    logger.info(f"Ожидаю завершения задач в работе (не дольше {timeout:.0f} с)...")
+    _, alive = psutil.wait_procs(processes, timeout=timeout)
     
     # Проверяем, остались ли процессы, и принудительно завершаем их
-    for proc in bot_processes:
+    for proc in alive:
         try:
-            if proc.is_running():
-                logger.warning(f"Процесс {proc.pid} все еще работает. Принудительное завершение...")
-                proc.kill()
+            logger.warning(f"Процесс {proc.pid} все еще работает. Принудительное завершение...")
+            proc.kill()
         except Exception as e:
             logger.error(f"Ошибка при принудительном завершении процесса {proc.pid}: {e}")
+
+def process_state(proc):
+    """Состояние процесса бота по его файлу состояния; None - процесс завершился."""
+    try:
+        if proc.status() == psutil.STATUS_ZOMBIE:
+            return None
+    except psutil.NoSuchProcess:
+        return None
+    info = read_state(state_path(RUN_DIR, 'bot', proc.pid)) or {}
+    return info.get('state', STATE_STARTING)
+
+def spawn(script, *args, env=None):
+    """Запускает процесс бота или воркера в фоновом режиме и возвращает его.
     
-    logger.info("Все экземпляры бота остановлены.")
+    env - переменные окружения процесса (по умолчанию - как у manage_bot.py).
+    """
+    script_path = os.path.join(BASE_DIR, script)
+    
+    # Создаем лог-файл для вывода процесса: bot.log или worker.log
+    log_file_path = os.path.join(BASE_DIR, f"{os.path.splitext(script)[0]}.log")
+    log_file = open(log_file_path, 'a')
+    
+    # Запускаем процесс
+    process = psutil.Popen(
+        [sys.executable, script_path, *args],
+        stdout=log_file,
+        stderr=log_file,
+        start_new_session=True,
+        env=env
+    )
+    log_file.close()
+    
+    logger.info(f"Запущен {script} с PID {process.pid}. Вывод перенаправлен в {log_file_path}")
+    return process
+
+def spawn_bot(*args):
+    """Запускает процесс бота в фоновом режиме и возвращает его."""
+    return spawn('bot.py', *args)
 
 def start_bot():
     """Запускает бота в фоновом режиме."""
@@ -75,55 +157,435 @@ def start_bot():
             return
     
     try:
-        # Запускаем бота в фоновом режиме
-        bot_script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
-        
-        # Создаем лог-файл для вывода бота
-        log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.log')
-        log_file = open(log_file_path, 'a')
-        
-        # Запускаем процесс
-        process = subprocess.Popen(
-            [sys.executable, bot_script_path],
-            stdout=log_file,
-            stderr=log_file,
-            start_new_session=True
-        )
-        
-        logger.info(f"Бот запущен с PID {process.pid}. Вывод перенаправлен в {log_file_path}")
+        spawn_bot()
     except Exception as e:
         logger.error(f"Ошибка при запуске бота: {e}")
 
+class HandOver:
+    """Передача приёма обновлений от прежних экземпляров бота новому.
+    
+    Новый экземпляр должен быть запущен с ключом --standby. Когда он
+    подготовился к работе, прежние получают SIGTERM и перестают получать
+    обновления, после чего новый по SIGUSR1 начинает их получать. Прежние
+    экземпляры тем временем доделывают задачи в работе.
+    
+    Передача не блокирует: step() продвигает её на один шаг и возвращает
+    None, пока она идёт, - так супервизор продолжает следить за остальными
+    процессами. False означает, что новый экземпляр не подготовился: он
+    останавливается, а прежние продолжают работу.
+    """
+    
+    def __init__(self, old_processes, new_process):
+        self.old_processes = old_processes
+        self.new_process = new_process
+        self.phase = STATE_STANDBY
+        self.deadline = time.monotonic() + SD_WARMUP_TIMEOUT + 60
+        logger.info("Ожидаю готовности нового экземпляра...")
+    
+    def step(self):
+        now = time.monotonic()
+        if self.phase == STATE_STANDBY:
+            state = process_state(self.new_process)
+            if state is None or (state != STATE_STANDBY and now >= self.deadline):
+                logger.error("Новый экземпляр не подготовился к работе, перезапуск отменен. Подробности в bot.log")
+                if state is not None:
+                    self.new_process.terminate()
+                return False
+            if state != STATE_STANDBY:
+                return None
+            for proc in self.old_processes:
+                try:
+                    logger.info(f"Останавливаю прежний процесс с PID {proc.pid}...")
+                    proc.terminate()
+                except Exception as e:
+                    logger.error(f"Ошибка при остановке процесса {proc.pid}: {e}")
+            self.phase = STATE_DRAINING
+            self.deadline = now + 60
+            return None
+        if self.phase == STATE_DRAINING:
+            # Новый экземпляр начинает получать обновления, только когда старые перестали
+            waiting = [proc for proc in self.old_processes if process_state(proc) not in (STATE_DRAINING, None)]
+            if waiting and now < self.deadline:
+                return None
+            for proc in waiting:
+                logger.warning(f"Процесс {proc.pid} не сообщил о прекращении приема обновлений")
+            self.new_process.send_signal(signal.SIGUSR1)
+            self.phase = STATE_RUNNING
+            self.deadline = now + 60
+            return None
+        state = process_state(self.new_process)
+        if state == STATE_RUNNING:
+            logger.info(f"Новый экземпляр с PID {self.new_process.pid} принимает запросы.")
+            return True
+        if state is None or now >= self.deadline:
+            logger.error(f"Новый экземпляр с PID {self.new_process.pid} не начал принимать запросы. "
+                         f"Подробности в bot.log")
+            return True
+        return None
+
+def hand_over(old_processes, new_process):
+    """Выполняет HandOver до конца; возвращает False, если новый экземпляр не подготовился."""
+    handover = HandOver(old_processes, new_process)
+    while True:
+        result = handover.step()
+        if result is not None:
+            return result
+        time.sleep(0.5)
+
+def restart_bot():
+    """Перезапускает бота без простоя.
+    
+    Новый экземпляр запускается в режиме standby и готовится к работе
+    (прогревает серверы), пока старый обрабатывает запросы, затем приём
+    обновлений передаётся ему (см. hand_over). Если работает супервизор,
+    перезапуск выполняет он.
+    """
+    supervisor = find_supervisor()
+    if supervisor is not None:
+        logger.info(f"Перезапуск процессов выполнит супервизор с PID {supervisor.pid}, подробности в его выводе.")
+        supervisor.send_signal(signal.SIGUSR1)
+        return
+    
+    old_processes = find_bot_processes()
+    if not old_processes:
+        logger.info("Не найдено запущенных экземпляров бота, выполняю обычный запуск.")
+        start_bot()
+        return
+    
+    try:
+        new_process = spawn_bot('--standby')
+    except Exception as e:
+        logger.error(f"Ошибка при запуске бота: {e}")
+        return
+    
+    if hand_over(old_processes, new_process):
+        wait_for_exit(old_processes)
+        logger.info("Перезапуск завершен.")
+
+class Child:
+    """Процесс, за которым следит супервизор."""
+
+    def __init__(self, name, script):
+        self.name = name
+        self.script = script
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.restart_at = 0.0
+
+class Supervisor:
+    """Запускает бота и воркеров и перезапускает упавшие процессы.
+
+    Упавший процесс перезапускается с задержкой, которая удваивается после
+    каждого падения подряд (от SUPERVISOR_RESTART_BACKOFF до
+    SUPERVISOR_RESTART_BACKOFF_MAX секунд) и сбрасывается, если процесс
+    проработал дольше наибольшей задержки. Управление - сигналами:
+    SIGTERM и SIGINT плавно останавливают все процессы, SIGHUP применяет
+    число воркеров из DESIRED_WORKERS_PATH (команда scale), SIGUSR1
+    перезапускает процессы без простоя (команда restart).
+    
+    Если воркеров больше нуля, бот запускается с BOT_ROLE=frontend и только
+    ставит задачи в общую очередь, а воркеры - с BOT_ROLE=standalone, даже
+    если в окружении или .env задано другое. При переходе между нулём и
+    ненулевым числом воркеров бот перезапускается без простоя в новой роли.
+    
+    Если задан METRICS_PORT, бот отдаёт метрики на нём, а воркер номер N -
+    на порту METRICS_PORT + 1 + N.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.children = {'bot': Child('bot', 'bot.py')}
+        # Процессы, которые доделывают задачи после SIGTERM: (процесс, срок принудительного завершения)
+        self.retiring = []
+        # Идущая передача приёма обновлений новому экземпляру бота
+        self.handover = None
+        self.state = InstanceState(RUN_DIR, 'supervisor')
+        self._stopping = False
+        self._rescale = False
+        self._restart = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_rescale)
+        signal.signal(signal.SIGUSR1, self._on_restart)
+        self.scale(self.workers)
+        logger.info(f"Супервизор запущен с PID {os.getpid()}, воркеров: {self.workers}")
+        try:
+            while not self._stopping:
+                if self._rescale:
+                    self._rescale = False
+                    self.scale(read_desired_workers(self.workers))
+                if self._restart:
+                    self._restart = False
+                    self.restart()
+                self.advance_handover()
+                self.check_children()
+                self.reap_retiring()
+                time.sleep(0.5)
+        finally:
+            self.shutdown()
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_rescale(self, signum, frame):
+        self._rescale = True
+
+    def _on_restart(self, signum, frame):
+        self._restart = True
+
+    def _report(self):
+        self.state.set(STATE_RUNNING, workers=self.workers)
+
+    def child_env(self, child):
+        """Окружение процесса: роль бота зависит от того, есть ли воркеры."""
+        role = 'standalone' if child.script == 'worker.py' or not self.workers else 'frontend'
+        return {**os.environ, 'BOT_ROLE': role}
+
+    def child_args(self, child):
+        """Аргументы процесса: каждому воркеру - свой порт метрик."""
+        if child.script != 'worker.py':
+            return []
+        slot = int(child.name.rsplit('-', 1)[1])
+        return ['--metrics-port', str(METRICS_PORT + 1 + slot if METRICS_PORT else 0)]
+
+    def scale(self, workers):
+        """Доводит число воркеров до workers; лишние воркеры доделывают задачи и завершаются."""
+        role_changed = (workers > 0) != (self.workers > 0)
+        for slot in range(workers):
+            name = f'worker-{slot}'
+            if name not in self.children:
+                self.children[name] = Child(name, 'worker.py')
+        for slot in range(workers, self.workers):
+            child = self.children.pop(f'worker-{slot}', None)
+            if child is not None and child.process is not None:
+                logger.info(f"Останавливаю лишний воркер {child.name} (PID {child.process.pid})...")
+                self.retire(child.process)
+        if workers != self.workers:
+            logger.info(f"Число воркеров: {self.workers} -> {workers}")
+        self.workers = workers
+        self._report()
+        if role_changed and self.children['bot'].process is not None:
+            logger.info("Роль бота изменилась, перезапускаю его")
+            self.restart_bot()
+
+    def start(self, child, *args):
+        try:
+            child.process = spawn(child.script, *self.child_args(child), *args, env=self.child_env(child))
+        except Exception as e:
+            logger.error(f"Ошибка при запуске {child.name}: {e}")
+            self.schedule_restart(child, time.monotonic())
+            return
+        child.started_at = time.monotonic()
+
+    def schedule_restart(self, child, now):
+        # Процесс, проработавший дольше наибольшей задержки, падает не подряд
+        if now - child.started_at >= SUPERVISOR_RESTART_BACKOFF_MAX:
+            child.failures = 0
+        delay = min(SUPERVISOR_RESTART_BACKOFF * 2 ** child.failures, SUPERVISOR_RESTART_BACKOFF_MAX)
+        child.failures += 1
+        child.restart_at = now + delay
+        return delay
+
+    def check_children(self):
+        """Запускает недостающие процессы и планирует перезапуск завершившихся."""
+        now = time.monotonic()
+        for child in self.children.values():
+            if child.name == 'bot' and self.handover is not None:
+                # Бот сейчас подменяется, его процессами занимается advance_handover
+                continue
+            if child.process is None:
+                if now >= child.restart_at:
+                    self.start(child)
+                continue
+            code = child.process.poll()
+            if code is None:
+                continue
+            pid = child.process.pid
+            child.process = None
+            child.restarts += 1
+            delay = self.schedule_restart(child, now)
+            logger.warning(f"Процесс {child.name} (PID {pid}) завершился с кодом {code}, "
+                           f"перезапуск через {delay:.1f} с")
+
+    def retire(self, process):
+        try:
+            process.terminate()
+        except psutil.NoSuchProcess:
+            return
+        self.retiring.append((process, time.monotonic() + DRAIN_TIMEOUT + 10))
+
+    def reap_retiring(self):
+        now = time.monotonic()
+        still_running = []
+        for process, kill_at in self.retiring:
+            if process.poll() is not None:
+                continue
+            if now >= kill_at:
+                logger.warning(f"Процесс {process.pid} все еще работает. Принудительное завершение...")
+                process.kill()
+            still_running.append((process, kill_at))
+        self.retiring = still_running
+
+    def restart(self):
+        """Перезапускает бота и воркеров без простоя.
+
+        Бот передаёт приём обновлений новому экземпляру (см. HandOver),
+        каждому воркеру сначала запускается замена, затем прежний доделывает
+        задачи и завершается: очередь общая, поэтому задачи не теряются.
+        """
+        logger.info("Перезапуск процессов без простоя...")
+        self.restart_bot()
+        for child in self.children.values():
+            if child.name == 'bot' or child.process is None:
+                continue
+            old_process = child.process
+            self.start(child)
+            self.retire(old_process)
+
+    def restart_bot(self):
+        """Начинает подмену бота новым экземпляром; её продвигает advance_handover."""
+        bot_child = self.children['bot']
+        if self.handover is not None:
+            logger.warning("Перезапуск бота уже идет")
+            return
+        if bot_child.process is None or bot_child.process.poll() is not None:
+            # Бот не работает - его и так запустит check_children
+            return
+        try:
+            new_process = spawn(bot_child.script, '--standby', env=self.child_env(bot_child))
+        except Exception as e:
+            logger.error(f"Ошибка при запуске бота: {e}")
+            return
+        self.handover = HandOver([bot_child.process], new_process)
+
+    def advance_handover(self):
+        if self.handover is None:
+            return
+        result = self.handover.step()
+        if result is None:
+            return
+        handover, self.handover = self.handover, None
+        kill_at = time.monotonic() + DRAIN_TIMEOUT + 10
+        if result:
+            # SIGTERM прежнему экземпляру уже отправлен в HandOver
+            bot_child = self.children['bot']
+            bot_child.process = handover.new_process
+            bot_child.started_at = time.monotonic()
+            self.retiring.extend((process, kill_at) for process in handover.old_processes)
+            logger.info("Перезапуск бота завершен.")
+        else:
+            self.retiring.append((handover.new_process, kill_at))
+
+    def shutdown(self):
+        """Плавно останавливает все процессы и удаляет файлы супервизора."""
+        logger.info("Супервизор останавливает процессы...")
+        processes = [process for process, _ in self.retiring]
+        if self.handover is not None:
+            self.handover.new_process.terminate()
+            processes.append(self.handover.new_process)
+        for child in self.children.values():
+            if child.process is not None:
+                try:
+                    child.process.terminate()
+                except psutil.NoSuchProcess:
+                    continue
+                processes.append(child.process)
+        wait_for_exit(processes)
+        self.state.remove()
+        try:
+            os.remove(DESIRED_WORKERS_PATH)
+        except OSError:
+            pass
+        logger.info("Супервизор остановлен.")
+
+def read_desired_workers(default):
+    try:
+        with open(DESIRED_WORKERS_PATH) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+def supervise(workers):
+    """Запускает супервизор в текущем процессе (например, под systemd или nohup)."""
+    supervisor = find_supervisor()
+    if supervisor is not None:
+        logger.error(f"Супервизор уже запущен с PID {supervisor.pid}.")
+        return
+    if find_bot_processes():
+        logger.error("Бот уже запущен без супервизора. Остановите его командой stop.")
+        return
+    os.makedirs(RUN_DIR, exist_ok=True)
+    with open(DESIRED_WORKERS_PATH, 'w') as f:
+        f.write(str(workers))
+    Supervisor(workers).run()
+
+def scale_workers(workers):
+    """Меняет число воркеров у работающего супервизора."""
+    supervisor = find_supervisor()
+    if supervisor is None:
+        logger.error("Супервизор не запущен. Запустите его командой supervise.")
+        return
+    with open(DESIRED_WORKERS_PATH, 'w') as f:
+        f.write(str(workers))
+    supervisor.send_signal(signal.SIGHUP)
+    logger.info(f"Супервизору с PID {supervisor.pid} отправлен запрос: воркеров {workers}.")
+
+def format_uptime(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
 def check_status():
-    """Проверяет статус запущенных экземпляров бота."""
-    bot_processes = find_bot_processes()
+    """Проверяет статус запущенных процессов бота, воркеров и супервизора."""
+    processes = [(kind, proc, info) for kind in ('supervisor', 'bot', 'worker')
+                 for proc, info in find_processes(kind)]
     
-    if not bot_processes:
+    if not processes:
         logger.info("Не найдено запущенных экземпляров бота.")
         return
     
-    logger.info(f"Найдено {len(bot_processes)} запущенных экземпляров бота:")
-    for i, proc in enumerate(bot_processes, 1):
+    # Загрузка CPU измеряется за один общий интервал для всех процессов
+    for _, proc, _ in processes:
         try:
-            # Получаем информацию о процессе
-            process_info = proc.as_dict(attrs=['pid', 'cpu_percent', 'memory_percent', 'create_time'])
-            create_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(process_info['create_time']))
-            
-            logger.info(f"Экземпляр {i}:")
-            logger.info(f"  PID: {process_info['pid']}")
-            logger.info(f"  Время запуска: {create_time}")
-            logger.info(f"  Использование CPU: {process_info['cpu_percent']}%")
-            logger.info(f"  Использование памяти: {process_info['memory_percent']:.2f}%")
-        except Exception as e:
+            proc.cpu_percent(None)
+        except psutil.Error:
+            pass
+    time.sleep(0.5)
+    
+    logger.info(f"Найдено запущенных процессов: {len(processes)}")
+    now = time.time()
+    for kind, proc, info in processes:
+        try:
+            with proc.oneshot():
+                cpu = proc.cpu_percent(None)
+                rss = proc.memory_info().rss / 1024 / 1024
+                uptime = now - proc.create_time()
+        except psutil.Error as e:
             logger.error(f"Ошибка при получении информации о процессе {proc.pid}: {e}")
+            continue
+        line = (f"{kind:<10} PID {proc.pid:<7} {info.get('state', '-'):<9} работает {format_uptime(uptime)}, "
+                f"RSS {rss:.0f} МБ, CPU {cpu:.1f}%")
+        if kind == 'worker':
+            line += (f", задач выполнено {info.get('processed', 0)}, ошибок {info.get('failed', 0)}, "
+                     f"в работе {info.get('active', 0)}")
+        elif kind == 'supervisor':
+            line += f", воркеров {info.get('workers', 0)}"
+        logger.info(line)
 
 def print_help():
     """Выводит справку по использованию скрипта."""
     print("Использование:")
-    print("  python manage_bot.py start   - Запустить бота")
-    print("  python manage_bot.py stop    - Остановить все экземпляры бота")
-    print("  python manage_bot.py status  - Проверить статус запущенных экземпляров")
-    print("  python manage_bot.py help    - Показать эту справку")
+    print("  python manage_bot.py start         - Запустить бота")
+    print("  python manage_bot.py stop          - Остановить все экземпляры бота, доделав задачи в работе")
+    print("  python manage_bot.py restart       - Перезапустить бота без простоя")
+    print("  python manage_bot.py status        - Проверить статус запущенных экземпляров")
+    print("  python manage_bot.py supervise [N] - Запустить бота и N воркеров под присмотром супервизора")
+    print("  python manage_bot.py scale N       - Изменить число воркеров у работающего супервизора")
+    print("  python manage_bot.py help          - Показать эту справку")
 
 def main():
     if len(sys.argv) < 2:
@@ -136,8 +598,22 @@ def main():
         start_bot()
     elif command == 'stop':
         stop_bot()
+    elif command == 'restart':
+        restart_bot()
     elif command == 'status':
         check_status()
+    elif command in ('supervise', 'scale'):
+        try:
+            workers = int(sys.argv[2]) if len(sys.argv) > 2 else SUPERVISOR_WORKERS
+        except ValueError:
+            workers = -1
+        if workers < 0 or (command == 'scale' and len(sys.argv) < 3):
+            print("Укажите число воркеров, например: python manage_bot.py scale 4")
+            return
+        if command == 'supervise':
+            supervise(workers)
+        else:
+            scale_workers(workers)
     elif command == 'help':
         print_help()
     else:
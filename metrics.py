@@ -0,0 +1,238 @@
+import bisect
+import contextvars
+import logging
+import socket
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Идентификатор задачи для сквозной трассировки в логах
+trace_id: contextvars.ContextVar = contextvars.ContextVar("trace_id", default="-")
+
+# Границы корзин гистограмм длительности, с
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+LabelValues = Tuple[str, ...]
+# Сборщик значений при запросе: список (имя, тип, описание, [(метки, значение)])
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+
+def install_trace_logging() -> None:
+    """Добавляет поле trace_id во все записи журнала."""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.trace_id = trace_id.get()
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{_format_labels(self.labels, key)} {value}"
+                                for key, value in self.values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def summary(self, **labels) -> Optional[Dict[str, float]]:
+        """Число наблюдений, среднее и оценки перцентилей по корзинам."""
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if not counts:
+            return None
+        total = sum(counts)
+        return {
+            "count": total,
+            "avg": self._sums[key] / total,
+            "p50": self._quantile(counts, total, 0.5),
+            "p95": self._quantile(counts, total, 0.95),
+            "p99": self._quantile(counts, total, 0.99),
+        }
+
+    def _quantile(self, counts: List[int], total: int, q: float) -> float:
+        # Линейная интерполяция внутри корзины, как histogram_quantile в Prometheus
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def label_sets(self) -> List[Dict[str, str]]:
+        return [dict(zip(self.labels, key)) for key in self._counts]
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Набор метрик и сборщиков, отдаваемый в текстовом формате Prometheus.
+
+    Значения, которые уже считаются в других модулях (размер очереди,
+    попадания в кеш и т.п.), не дублируются: они снимаются сборщиками в
+    момент запроса.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Collector) -> None:
+        self._collectors.append(collector)
+
+    def collect(self) -> List[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]:
+        families = []
+        for collector in self._collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.error(f"Ошибка сборщика метрик: {e}")
+        return families
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, metric_type, description, samples in self.collect():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "sd_bot_stage_seconds", "Длительность этапов обработки запроса", ["stage"]))
+RENDER_SECONDS = REGISTRY.register(Histogram(
+    "sd_bot_render_seconds", "Длительность запроса txt2img по серверам", ["backend"]))
+JOBS_TOTAL = REGISTRY.register(Counter(
+    "sd_bot_jobs_total", "Завершённые задачи генерации по результату", ["result"]))
+PREDICTION_RATIO = REGISTRY.register(Histogram(
+    "sd_bot_render_prediction_ratio", "Отношение фактического времени генерации к предсказанному", ["backend"],
+    buckets=(0.25, 0.5, 0.67, 0.8, 0.9, 1.0, 1.1, 1.25, 1.5, 2, 4)))
+GPU_SECONDS = REGISTRY.register(Counter(
+    "sd_bot_gpu_seconds_total", "Время запросов к Stable Diffusion по операциям", ["operation"]))
+SATISFIED_TOTAL = REGISTRY.register(Counter(
+    "sd_bot_satisfied_requests_total", "Запросы, результат которых понадобился пользователю"))
+REQUESTS_TOTAL = REGISTRY.register(Counter(
+    "sd_bot_requests_total", "Входящие запросы на генерацию по способу обработки", ["result"]))
+
+
+class MetricsServer:
+    """HTTP-сервер с эндпоинтом /metrics для Prometheus.
+
+    Порт открывается с SO_REUSEPORT (где он есть): при перезапуске без
+    простоя новый экземпляр занимает порт, пока прежний ещё доделывает задачи.
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port, reuse_port=hasattr(socket, "SO_REUSEPORT")).start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type="text/plain", charset="utf-8")
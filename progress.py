@@ -0,0 +1,130 @@
+import asyncio
+import base64
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+import telegram.error
+
+from clients import SDAPIError, SDClient
+
+logger = logging.getLogger(__name__)
+
+# Обработчик прогресса: (доля 0..1, оставшееся время в секундах, превью или None)
+ProgressCallback = Callable[[float, Optional[float], Optional[bytes]], Awaitable[None]]
+
+
+@dataclass
+class _ThrottleState:
+    interval: float
+    last_call: float = 0.0
+    blocked_until: float = 0.0
+
+
+class EditThrottle:
+    """Адаптивное ограничение частоты редактирования сообщений.
+
+    Для каждого чата хранится свой минимальный интервал между правками.
+    Если Telegram ответил RetryAfter, чат блокируется на указанное время,
+    а интервал удваивается (до max_interval); после успешных правок он
+    постепенно возвращается к min_interval. Дополнительно ограничивается
+    общее число правок в секунду по всем чатам. Промежуточные обновления,
+    не прошедшие ограничение, отбрасываются - следующее будет свежее.
+    """
+
+    def __init__(self, min_interval: float, max_interval: float, global_rate: float):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.global_gap = 1.0 / global_rate if global_rate > 0 else 0.0
+        self._states: Dict[Hashable, _ThrottleState] = {}
+        self._global_last = 0.0
+
+    def _state(self, key: Hashable) -> _ThrottleState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _ThrottleState(self.min_interval)
+        return state
+
+    def forget(self, key: Hashable) -> None:
+        self._states.pop(key, None)
+
+    async def call(self, key: Hashable, func: Callable[[], Awaitable[object]]) -> bool:
+        """Выполняет правку, если ограничения позволяют; возвращает True, если она была отправлена."""
+        now = time.monotonic()
+        state = self._state(key)
+        if now < state.blocked_until or now - state.last_call < state.interval:
+            return False
+        if now - self._global_last < self.global_gap:
+            return False
+        state.last_call = self._global_last = now
+        try:
+            await func()
+        except telegram.error.RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            state.blocked_until = time.monotonic() + retry_after
+            state.interval = min(self.max_interval, state.interval * 2)
+            logger.warning(f"Telegram ограничил правки в чате {key} на {retry_after} с, интервал {state.interval:.1f} с")
+            return False
+        except telegram.error.BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        state.interval = max(self.min_interval, state.interval * 0.9)
+        return True
+
+
+class ProgressMonitor:
+    """Общий опрос /sdapi/v1/progress: один цикл на сервер для всех его задач.
+
+    Цикл опроса сервера запускается при появлении первой подписки и
+    завершается, когда подписок не осталось.
+    """
+
+    def __init__(self, client: SDClient, interval: float, with_preview: bool):
+        self.client = client
+        self.interval = interval
+        self.with_preview = with_preview
+        self._subscribers: Dict[str, Dict[str, ProgressCallback]] = {}
+        self._pollers: Dict[str, asyncio.Task] = {}
+
+    def subscribe(self, backend_url: str, job_id: str, callback: ProgressCallback) -> None:
+        self._subscribers.setdefault(backend_url, {})[job_id] = callback
+        if backend_url not in self._pollers:
+            self._pollers[backend_url] = asyncio.create_task(self._poll(backend_url))
+
+    def unsubscribe(self, backend_url: str, job_id: str) -> None:
+        subscribers = self._subscribers.get(backend_url)
+        if subscribers is not None:
+            subscribers.pop(job_id, None)
+
+    async def stop(self) -> None:
+        for task in self._pollers.values():
+            task.cancel()
+        await asyncio.gather(*self._pollers.values(), return_exceptions=True)
+        self._pollers.clear()
+
+    async def _poll(self, backend_url: str) -> None:
+        try:
+            while self._subscribers.get(backend_url):
+                await asyncio.sleep(self.interval)
+                subscribers = self._subscribers.get(backend_url)
+                if not subscribers:
+                    break
+                try:
+                    state = await self.client.progress(backend_url, with_image=self.with_preview)
+                except SDAPIError as e:
+                    logger.debug(f"Не удалось получить прогресс {backend_url}: {e}")
+                    continue
+                progress = float(state.get("progress") or 0.0)
+                eta = state.get("eta_relative")
+                preview = None
+                if self.with_preview and state.get("current_image"):
+                    try:
+                        preview = base64.b64decode(state["current_image"])
+                    except ValueError:
+                        preview = None
+                await asyncio.gather(*(callback(progress, eta, preview) for callback in list(subscribers.values())),
+                                     return_exceptions=True)
+        finally:
+            self._pollers.pop(backend_url, None)
+            self._subscribers.pop(backend_url, None)
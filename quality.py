@@ -0,0 +1,130 @@
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QualityLevel:
+    """Параметры генерации на одном уровне качества."""
+    width: int
+    height: int
+    steps: int
+    scheduler: Optional[str] = None  # None - сэмплер из базовых настроек
+
+    def apply(self, payload: dict) -> dict:
+        payload = dict(payload)
+        payload["width"] = self.width
+        payload["height"] = self.height
+        payload["num_inference_steps"] = self.steps
+        if self.scheduler:
+            payload["scheduler"] = self.scheduler
+        return payload
+
+    def describe(self) -> str:
+        text = f"{self.width}×{self.height}, {self.steps} шагов"
+        if self.scheduler:
+            text += f", {self.scheduler}"
+        return text
+
+
+def parse_levels(spec: str) -> List[QualityLevel]:
+    """Разбирает уровни качества вида "768x768:20,512x512:15:EulerDiscrete"."""
+    levels = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        parts = item.split(":")
+        width, height = (int(side) for side in parts[0].lower().split("x"))
+        scheduler = parts[2] if len(parts) > 2 and parts[2] else None
+        levels.append(QualityLevel(width, height, int(parts[1]), scheduler))
+    return levels
+
+
+class QualityPolicy:
+    """Снижает качество новых задач при высокой нагрузке и возвращает его, когда нагрузка спадает.
+
+    levels[0] - полное качество, следующие уровни дешевле. Нагрузка
+    оценивается по числу задач в очереди на один слот GPU и по p95 времени
+    от запроса до ответа за последние latency_window задач. Если одно из
+    значений превышает порог (queue_threshold или latency_slo), качество
+    снижается на один уровень; повышается оно, когда оба значения ниже
+    порогов, умноженных на recovery_ratio. Между сменами уровня проходит не
+    меньше adjust_interval секунд, чтобы новые задачи успели повлиять на
+    задержку. После смены уровня задержки прежних задач отбрасываются, а
+    повышение качества ждёт задержек, измеренных уже на новом уровне.
+    latency_slo=0 отключает учёт задержки: уровень зависит только от очереди.
+    """
+
+    def __init__(self, levels: List[QualityLevel], queue_threshold: float, latency_slo: float,
+                 recovery_ratio: float = 0.5, adjust_interval: float = 30.0, latency_window: int = 50,
+                 enabled: bool = True):
+        self.levels = levels
+        self.queue_threshold = queue_threshold
+        self.latency_slo = latency_slo
+        self.recovery_ratio = recovery_ratio
+        self.adjust_interval = adjust_interval
+        self.enabled = enabled
+        self.level = 0
+        self._changed_at = 0.0
+        self._latencies: Deque[float] = deque(maxlen=latency_window)
+        # Задачи, выполненные с пониженным качеством, по уровням
+        self.degraded_jobs = [0] * len(levels)
+
+    @property
+    def current(self) -> QualityLevel:
+        return self.levels[self.level]
+
+    @property
+    def degraded(self) -> bool:
+        return self.level > 0
+
+    def observe(self, latency: float) -> None:
+        """Учитывает время от запроса пользователя до отправки изображения."""
+        self._latencies.append(latency)
+
+    def latency_p95(self) -> Optional[float]:
+        if not self._latencies:
+            return None
+        values = sorted(self._latencies)
+        return values[min(len(values) - 1, int(0.95 * len(values)))]
+
+    def update(self, queue_depth: int, capacity: int) -> QualityLevel:
+        """Пересчитывает уровень качества по текущей нагрузке и возвращает его."""
+        if not self.enabled or len(self.levels) < 2:
+            return self.current
+        now = time.monotonic()
+        if now - self._changed_at < self.adjust_interval:
+            return self.current
+        pressure = queue_depth / max(capacity, 1)
+        p95 = self.latency_p95()
+        if not self.latency_slo:
+            p95 = None
+        overloaded = pressure >= self.queue_threshold or (p95 is not None and p95 > self.latency_slo)
+        relaxed = (pressure < self.queue_threshold * self.recovery_ratio
+                   and (not self.latency_slo
+                        or p95 is not None and p95 < self.latency_slo * self.recovery_ratio))
+        if overloaded and self.level < len(self.levels) - 1:
+            self._set_level(self.level + 1, pressure, p95, now)
+        elif relaxed and self.level > 0:
+            self._set_level(self.level - 1, pressure, p95, now)
+        return self.current
+
+    def apply(self, payload: dict) -> dict:
+        """Применяет текущий уровень качества к параметрам запроса."""
+        if self.degraded:
+            self.degraded_jobs[self.level] += 1
+        return self.current.apply(payload)
+
+    def _set_level(self, level: int, pressure: float, p95: Optional[float], now: float) -> None:
+        direction = "снижено" if level > self.level else "повышено"
+        self.level = level
+        self._changed_at = now
+        self._latencies.clear()
+        p95_text = f"{p95:.1f} с" if p95 is not None else "нет данных"
+        logger.info(f"Качество генерации {direction} до уровня {level} ({self.current.describe()}): "
+                    f"задач на слот {pressure:.1f}, p95 {p95_text}")
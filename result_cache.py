@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def payload_key(payload: dict) -> str:
+    """Возвращает хеш полного набора параметров генерации."""
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(payload: dict) -> bool:
+    """Результат воспроизводим только при фиксированном seed."""
+    return payload.get("seed", -1) not in (-1, None)
+
+
+class DiskImageCache:
+    """Дисковый кеш изображений с вытеснением давно не использованных файлов.
+
+    Файлы хранятся в подкаталогах по первым символам ключа. Индекс размеров
+    держится в памяти в порядке последнего использования и восстанавливается
+    при запуске по времени изменения файлов.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self.total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.img")
+
+    def _load_index(self) -> None:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".img"):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.total_bytes += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except OSError:
+            with self._lock:
+                self.total_bytes -= self._index.pop(key, 0)
+            return None
+
+    def put(self, key: str, data: bytes) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._index.pop(key, 0)
+            self._index[key] = len(data)
+            evicted = []
+            while self.total_bytes > self.max_bytes and len(self._index) > 1:
+                old_key, size = self._index.popitem(last=False)
+                self.total_bytes -= size
+                evicted.append(old_key)
+        for old_key in evicted:
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class ResultCache:
+    """Кеш результатов генерации по хешу параметров запроса.
+
+    В памяти хранится file_id, который Telegram вернул после первой
+    отправки: повторный запрос отправляется по file_id без генерации и без
+    загрузки файла. Необязательный дисковый уровень хранит сами изображения,
+    чтобы пережить перезапуск и вытеснение file_id из памяти.
+    """
+
+    def __init__(self, max_entries: int, disk_cache: Optional[DiskImageCache] = None):
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self._file_ids: "OrderedDict[str, str]" = OrderedDict()
+        self.file_id_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get_file_id(self, key: str) -> Optional[str]:
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id
+
+    def put_file_id(self, key: str, file_id: str) -> None:
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.max_entries:
+            self._file_ids.popitem(last=False)
+
+    async def get_bytes(self, key: str) -> Optional[bytes]:
+        """Ищет изображение на диске; промах учитывается в статистике."""
+        data = None
+        if self.disk_cache is not None:
+            try:
+                data = await asyncio.to_thread(self.disk_cache.get, key)
+            except OSError as e:
+                logger.error(f"Ошибка чтения кеша изображений: {e}")
+        if data is None:
+            self.misses += 1
+        else:
+            self.disk_hits += 1
+        return data
+
+    async def put_bytes(self, key: str, data: bytes) -> None:
+        if self.disk_cache is None:
+            return
+        try:
+            await asyncio.to_thread(self.disk_cache.put, key, data)
+        except OSError as e:
+            logger.error(f"Ошибка записи кеша изображений: {e}")
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.file_id_hits + self.disk_hits + self.misses
+        return {
+            "lookups": lookups,
+            "file_id_hits": self.file_id_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.file_id_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "file_ids": len(self._file_ids),
+            "disk_entries": len(self.disk_cache) if self.disk_cache is not None else 0,
+            "disk_bytes": self.disk_cache.total_bytes if self.disk_cache is not None else 0,
+        }
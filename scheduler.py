@@ -0,0 +1,558 @@
+import asyncio
+import heapq
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from backends import Backend, BackendPool, NoBackendAvailableError
+from clients import SDTimeoutError
+from cost import CostModel
+from metrics import JOBS_TOTAL, STAGE_SECONDS, trace_id
+
+logger = logging.getLogger(__name__)
+
+
+# Порядок выбора задач из очереди
+ORDERING_FAIR = "fair"  # Пользователи по кругу
+ORDERING_SJF = "sjf"  # Сначала самые дешёвые задачи
+ORDERING_WFQ = "wfq"  # Пользователь, получивший меньше всего времени GPU
+ORDERINGS = (ORDERING_FAIR, ORDERING_SJF, ORDERING_WFQ)
+
+
+class QueueFullError(Exception):
+    """Очередь генерации переполнена, задача не принята."""
+
+
+class JobCancelledError(Exception):
+    """Задача отменена пользователем или по истечении срока."""
+
+    def __init__(self, reason: str = "cancelled"):
+        super().__init__(f"Задача отменена: {reason}")
+        self.reason = reason
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+@dataclass
+class GenerationJob:
+    """Задача на генерацию одного изображения."""
+    user_id: int
+    chat_id: int
+    prompt: str
+    payload: dict
+    job_id: str = field(default_factory=new_job_id)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: Optional[float] = None
+    future: Optional[asyncio.Future] = None
+    # Вызывается при изменении позиции в очереди: (позиция, ETA в секундах)
+    on_position: Optional[Callable[[int, float], Awaitable[None]]] = None
+    # Вызывается, когда задача передана на GPU
+    on_start: Optional[Callable[[], Awaitable[None]]] = None
+    # Вызывается при опросе прогресса генерации: (доля, ETA в секундах, превью)
+    on_progress: Optional[Callable[[float, Optional[float], Optional[bytes]], Awaitable[None]]] = None
+    last_position: int = 0
+    last_notified_at: float = 0.0
+    # Ключ совместимости для объединения задач в один запрос
+    batch_key: Optional[Hashable] = None
+    # Сервер, на котором выполняется задача
+    backend_url: Optional[str] = None
+    # Момент (time.monotonic), после которого задача считается просроченной
+    deadline: Optional[float] = None
+    # Причина отмены ("cancelled" или "expired"), если задача отменена
+    cancel_reason: Optional[str] = None
+    # Предсказанное время генерации, с
+    predicted: float = 0.0
+    # Операция Stable Diffusion: txt2img, img2img или upscale. В пакеты объединяются только txt2img
+    operation: str = "txt2img"
+
+
+class GenerationScheduler:
+    """Планировщик генерации с ограниченной очередью и справедливостью между пользователями.
+
+    Задачи каждого пользователя хранятся в отдельной очереди, а диспетчер
+    обходит пользователей по кругу (round-robin), поэтому пользователь,
+    отправивший много запросов, не блокирует остальных. Каждый запрос
+    занимает слот на одном из серверов пула; если сервер вернул ошибку,
+    задача повторяется на другом сервере (до max_retries раз).
+
+    Если задан batch_key, диспетчер после выбора задачи ждёт batch_window
+    секунд и добирает до max_batch_size совместимых задач из очереди, чтобы
+    отправить их одним запросом. runner получает список задач пакета и
+    возвращает результаты в том же порядке.
+
+    Задачу можно отменить (или она отменяется сама по истечении deadline):
+    ожидающая задача просто удаляется из очереди, а если отменены все задачи
+    выполняющегося запроса, запрос прерывается и вызывается interrupt для
+    сервера, чтобы GPU сразу перешёл к следующей задаче.
+
+    С моделью стоимости (cost_model) время генерации каждой задачи
+    предсказывается по её параметрам: на этом основаны ETA, а порядок
+    ordering может быть "sjf" (первой идёт самая дешёвая из первых задач
+    пользователей; за каждую секунду ожидания стоимость уменьшается на
+    sjf_aging, чтобы дорогие задачи не ждали бесконечно) или "wfq" (следующим
+    обслуживается пользователь, чьим задачам досталось меньше всего
+    предсказанного времени GPU). Внутри очереди одного пользователя задачи
+    всегда выполняются по порядку.
+    """
+
+    def __init__(self, runner: Callable[[List[GenerationJob], Backend], Awaitable[List[Optional[bytes]]]],
+                 pool: BackendPool, max_queue: int, max_per_user: int,
+                 initial_estimate: float = 30.0, position_update_interval: float = 3.0,
+                 batch_key: Optional[Callable[[dict], Hashable]] = None,
+                 max_batch_size: int = 1, batch_window: float = 0.0, max_retries: int = 0,
+                 interrupt: Optional[Callable[[Backend], Awaitable[None]]] = None,
+                 expiry_check_interval: float = 1.0, cost_model: Optional[CostModel] = None,
+                 ordering: str = ORDERING_FAIR, sjf_aging: float = 0.0):
+        if ordering not in ORDERINGS:
+            raise ValueError(f"Неизвестный порядок очереди: {ordering}")
+        self._runner = runner
+        self.cost_model = cost_model
+        self.ordering = ordering
+        self.sjf_aging = sjf_aging
+        # Предсказанное время GPU, полученное пользователями с задачами в очереди (для wfq)
+        self._service: Dict[int, float] = {}
+        self._virtual_time = 0.0
+        self._interrupt = interrupt
+        self.expiry_check_interval = expiry_check_interval
+        self._pool = pool
+        self.max_retries = max_retries
+        self._batch_key = batch_key
+        self.max_batch_size = max_batch_size if batch_key else 1
+        self.batch_window = batch_window
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.position_update_interval = position_update_interval
+        self._queues: "OrderedDict[int, Deque[GenerationJob]]" = OrderedDict()
+        self._size = 0
+        self._running: Dict[str, GenerationJob] = {}
+        # Выполняющийся запрос и его пакет для каждой запущенной задачи
+        self._batches: Dict[str, Tuple[asyncio.Task, List[GenerationJob]]] = {}
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._expiry: Optional[asyncio.Task] = None
+        self._tasks = set()
+        # Скользящее среднее длительности одной генерации для расчёта ETA
+        self.avg_duration = initial_estimate
+        # Счётчики отмен и потерянного времени GPU
+        self.cancelled_queued = 0
+        self.cancelled_running = 0
+        self.expired = 0
+        self.wasted_gpu_seconds = 0.0
+        # Срок плавной остановки (time.monotonic) и признак, что задачи больше не принимаются
+        self.shutdown_deadline: Optional[float] = None
+        self.closed = False
+
+    @property
+    def queued(self) -> int:
+        return self._size
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    def start(self) -> None:
+        """Запускает диспетчер очереди в текущем event loop."""
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+            self._expiry = asyncio.create_task(self._expiry_loop())
+
+    async def stop(self) -> None:
+        """Останавливает диспетчер и отменяет выполняющиеся задачи."""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._expiry.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            await asyncio.gather(self._dispatcher, self._expiry, *self._tasks, return_exceptions=True)
+            self._dispatcher = None
+            self._expiry = None
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        """Возвращает ожидающую или выполняющуюся задачу по идентификатору."""
+        job = self._running.get(job_id)
+        if job is None:
+            job = next((queued for queued in self._iter_queued() if queued.job_id == job_id), None)
+        return job
+
+    def user_jobs(self, user_id: int) -> List[GenerationJob]:
+        """Все ожидающие и выполняющиеся задачи пользователя."""
+        jobs = list(self._queues.get(user_id, ()))
+        return jobs + [job for job in self._running.values() if job.user_id == user_id]
+
+    def cancel(self, job_id: str, reason: str = "cancelled") -> bool:
+        """Отменяет задачу; возвращает False, если задача не найдена или уже завершена."""
+        job = self.get(job_id)
+        if job is None or job.future.done():
+            return False
+        job.cancel_reason = reason
+        JOBS_TOTAL.inc(result=reason)
+        if reason == "expired":
+            self.expired += 1
+        if job.job_id not in self._running:
+            self._remove_queued(job)
+            self.cancelled_queued += 1
+            job.future.set_exception(JobCancelledError(reason))
+            logger.info(f"Задача {job.job_id} удалена из очереди ({reason})")
+            self._spawn(self._notify_positions())
+            return True
+
+        self.cancelled_running += 1
+        if job.started_at is None:
+            # Запрос ещё не начат или пакет ещё собирается - задача просто не попадёт в него
+            job.future.set_exception(JobCancelledError(reason))
+            return True
+        task, batch = self._batches[job.job_id]
+        if all(other.cancel_reason or other.future.done() for other in batch):
+            # Результат запроса больше никому не нужен - прерываем генерацию
+            logger.info(f"Задача {job.job_id} отменена во время генерации ({reason}), прерываю запрос")
+            task.cancel()
+        else:
+            # Остальные задачи пакета ещё ждут результат, отменяем только эту
+            self.wasted_gpu_seconds += time.monotonic() - job.started_at
+            job.future.set_exception(JobCancelledError(reason))
+        return True
+
+    def shutdown_at(self, deadline: float) -> None:
+        """Начинает плавную остановку к сроку deadline (time.monotonic).
+
+        Новые задачи ещё принимаются, но ожидающие задачи, которые по оценке
+        не успеют выполниться до срока, отменяются сразу с причиной shutdown,
+        чтобы пользователи не ждали впустую.
+        """
+        self.shutdown_deadline = deadline
+        self._cancel_late(time.monotonic())
+
+    def close(self) -> int:
+        """Перестаёт принимать задачи и отменяет все оставшиеся; возвращает их число."""
+        self.closed = True
+        jobs = list(self._iter_queued()) + list(self._running.values())
+        return sum(self.cancel(job.job_id, reason="shutdown") for job in jobs)
+
+    def _cancel_late(self, now: float) -> None:
+        remaining = self.shutdown_deadline - now
+        late = [job for job, eta in self._etas() if eta > remaining]
+        for job in late:
+            self.cancel(job.job_id, reason="shutdown")
+        if late:
+            logger.info(f"Отменено задач, которые не успеют выполниться до остановки: {len(late)}")
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отменяет все задачи пользователя и возвращает их число."""
+        return sum(self.cancel(job.job_id) for job in self.user_jobs(user_id))
+
+    def submit(self, job: GenerationJob) -> asyncio.Future:
+        """Ставит задачу в очередь и возвращает future с результатом.
+
+        Если очередь переполнена, сразу выбрасывает QueueFullError вместо
+        того, чтобы задача ждала до истечения таймаута. После close()
+        новые задачи отклоняются так же.
+        """
+        if self.closed:
+            raise QueueFullError("Бот останавливается, задачи не принимаются")
+        if self._size >= self.max_queue:
+            raise QueueFullError("Очередь генерации переполнена")
+        user_queue = self._queues.get(job.user_id)
+        if user_queue is not None and len(user_queue) >= self.max_per_user:
+            raise QueueFullError("Слишком много запросов от пользователя в очереди")
+
+        job.future = asyncio.get_running_loop().create_future()
+        job.predicted = self.predict(job.payload)
+        if self._batch_key is not None:
+            job.batch_key = self._batch_key(job.payload) if job.operation == "txt2img" else job.job_id
+        if user_queue is None:
+            user_queue = self._queues[job.user_id] = deque()
+            # Простаивавший пользователь не копит права на время GPU
+            self._service[job.user_id] = self._virtual_time
+        user_queue.append(job)
+        self._size += 1
+        job.last_position = self.position(job)
+        if job.on_position and self._pool.pick() is None:
+            # Все слоты заняты - сразу показываем позицию в очереди
+            job.last_notified_at = time.monotonic()
+            self._spawn(self._safe_callback(job.on_position(job.last_position, self.eta(job))))
+        self._wakeup.set()
+        logger.info(f"Задача {job.job_id} пользователя {job.user_id} поставлена в очередь, позиция {job.last_position}")
+        return job.future
+
+    def predict(self, payload: dict, backend_url: Optional[str] = None) -> float:
+        """Предсказанное время генерации запроса, с."""
+        if self.cost_model is None:
+            return self.avg_duration
+        return self.cost_model.predict(payload, backend_url)
+
+    def _iter_queued(self) -> Iterator[GenerationJob]:
+        """Перебирает ожидающие задачи в порядке их будущего выполнения."""
+        if self.ordering == ORDERING_SJF:
+            yield from self._iter_by_cost()
+            return
+        if self.ordering == ORDERING_WFQ:
+            yield from self._iter_by_service()
+            return
+        queues = list(self._queues.values())
+        depth = 0
+        while True:
+            found = False
+            for user_queue in queues:
+                if depth < len(user_queue):
+                    found = True
+                    yield user_queue[depth]
+            if not found:
+                return
+            depth += 1
+
+    def _sjf_score(self, job: GenerationJob, now: float) -> float:
+        return job.predicted - self.sjf_aging * (now - job.enqueued_at)
+
+    def _iter_by_cost(self) -> Iterator[GenerationJob]:
+        # Слияние очередей пользователей по стоимости первой задачи
+        now = time.monotonic()
+        heap = [(self._sjf_score(queue[0], now), index, 0) for index, queue in enumerate(self._queues.values())]
+        queues = list(self._queues.values())
+        heapq.heapify(heap)
+        while heap:
+            _, index, depth = heapq.heappop(heap)
+            queue = queues[index]
+            yield queue[depth]
+            if depth + 1 < len(queue):
+                heapq.heappush(heap, (self._sjf_score(queue[depth + 1], now), index, depth + 1))
+
+    def _iter_by_service(self) -> Iterator[GenerationJob]:
+        # Имитация выбора: пользователь с наименьшим временем GPU получает следующую задачу
+        heap = [(self._service.get(user_id, 0.0), index, 0) for index, user_id in enumerate(self._queues)]
+        queues = list(self._queues.values())
+        heapq.heapify(heap)
+        while heap:
+            service, index, depth = heapq.heappop(heap)
+            queue = queues[index]
+            yield queue[depth]
+            if depth + 1 < len(queue):
+                heapq.heappush(heap, (service + queue[depth].predicted, index, depth + 1))
+
+    def position(self, job: GenerationJob) -> int:
+        """Возвращает позицию задачи в очереди (начиная с 1), 0 - если задача не в очереди."""
+        for index, queued in enumerate(self._iter_queued(), 1):
+            if queued is job:
+                return index
+        return 0
+
+    def _running_remaining(self) -> float:
+        """Предсказанное время, оставшееся выполняющимся запросам, с."""
+        now = time.monotonic()
+        remaining = 0.0
+        for job in self._running.values():
+            started = job.started_at if job.started_at is not None else now
+            remaining += max(0.0, job.predicted - (now - started))
+        return remaining
+
+    def _etas(self) -> Iterator[Tuple[GenerationJob, float]]:
+        """Ожидающие задачи по порядку с оценкой времени до их завершения.
+
+        Предсказанное время задач впереди и остаток выполняющихся делится
+        на число слотов GPU, к нему добавляется время самой задачи.
+        """
+        capacity = max(self._pool.capacity, 1)
+        ahead = self._running_remaining()
+        for job in self._iter_queued():
+            yield job, ahead / capacity + job.predicted
+            ahead += job.predicted
+
+    def eta(self, job: GenerationJob) -> float:
+        """Оценивает время до завершения ожидающей задачи, с."""
+        return next((eta for queued, eta in self._etas() if queued is job), job.predicted)
+
+    def _pop_next(self) -> GenerationJob:
+        if self.ordering == ORDERING_FAIR:
+            user_id, user_queue = next(iter(self._queues.items()))
+        elif self.ordering == ORDERING_SJF:
+            now = time.monotonic()
+            user_id, user_queue = min(self._queues.items(), key=lambda item: self._sjf_score(item[1][0], now))
+        else:
+            user_id, user_queue = min(self._queues.items(), key=lambda item: self._service.get(item[0], 0.0))
+        job = user_queue.popleft()
+        self._charge(job)
+        # Пользователь уходит в конец круга, пустые очереди удаляются
+        if user_queue:
+            self._queues.move_to_end(user_id)
+        else:
+            del self._queues[user_id]
+            self._service.pop(user_id, None)
+        self._size -= 1
+        return job
+
+    def _charge(self, job: GenerationJob) -> None:
+        """Учитывает время GPU, выделенное пользователю (для wfq)."""
+        if job.user_id in self._service:
+            self._virtual_time = max(self._virtual_time, self._service[job.user_id])
+            self._service[job.user_id] += job.predicted
+
+    def _remove_queued(self, job: GenerationJob) -> None:
+        user_queue = self._queues[job.user_id]
+        user_queue.remove(job)
+        if not user_queue:
+            del self._queues[job.user_id]
+            self._service.pop(job.user_id, None)
+        self._size -= 1
+
+    def _take_compatible(self, key: Hashable, limit: int) -> List[GenerationJob]:
+        """Забирает из очереди до limit задач с тем же ключом совместимости."""
+        taken = [job for job in self._iter_queued() if job.batch_key == key][:limit]
+        for job in taken:
+            self._charge(job)
+            self._remove_queued(job)
+        return taken
+
+    async def _collect_batch(self, first: GenerationJob) -> List[GenerationJob]:
+        """Добирает к задаче совместимые задачи в течение окна сбора пакета.
+
+        Собранные задачи уже не в очереди, поэтому сразу учитываются как
+        выполняющиеся: пока окно открыто, их можно отменить, и их находят
+        проверка сроков и close().
+        """
+        batch = [first]
+        self._running[first.job_id] = first
+        if self.max_batch_size <= 1:
+            return batch
+        deadline = time.monotonic() + self.batch_window
+        while True:
+            taken = self._take_compatible(first.batch_key, self.max_batch_size - len(batch))
+            for job in taken:
+                self._running[job.job_id] = job
+            batch += taken
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.max_batch_size or remaining <= 0:
+                return batch
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            while not self._size:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            backend = await self._pool.acquire()
+            if not self._size:
+                self._pool.release(backend, ok=None)
+                continue
+            batch = await self._collect_batch(self._pop_next())
+            task = self._spawn(self._run(batch, backend))
+            for job in batch:
+                self._batches[job.job_id] = (task, batch)
+            self._spawn(self._notify_positions())
+
+    async def _expiry_loop(self) -> None:
+        """Периодически отменяет задачи, у которых истёк срок или которые не успеют до остановки."""
+        while True:
+            await asyncio.sleep(self.expiry_check_interval)
+            now = time.monotonic()
+            expired = [job for job in list(self._iter_queued()) + list(self._running.values())
+                       if job.deadline is not None and job.deadline <= now and not job.cancel_reason]
+            for job in expired:
+                self.cancel(job.job_id, reason="expired")
+            if self.shutdown_deadline is not None:
+                self._cancel_late(now)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _run(self, batch: List[GenerationJob], backend: Backend) -> None:
+        started_at = time.monotonic()
+        # Задачи, отменённые до начала запроса, не отправляем
+        active = [job for job in batch if not job.future.done()]
+        trace_id.set(','.join(job.job_id for job in active) or '-')
+        for job in active:
+            job.started_at = started_at
+            STAGE_SECONDS.observe(started_at - job.enqueued_at, stage="queue_wait")
+            logger.info(f"Задача {job.job_id} запущена, ожидание в очереди {started_at - job.enqueued_at:.1f} с")
+            if job.on_start:
+                self._spawn(self._safe_callback(job.on_start()))
+        if len(active) > 1:
+            logger.info(f"Задачи {', '.join(job.job_id for job in active)} объединены в один запрос")
+        tried = set()
+        rendering = None
+        try:
+            if not active:
+                self._pool.release(backend, ok=None)
+                return
+            while True:
+                for job in active:
+                    job.backend_url = backend.url
+                    job.predicted = self.predict(job.payload, backend.url)
+                attempt_started = time.monotonic()
+                rendering = backend
+                try:
+                    results = await self._runner(active, backend)
+                except asyncio.CancelledError:
+                    self._pool.release(backend, ok=None)
+                    raise
+                except Exception as e:
+                    self._pool.release(backend, ok=False)
+                    rendering = None
+                    tried.add(backend.url)
+                    if len(tried) > self.max_retries:
+                        raise
+                    logger.warning(f"Сервер {backend.url} вернул ошибку ({e}), повтор на другом сервере")
+                    try:
+                        backend = await self._pool.acquire(exclude=tried)
+                    except NoBackendAvailableError:
+                        raise e
+                    continue
+                self._pool.release(backend, time.monotonic() - attempt_started, ok=True)
+                break
+            for job, result in zip(active, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+                    JOBS_TOTAL.inc(result="success" if result else "failure")
+        except asyncio.CancelledError:
+            # Все задачи пакета отменены: освобождаем GPU и учитываем потерянное время
+            self.wasted_gpu_seconds += time.monotonic() - started_at
+            if rendering is not None and self._interrupt is not None:
+                self._spawn(self._safe_callback(self._interrupt(rendering)))
+            for job in active:
+                if not job.future.done():
+                    job.future.set_exception(JobCancelledError(job.cancel_reason or "cancelled"))
+        except Exception as e:
+            result = "timeout" if isinstance(e, (SDTimeoutError, asyncio.TimeoutError)) else "failure"
+            for job in active:
+                if not job.future.done():
+                    job.future.set_exception(e)
+                    JOBS_TOTAL.inc(result=result)
+        finally:
+            if active and not any(job.cancel_reason for job in active):
+                self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started_at)
+            for job in batch:
+                self._running.pop(job.job_id, None)
+                self._batches.pop(job.job_id, None)
+
+    async def _notify_positions(self) -> None:
+        """Сообщает ожидающим задачам их новую позицию в очереди.
+
+        Уведомление отправляется только при изменении позиции и не чаще
+        position_update_interval, чтобы не упираться в лимиты Telegram.
+        """
+        now = time.monotonic()
+        for index, (job, eta) in enumerate(list(self._etas()), 1):
+            if job.on_position is None or job.last_position == index:
+                continue
+            if now - job.last_notified_at < self.position_update_interval:
+                continue
+            job.last_position = index
+            job.last_notified_at = now
+            await self._safe_callback(job.on_position(index, eta))
+
+    @staticmethod
+    async def _safe_callback(awaitable) -> None:
+        try:
+            await awaitable
+        except Exception as e:
+            logger.warning(f"Ошибка в обработчике уведомления планировщика: {e}")
@@ -0,0 +1,149 @@
+import binascii
+import io
+import re
+from typing import List, Optional
+
+# Символы, на которых останавливается быстрый поиск внутри JSON-строки
+_STRING_SPECIAL = re.compile(rb'["\\]')
+
+_WHITESPACE = b' \t\r\n'
+
+
+class StreamDecodeError(ValueError):
+    """Ответ API не удалось разобрать как JSON с изображениями."""
+
+
+class ImagesStreamDecoder:
+    """Потоковый разбор ответа txt2img, который извлекает только поле images.
+
+    Ответ подаётся кусками через feed(). Строки base64 из массива images
+    декодируются по мере поступления в отдельный буфер на каждое
+    изображение, а все остальные поля (info, parameters и т.д.) пропускаются
+    без сохранения. В памяти одновременно находятся только текущий кусок
+    ответа и декодированные изображения.
+    """
+
+    def __init__(self):
+        self.images: List[bytes] = []
+        self._stack: List[str] = []
+        self._expect_key = False
+        self._key = bytearray()
+        self._current_key: Optional[bytes] = None
+        self._in_string = False
+        self._string_kind = ''
+        self._escape = False
+        self._b64_carry = b''
+        self._image: Optional[io.BytesIO] = None
+        self._finished = False
+
+    @property
+    def finished(self) -> bool:
+        return self._finished
+
+    def feed(self, chunk: bytes) -> None:
+        pos = 0
+        length = len(chunk)
+        while pos < length:
+            if self._in_string:
+                pos = self._feed_string(chunk, pos)
+            else:
+                pos = self._feed_structure(chunk, pos)
+
+    def close(self) -> List[bytes]:
+        """Проверяет, что ответ разобран целиком, и возвращает изображения."""
+        if not self._finished:
+            raise StreamDecodeError("Ответ API оборвался до конца JSON")
+        return self.images
+
+    def _feed_structure(self, chunk: bytes, pos: int) -> int:
+        char = chunk[pos:pos + 1]
+        if char in _WHITESPACE:
+            pass
+        elif self._finished:
+            raise StreamDecodeError("Лишние данные после конца JSON")
+        elif char == b'{':
+            self._stack.append('object')
+            self._expect_key = True
+        elif char == b'[':
+            is_images = len(self._stack) == 1 and self._current_key == b'images'
+            self._stack.append('images' if is_images else 'array')
+        elif char in b'}]':
+            if not self._stack:
+                raise StreamDecodeError("Непарная закрывающая скобка в ответе API")
+            self._stack.pop()
+            if not self._stack:
+                self._finished = True
+        elif char == b',':
+            self._expect_key = self._stack[-1] == 'object' if self._stack else False
+        elif char == b':':
+            self._expect_key = False
+        elif char == b'"':
+            self._start_string()
+        elif not self._stack:
+            raise StreamDecodeError("Ответ API не является JSON-объектом")
+        return pos + 1
+
+    def _start_string(self) -> None:
+        if not self._stack:
+            raise StreamDecodeError("Ответ API не является JSON-объектом")
+        top = self._stack[-1]
+        self._in_string = True
+        if top == 'object' and self._expect_key:
+            self._string_kind = 'key' if len(self._stack) == 1 else 'skip'
+            self._key.clear()
+        elif top == 'images':
+            self._string_kind = 'image'
+            self._image = io.BytesIO()
+            self._b64_carry = b''
+        else:
+            self._string_kind = 'skip'
+
+    def _feed_string(self, chunk: bytes, pos: int) -> int:
+        if self._escape:
+            self._escape = False
+            self._consume_escape(chunk[pos:pos + 1])
+            return pos + 1
+        match = _STRING_SPECIAL.search(chunk, pos)
+        end = match.start() if match else len(chunk)
+        if end > pos and self._string_kind != 'skip':
+            self._consume(memoryview(chunk)[pos:end])
+        if match is None:
+            return end
+        if chunk[end:end + 1] == b'"':
+            self._end_string()
+        else:
+            self._escape = True
+        return end + 1
+
+    def _consume(self, segment) -> None:
+        if self._string_kind == 'key':
+            self._key += segment
+        elif self._string_kind == 'image':
+            data = self._b64_carry + bytes(segment) if self._b64_carry else segment
+            usable = len(data) - len(data) % 4
+            if usable:
+                try:
+                    self._image.write(binascii.a2b_base64(data[:usable]))
+                except binascii.Error as e:
+                    raise StreamDecodeError(f"Ошибка при декодировании изображения: {e}")
+            self._b64_carry = bytes(data[usable:])
+
+    def _consume_escape(self, char: bytes) -> None:
+        if self._string_kind == 'key':
+            self._key += char
+        elif self._string_kind == 'image':
+            if char == b'/':
+                self._consume(b'/')
+            elif char not in (b'n', b'r'):
+                raise StreamDecodeError("Недопустимый символ в строке base64")
+
+    def _end_string(self) -> None:
+        self._in_string = False
+        if self._string_kind == 'key':
+            self._current_key = bytes(self._key)
+        elif self._string_kind == 'image':
+            if self._b64_carry:
+                raise StreamDecodeError("Длина строки base64 не кратна 4")
+            # getvalue() отдаёт внутренний буфер BytesIO без копирования
+            self.images.append(self._image.getvalue())
+            self._image = None
@@ -0,0 +1,155 @@
+import asyncio
+import io
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional
+
+from metrics import STAGE_SECONDS
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен - изображения отправляются без перекодирования
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые форматы отправки: имя формата Pillow и расширение файла
+FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+
+
+def transcode_image(data: bytes, image_format: str, quality: int, max_side: int) -> bytes:
+    """Перекодирует изображение и при необходимости уменьшает его.
+
+    Функция выполняется в дочернем процессе, поэтому принимает и
+    возвращает только bytes и простые значения.
+    """
+    pil_format, _ = FORMATS[image_format]
+    with Image.open(io.BytesIO(data)) as image:
+        if max_side and max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if pil_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, pil_format, quality=quality, optimize=pil_format == "JPEG")
+    return output.getvalue()
+
+
+class ImageTranscoder:
+    """Перекодирование результатов генерации перед отправкой в Telegram.
+
+    PNG от Stable Diffusion весит несколько мегабайт, и его загрузка
+    заметно удлиняет ответ. Сжатие выполняется в пуле процессов, чтобы не
+    занимать GIL цикла событий. Ведётся статистика размеров до и после
+    перекодирования и времени загрузки в Telegram.
+    """
+
+    def __init__(self, image_format: str, quality: int, max_side: int, workers: int):
+        self.image_format = image_format.lower()
+        self.quality = quality
+        self.max_side = max_side
+        self.workers = workers
+        self.enabled = self.image_format in FORMATS and Image is not None
+        if self.image_format in FORMATS and Image is None:
+            logger.warning("Pillow не установлен, изображения отправляются без перекодирования")
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.images = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.transcode_seconds = 0.0
+        self._uploads: Dict[str, list] = {}
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.image_format][1] if self.enabled else "png"
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def transcode(self, data: bytes) -> bytes:
+        """Возвращает сжатое изображение; при ошибке - исходные данные."""
+        if not self.enabled:
+            return data
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(self._get_executor(), transcode_image, data,
+                                                self.image_format, self.quality, self.max_side)
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"Ошибка при перекодировании изображения: {e}")
+            return data
+        elapsed = time.monotonic() - started
+        STAGE_SECONDS.observe(elapsed, stage="transcode")
+        self.transcode_seconds += elapsed
+        self.images += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(result)
+        return result
+
+    def record_upload(self, kind: str, size: int, seconds: float) -> None:
+        """Учитывает загрузку в Telegram: kind - photo или document."""
+        STAGE_SECONDS.observe(seconds, stage=f"upload_{kind}")
+        stats = self._uploads.setdefault(kind, [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += size
+        stats[2] += seconds
+
+    def stats(self) -> Dict[str, float]:
+        result = {
+            "images": self.images,
+            "failures": self.failures,
+            "avg_bytes_in": self.bytes_in / self.images if self.images else 0.0,
+            "avg_bytes_out": self.bytes_out / self.images if self.images else 0.0,
+            "ratio": self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+            "avg_transcode_seconds": self.transcode_seconds / self.images if self.images else 0.0,
+        }
+        for kind, (count, size, seconds) in self._uploads.items():
+            result[f"{kind}_uploads"] = count
+            result[f"{kind}_avg_bytes"] = size / count
+            result[f"{kind}_avg_seconds"] = seconds / count
+        return result
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class OriginalsStore:
+    """Оригиналы в полном разрешении для кнопки «Отправить файлом».
+
+    Хранятся в памяти с вытеснением давно не использованных записей по
+    суммарному размеру.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self.total_bytes = 0
+
+    def put(self, key: str, data: bytes) -> None:
+        old = self._items.pop(key, None)
+        if old is not None:
+            self.total_bytes -= len(old)
+        self._items[key] = data
+        self.total_bytes += len(data)
+        while self.total_bytes > self.max_bytes and len(self._items) > 1:
+            _, evicted = self._items.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._items.get(key)
+        if data is not None:
+            self._items.move_to_end(key)
+        return data
+
+    def __len__(self) -> int:
+        return len(self._items)
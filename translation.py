@@ -0,0 +1,221 @@
+import asyncio
+import importlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from clients import GoogleTranslateClient
+
+logger = logging.getLogger(__name__)
+
+
+def is_russian(text: str) -> bool:
+    """Проверяет, содержит ли текст русские символы."""
+    return any(ord('а') <= ord(c) <= ord('я') or ord('А') <= ord(c) <= ord('Я') for c in text)
+
+
+def normalize(text: str) -> str:
+    """Приводит текст к виду, по которому он ищется в кеше."""
+    return ' '.join(text.split())
+
+
+class TranslationBackend:
+    """Базовый класс сервиса перевода.
+
+    Реализации переводят сразу список текстов и возвращают переводы в том
+    же порядке. Так можно подключить локальный или офлайн-переводчик, а в
+    тестах - заглушку.
+    """
+
+    async def translate_batch(self, texts: List[str]) -> List[str]:
+        raise NotImplementedError
+
+
+class NullTranslationBackend(TranslationBackend):
+    """Переводчик-заглушка: возвращает тексты без изменений."""
+
+    async def translate_batch(self, texts: List[str]) -> List[str]:
+        return list(texts)
+
+
+class GoogleTranslationBackend(TranslationBackend):
+    """Перевод через Google Translate.
+
+    Пакет текстов отправляется одним запросом, тексты разделяются переводом
+    строки. Если число строк в ответе не совпало, тексты переводятся по одному.
+    """
+
+    def __init__(self, client: GoogleTranslateClient):
+        self.client = client
+
+    async def translate_batch(self, texts: List[str]) -> List[str]:
+        if len(texts) == 1:
+            return [await self.client.translate(texts[0])]
+        translated = (await self.client.translate('\n'.join(texts))).split('\n')
+        if len(translated) == len(texts):
+            return [line.strip() for line in translated]
+        logger.warning("Пакетный перевод вернул другое число строк, перевожу по одному")
+        return list(await asyncio.gather(*(self.client.translate(text) for text in texts)))
+
+
+def create_backend(name: str, client: GoogleTranslateClient) -> TranslationBackend:
+    """Создаёт сервис перевода по имени из конфигурации.
+
+    Поддерживаются "google", "none" и путь к своему классу вида "module:Class".
+    """
+    if name == "google":
+        return GoogleTranslationBackend(client)
+    if name == "none":
+        return NullTranslationBackend()
+    module_name, _, class_name = name.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+class DiskTranslationCache:
+    """Постоянный кеш переводов в SQLite с ограничением по числу записей.
+
+    При превышении лимита удаляются записи, которые дольше всего не использовались.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS translations "
+                         "(source TEXT PRIMARY KEY, result TEXT NOT NULL, used_at REAL NOT NULL)")
+        self._db.commit()
+
+    def get(self, source: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT result FROM translations WHERE source = ?", (source,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE translations SET used_at = ? WHERE source = ?", (time.time(), source))
+            self._db.commit()
+            return row[0]
+
+    def put_many(self, items: Dict[str, str]) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO translations (source, result, used_at) VALUES (?, ?, ?)",
+                                 [(source, result, now) for source, result in items.items()])
+            self._db.execute("DELETE FROM translations WHERE source IN (SELECT source FROM translations "
+                             "ORDER BY used_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            self._db.commit()
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class Translator:
+    """Перевод запросов на английский с кешированием и пакетной обработкой.
+
+    Конвейер: текст без русских символов возвращается как есть, затем
+    проверяется LRU-кеш в памяти, затем одинаковые запросы, уже ожидающие
+    перевода, объединяются, затем проверяется дисковый кеш. Оставшиеся
+    тексты копятся batch_window секунд и переводятся одним пакетом.
+    """
+
+    def __init__(self, backend: TranslationBackend, cache_size: int,
+                 disk_cache: Optional[DiskTranslationCache] = None,
+                 batch_window: float = 0.05, max_batch: int = 16):
+        self.backend = backend
+        self.cache_size = cache_size
+        self.disk_cache = disk_cache
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._pending: List[str] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._tasks = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, source: str, result: str) -> None:
+        self._cache[source] = result
+        self._cache.move_to_end(source)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def translate(self, text: str) -> str:
+        """Переводит текст на английский; при ошибке возвращает исходный текст."""
+        if not is_russian(text):
+            return text
+        source = normalize(text)
+        cached = self._cache.get(source)
+        if cached is not None:
+            self._cache.move_to_end(source)
+            self.hits += 1
+            return cached
+        future = self._inflight.get(source)
+        if future is None:
+            future = self._inflight[source] = asyncio.get_running_loop().create_future()
+            self._spawn(self._lookup(source))
+        else:
+            self.hits += 1
+        return await asyncio.shield(future)
+
+    async def _lookup(self, source: str) -> None:
+        if self.disk_cache is not None:
+            try:
+                cached = await asyncio.to_thread(self.disk_cache.get, source)
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка чтения дискового кеша переводов: {e}")
+                cached = None
+            if cached is not None:
+                self.hits += 1
+                self._remember(source, cached)
+                self._inflight.pop(source).set_result(cached)
+                return
+        self.misses += 1
+        self._pending.append(source)
+        if len(self._pending) >= self.max_batch:
+            self._spawn(self._flush())
+        elif self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.batch_window)
+        self._flush_task = None
+        await self._flush()
+
+    async def _flush(self) -> None:
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if not batch:
+            return
+        if self._pending and self._flush_task is None:
+            self._flush_task = self._spawn(self._flush_later())
+        try:
+            results = await self.backend.translate_batch(batch)
+        except Exception as e:
+            logger.error(f"Ошибка при переводе: {e}")
+            results = batch
+        else:
+            for source, result in zip(batch, results):
+                self._remember(source, result)
+            if self.disk_cache is not None:
+                try:
+                    await asyncio.to_thread(self.disk_cache.put_many, dict(zip(batch, results)))
+                except sqlite3.Error as e:
+                    logger.error(f"Ошибка записи дискового кеша переводов: {e}")
+        for source, result in zip(batch, results):
+            future = self._inflight.pop(source, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    def close(self) -> None:
+        if self.disk_cache is not None:
+            self.disk_cache.close()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Dict, Optional
+
+from clients import SDAPIError
+from metrics import STAGE_SECONDS
+
+if TYPE_CHECKING:
+    from backends import Backend, BackendPool
+    from clients import SDClient
+
+logger = logging.getLogger(__name__)
+
+# Маленькая генерация, после которой ядра CUDA скомпилированы и модель в памяти GPU
+WARMUP_PAYLOAD = {
+    "prompt": "warmup",
+    "negative_prompt": "",
+    "width": 256,
+    "height": 256,
+    "num_outputs": 1,
+    "num_inference_steps": 2,
+    "seed": 0,
+}
+
+
+class BackendWarmer:
+    """Прогрев серверов Stable Diffusion перед приёмом задач.
+
+    Пока сервер прогревается (backend.warming), пул не направляет на него
+    задачи. Прогрев проверяет через /sdapi/v1/options, что загружен нужный
+    чекпойнт, при необходимости переключает его (ищется в
+    /sdapi/v1/sd-models) и выполняет маленький txt2img. Время прогрева
+    сохраняется в backend.warmup_seconds и в этапе warmup метрик. Если
+    прогрев не удался, сервер всё равно возвращается в работу: дальше его
+    состояние определяют фоновая проверка и автомат защиты.
+    """
+
+    def __init__(self, pool: "BackendPool", client: "SDClient", checkpoint: str = "", timeout: float = 600.0,
+                 enabled: bool = True):
+        self.pool = pool
+        self.client = client
+        self.checkpoint = checkpoint
+        self.timeout = timeout
+        self.enabled = enabled
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def schedule(self, backend: "Backend") -> Optional[asyncio.Task]:
+        """Запускает прогрев сервера (или возвращает уже идущий)."""
+        if not self.enabled:
+            return None
+        task = self._tasks.get(backend.url)
+        if task is None:
+            backend.warming = True
+            task = self._tasks[backend.url] = asyncio.create_task(self.warm(backend))
+            task.add_done_callback(lambda done: self._forget(backend.url, done))
+        return task
+
+    def _forget(self, url: str, task: asyncio.Task) -> None:
+        if self._tasks.get(url) is task:
+            del self._tasks[url]
+
+    def schedule_pending(self) -> None:
+        """Прогревает серверы пула, которые ещё не прогревались."""
+        for backend in self.pool.backends:
+            if backend.warmup_seconds is None and backend.warmup_error is None:
+                self.schedule(backend)
+
+    async def wait(self) -> None:
+        """Дожидается окончания идущих прогревов (удачного или нет)."""
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def warm(self, backend: "Backend") -> None:
+        backend.warming = True
+        backend.warmup_error = None
+        logger.info(f"Прогрев сервера {backend.url}...")
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._warm(backend.url), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.TimeoutError):
+                e = SDAPIError(f"прогрев не завершился за {self.timeout:.0f} с")
+            backend.warmup_error = str(e)
+            logger.warning(f"Не удалось прогреть сервер {backend.url}: {e}")
+        else:
+            backend.warmup_seconds = time.monotonic() - started
+            STAGE_SECONDS.observe(backend.warmup_seconds, stage="warmup")
+            logger.info(f"Сервер {backend.url} прогрет за {backend.warmup_seconds:.1f} с")
+        finally:
+            backend.warming = False
+            self.pool.notify()
+
+    async def _warm(self, url: str) -> None:
+        if self.checkpoint:
+            await self._ensure_checkpoint(url)
+        await self.client.txt2img(url, WARMUP_PAYLOAD)
+
+    async def _ensure_checkpoint(self, url: str) -> None:
+        """Загружает на сервере нужный чекпойнт, если сейчас загружен другой."""
+        current = (await self.client.options(url)).get("sd_model_checkpoint") or ""
+        if self.checkpoint in current:
+            logger.info(f"На сервере {url} уже загружен чекпойнт {current}")
+            return
+        models = await self.client.models(url)
+        title = next((model["title"] for model in models
+                      if self.checkpoint in (model.get("title", ""), model.get("model_name", ""))
+                      or model.get("title", "").startswith(self.checkpoint)), None)
+        if title is None:
+            raise SDAPIError(f"чекпойнт {self.checkpoint} не найден на сервере")
+        logger.info(f"Загрузка чекпойнта {title} на сервере {url} (был {current or 'не задан'})")
+        loading_started = time.monotonic()
+        await self.client.set_options(url, {"sd_model_checkpoint": title}, self.timeout)
+        STAGE_SECONDS.observe(time.monotonic() - loading_started, stage="checkpoint_load")
@@ -0,0 +1,88 @@
+import hmac
+import logging
+from typing import Optional, Sequence
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from lifecycle import Lifecycle
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """Встроенный HTTP-сервер для приёма обновлений Telegram.
+
+    Обновления кладутся в очередь приложения и обрабатываются так же, как
+    при опросе, - параллельно, если включены concurrent_updates. Запрос без
+    верного секретного токена отклоняется. Для локальной проверки достаточно
+    отправить POST с JSON обновления и заголовком секретного токена.
+    """
+
+    def __init__(self, application: Application, host: str, port: int, path: str,
+                 secret_token: Optional[str], max_body_size: int = 1024 * 1024):
+        self.application = application
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.app = web.Application(client_max_size=max_body_size)
+        self.app.router.add_post(path, self._handle_update)
+        self._runner: Optional[web.AppRunner] = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Webhook-сервер слушает {self.host}:{self.port}{self.path}")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""),
+                                                         self.secret_token):
+            self.rejected += 1
+            logger.warning(f"Отклонён запрос к webhook с неверным секретным токеном от {request.remote}")
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self.rejected += 1
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            return web.Response(status=400)
+        if update is None:
+            return web.Response(status=400)
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return web.Response()
+
+
+async def serve_webhook(application: Application, server: WebhookServer, webhook_url: Optional[str],
+                        allowed_updates: Sequence[str], max_connections: int, lifecycle: Lifecycle,
+                        standby: bool = False) -> None:
+    """Запускает приложение в режиме webhook до сигнала остановки.
+
+    Жизненный цикл и плавную остановку выполняет lifecycle. Если
+    webhook_url не задан, webhook в Telegram не регистрируется - это удобно
+    для локальной проверки записанными обновлениями. При остановке webhook
+    не удаляется: его перерегистрирует следующий экземпляр бота.
+    """
+
+    async def start_receiving() -> None:
+        await server.start()
+        if webhook_url:
+            await application.bot.set_webhook(webhook_url, allowed_updates=list(allowed_updates),
+                                              secret_token=server.secret_token,
+                                              max_connections=max_connections)
+            logger.info(f"Webhook зарегистрирован: {webhook_url}")
+
+    await lifecycle.run(application, start_receiving, server.stop, standby)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Процесс генерации изображений для режима BOT_ROLE=frontend.
+
+Воркер забирает задачи из общей очереди, выполняет их на своём пуле
+серверов Stable Diffusion и сам отправляет результат в чат по chat_id.
+Таких процессов можно запустить сколько угодно на разных ядрах и машинах,
+если они видят одно хранилище очереди.
+
+Запуск:
+    python worker.py [--worker-id gpu1-0]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Dict, Optional
+
+import telegram
+import telegram.error
+
+import bot
+from clients import SDAPIError
+from metrics import MetricsServer, STAGE_SECONDS, trace_id
+from jobqueue import (JobStore, QueuedJob, SharedSettings, create_job_store, STATUS_DONE, STATUS_FAILED,
+                      STATUS_CANCELLED)
+from result_cache import payload_key, is_cacheable
+from lifecycle import InstanceState, STATE_DRAINING, STATE_RUNNING
+from scheduler import GenerationJob, JobCancelledError, QueueFullError
+from config import (TELEGRAM_TOKEN, JOB_STORE_BACKEND, JOB_STORE_PATH, SETTINGS_REFRESH_INTERVAL,
+                    WORKER_POLL_INTERVAL, WORKER_HEARTBEAT_INTERVAL, WORKER_STALE_TIMEOUT, JOB_MAX_ATTEMPTS,
+                    JOB_DEADLINE, JOB_RETENTION, RESULT_CACHE_SIZE, METRICS_HOST, DRAIN_TIMEOUT, RUN_DIR)
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationWorker:
+    """Выполняет задачи из общей очереди через планировщик этого процесса.
+
+    Задачи забираются, только пока у пула серверов есть свободные места,
+    поэтому очередь остаётся общей, а не растаскивается по воркерам.
+    Воркер периодически отмечается в хранилище, проверяет, не отменены ли
+    его задачи, и возвращает в очередь задачи упавших воркеров. После
+    drain() воркер больше не забирает задачи и завершается, когда доделает
+    уже взятые.
+    """
+
+    def __init__(self, store: JobStore, telegram_bot: telegram.Bot, worker_id: str,
+                 state: Optional[InstanceState] = None):
+        self.store = store
+        self.bot = telegram_bot
+        self.worker_id = worker_id
+        # Файл состояния для manage_bot.py status
+        self.state = state
+        self._active: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self.draining = False
+        self.processed = 0
+        self.failed = 0
+
+    async def run(self) -> None:
+        self._report()
+        heartbeat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while not self.draining:
+                if len(self._active) >= bot.backend_pool.capacity:
+                    await self._sleep()
+                    continue
+                queued = await asyncio.to_thread(self.store.claim, self.worker_id)
+                if queued is None:
+                    await self._sleep()
+                    continue
+                task = asyncio.create_task(self._process(queued))
+                self._active[queued.job_id] = task
+                task.add_done_callback(lambda _, job_id=queued.job_id: self._on_done(job_id))
+            if self._active:
+                logger.info(f"Воркер {self.worker_id} доделывает задачи в работе: {len(self._active)}")
+                await asyncio.wait(list(self._active.values()))
+        finally:
+            heartbeat.cancel()
+            for task in list(self._active.values()):
+                task.cancel()
+            await asyncio.gather(heartbeat, *self._active.values(), return_exceptions=True)
+            # Незавершённые задачи достанутся другим воркерам
+            requeued = await asyncio.to_thread(self.store.requeue, self.worker_id)
+            if requeued:
+                logger.info(f"Возвращено в очередь задач: {requeued}")
+
+    def drain(self) -> None:
+        """Перестаёт забирать задачи из очереди; взятые задачи доделываются."""
+        self.draining = True
+        self._wakeup.set()
+        self._report()
+
+    def _report(self) -> None:
+        if self.state is None:
+            return
+        try:
+            self.state.set(STATE_DRAINING if self.draining else STATE_RUNNING, worker_id=self.worker_id,
+                           processed=self.processed, failed=self.failed, active=len(self._active))
+        except OSError as e:
+            logger.warning(f"Не удалось записать файл состояния {self.state.path}: {e}")
+
+    async def _sleep(self) -> None:
+        # Ждём освобождения слота или начала остановки, но не дольше периода опроса
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), WORKER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+    def _on_done(self, job_id: str) -> None:
+        self._active.pop(job_id, None)
+        self._wakeup.set()
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+            self._report()
+            try:
+                await asyncio.to_thread(self.store.heartbeat, self.worker_id)
+                statuses = await asyncio.to_thread(self.store.statuses, list(self._active))
+                for job_id, status in statuses.items():
+                    if status == STATUS_CANCELLED:
+                        bot.scheduler.cancel(job_id)
+                requeued, failed = await asyncio.to_thread(self.store.requeue_stale, WORKER_STALE_TIMEOUT,
+                                                           JOB_MAX_ATTEMPTS)
+                if requeued:
+                    logger.warning(f"Возвращено в очередь задач неотвечающих воркеров: {requeued}")
+                for queued in await asyncio.to_thread(self.store.expire):
+                    logger.info(f"Задача {queued.job_id} не дождалась воркера до истечения срока")
+                    await self._notify_cancelled(queued, "expired")
+                for queued in failed:
+                    logger.warning(f"Задача {queued.job_id} не выполнена за {queued.attempts} попыток")
+                    await self._notify_failed(queued)
+                # Завершённые задачи нужны только для статистики - старые удаляем
+                await asyncio.to_thread(self.store.prune, JOB_RETENTION, RESULT_CACHE_SIZE)
+            except Exception as e:
+                logger.error(f"Ошибка при обращении к очереди задач: {e}")
+
+    async def _edit(self, queued: QueuedJob, text: str, with_cancel: bool = True) -> None:
+        try:
+            await self.bot.edit_message_text(text, chat_id=queued.chat_id, message_id=queued.message_id,
+                                             reply_markup=bot.cancel_keyboard(queued.job_id) if with_cancel else None)
+        except telegram.error.BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+
+    async def _notify_cancelled(self, queued: QueuedJob, reason: str) -> None:
+        try:
+            await self._edit(queued, bot.format_cancelled(reason), with_cancel=False)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось сообщить об отмене задачи {queued.job_id}: {e}")
+
+    async def _notify_failed(self, queued: QueuedJob) -> None:
+        # Задачу бросил чужой воркер: сообщаем пользователю вместо него
+        try:
+            await self._edit(queued, bot.GENERATION_FAILED_TEXT, with_cancel=False)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось сообщить об ошибке задачи {queued.job_id}: {e}")
+
+    async def _process(self, queued: QueuedJob) -> None:
+        try:
+            await self._execute(queued)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Ошибка при выполнении задачи {queued.job_id}: {e}")
+            await asyncio.to_thread(self.store.finish, queued.job_id, STATUS_FAILED, str(e))
+            await self._notify_failed(queued)
+
+    async def _execute(self, queued: QueuedJob) -> None:
+        trace_id.set(queued.job_id)
+        chat_id = queued.chat_id
+
+        async def on_start() -> None:
+            await self._edit(queued, bot.format_started(job.predicted))
+
+        async def on_progress(progress: float, eta: float, preview: bytes) -> None:
+            text = bot.format_progress(progress, eta)
+            await bot.edit_throttle.call(chat_id, lambda: self._edit(queued, text))
+
+        # Срок отсчитывается от постановки в общую очередь, а не от того, когда задачу взял воркер
+        remaining = queued.deadline - time.time() if queued.deadline is not None else JOB_DEADLINE
+        job = GenerationJob(user_id=queued.user_id, chat_id=chat_id, prompt=queued.prompt, payload=queued.payload,
+                            job_id=queued.job_id, deadline=time.monotonic() + remaining,
+                            on_start=on_start, on_progress=on_progress)
+        try:
+            image_data = await bot.scheduler.submit(job)
+        except QueueFullError:
+            # Локальная очередь переполнена - задачу заберёт кто-то другой
+            await asyncio.to_thread(self.store.requeue, self.worker_id, queued.job_id)
+            return
+        except JobCancelledError as e:
+            await asyncio.to_thread(self.store.finish, queued.job_id, STATUS_CANCELLED, e.reason)
+            await self._edit(queued, bot.format_cancelled(e.reason), with_cancel=False)
+            return
+        except SDAPIError as e:
+            image_data = None
+            logger.error(f"Не удалось сгенерировать изображение для задачи {queued.job_id}: {e}")
+        finally:
+            bot.edit_throttle.forget(chat_id)
+
+        if not image_data:
+            self.failed += 1
+            await asyncio.to_thread(self.store.finish, queued.job_id, STATUS_FAILED, "генерация не удалась")
+            await self._edit(queued, bot.GENERATION_FAILED_TEXT, with_cancel=False)
+            return
+
+        cache_key = payload_key(queued.payload) if is_cacheable(queued.payload) else None
+        if cache_key:
+            await bot.result_cache.put_bytes(cache_key, image_data)
+        photo = await bot.transcoder.transcode(image_data)
+        started = time.monotonic()
+        message = await self.bot.send_photo(chat_id=chat_id, photo=photo, caption=queued.caption)
+        bot.transcoder.record_upload("photo", len(photo), time.monotonic() - started)
+        if cache_key and message.photo:
+            # file_id нужен фронтенду: повторный запрос он отправит сам, без очереди
+            file_id = message.photo[-1].file_id
+            bot.result_cache.put_file_id(cache_key, file_id)
+            await asyncio.to_thread(self.store.put_file_id, cache_key, file_id)
+        STAGE_SECONDS.observe(time.time() - queued.created_at, stage="end_to_end")
+        await asyncio.to_thread(self.store.finish, queued.job_id, STATUS_DONE)
+        self.processed += 1
+        try:
+            await self.bot.delete_message(chat_id=chat_id, message_id=queued.message_id)
+        except telegram.error.TelegramError:
+            pass
+        logger.info(f"Задача {queued.job_id} выполнена, изображение отправлено в чат {chat_id}")
+
+
+async def serve(worker_id: str, metrics_port: int) -> None:
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    worker = None
+
+    def request_stop() -> None:
+        # Первый сигнал - плавная остановка, повторный или истечение DRAIN_TIMEOUT -
+        # немедленная: незавершённые задачи возвращаются в общую очередь
+        if worker is None or worker.draining:
+            main_task.cancel()
+            return
+        logger.info(f"Воркер {worker_id} останавливается, задачи в работе доделываются "
+                    f"(не дольше {DRAIN_TIMEOUT:.0f} с)...")
+        worker.drain()
+        loop.call_later(DRAIN_TIMEOUT, main_task.cancel)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_stop)
+    store = create_job_store(JOB_STORE_BACKEND, JOB_STORE_PATH)
+    settings = SharedSettings(store, SETTINGS_REFRESH_INTERVAL, bot.apply_shared_setting)
+    metrics_server = MetricsServer(METRICS_HOST, metrics_port) if metrics_port else None
+    async with telegram.Bot(TELEGRAM_TOKEN) as telegram_bot:
+        if metrics_server is not None:
+            await metrics_server.start()
+        await settings.start()
+        bot.scheduler.start()
+        bot.health_checker.start()
+        bot.backend_warmer.schedule_pending()
+        state = InstanceState(RUN_DIR, "worker")
+        worker = GenerationWorker(store, telegram_bot, worker_id, state)
+        logger.info(f"Воркер {worker_id} запущен, серверы: {', '.join(b.url for b in bot.backend_pool.backends)}")
+        try:
+            await worker.run()
+        finally:
+            state.remove()
+            await settings.stop()
+            await bot.backend_warmer.stop()
+            await bot.health_checker.stop()
+            await bot.progress_monitor.stop()
+            await bot.scheduler.stop()
+            await bot.http_pool.close()
+            bot.transcoder.close()
+            store.close()
+            if metrics_server is not None:
+                await metrics_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Процесс генерации изображений")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}",
+                        help="Имя воркера в общей очереди")
+    # METRICS_PORT занят ботом, поэтому порт воркера задаётся явно (manage_bot.py supervise делает это сам)
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Порт эндпоинта /metrics этого воркера (0 - выключен)")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.worker_id, args.metrics_port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info(f"Воркер {args.worker_id} остановлен")
+
+
+if __name__ == "__main__":
+    main()